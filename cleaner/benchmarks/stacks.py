@@ -0,0 +1,249 @@
+import argparse
+import contextlib
+import io
+import json
+import logging
+import random
+import sys
+import time
+import tracemalloc
+
+from datetime import datetime
+from datetime import timedelta
+from datetime import timezone
+
+from unittest import mock
+
+from cleaner.lambdas.cloudformation import stacks
+
+
+# Times the stack cleaner's inventory parsing, rule evaluation and the
+# end-to-end get_stacks_to_delete against synthetic inventories. AWS is
+# replaced with in-memory stubs so the numbers reflect our code, not the
+# network or moto:
+#
+#   python -m benchmarks.stacks
+#   python -m benchmarks.stacks --sizes 100000 --messages 1000 --json
+
+DEFAULT_SIZES = [100, 1000, 10000, 100000]
+DEFAULT_MESSAGE_COUNTS = [1, 10, 100, 1000]
+DESCRIBE_STACKS_PAGE_SIZE = 100
+NOW = datetime(2022, 9, 4, 21, 44, 28, tzinfo=timezone.utc)
+
+# Stacks each demo deployment creates.
+STACK_SUFFIXES = [
+    'DemoDeploymentPipelineStack',
+    'DeployDevelopment-BackendStack',
+    'DeployDevelopment-PostgresStack',
+    'DeployDevelopment-FrontendStack',
+]
+
+
+def make_tags(branch, random_state):
+    tags = [
+        {'Key': 'project', 'Value': 'igvf-dev'},
+        {'Key': 'environment', 'Value': 'demo'},
+        {'Key': 'branch', 'Value': branch},
+    ]
+    if random_state.random() < 0.9:
+        tags.append(
+            {
+                'Key': 'time-to-live-hours',
+                # A few stacks carry unparsable values.
+                'Value': random_state.choice(['24', '48', '72', '168', 'never']),
+            }
+        )
+    if random_state.random() < 0.5:
+        tags.append(
+            {
+                'Key': 'turn-off-on-friday-night',
+                'Value': random_state.choice(['yes', 'no']),
+            }
+        )
+    return tags
+
+
+def make_raw_stacks(count, seed=0):
+    random_state = random.Random(seed)
+    raw_stacks = []
+    for i in range(count):
+        branch = f'IGVF-{i // len(STACK_SUFFIXES)}-synthetic-branch'
+        suffix = STACK_SUFFIXES[i % len(STACK_SUFFIXES)]
+        name = f'igvfd-{branch}-{suffix}'
+        raw_stack = {
+            'StackId': f'arn:aws:cloudformation:us-west-2:654654139991:stack/{name}/{i:08x}',
+            'StackName': name,
+            'CreationTime': NOW - timedelta(hours=random_state.randint(0, 200)),
+            'StackStatus': random_state.choice(
+                ['CREATE_COMPLETE'] * 8 + ['UPDATE_COMPLETE', 'DELETE_IN_PROGRESS']
+            ),
+            'Parameters': [
+                {'ParameterKey': 'BootstrapVersion', 'ParameterValue': '/cdk-bootstrap/hnb659fds/version'},
+            ],
+            'Capabilities': ['CAPABILITY_IAM', 'CAPABILITY_NAMED_IAM'],
+            'Tags': make_tags(branch, random_state),
+        }
+        if suffix == 'DeployDevelopment-PostgresStack':
+            raw_stack['Outputs'] = [
+                {
+                    'OutputKey': 'ExportsOutputRefPostgres',
+                    'OutputValue': 'abc',
+                    'ExportName': f'{name}:ExportsOutputRefPostgres',
+                }
+            ]
+        raw_stacks.append(raw_stack)
+    return raw_stacks
+
+
+def make_pages(raw_stacks):
+    return [
+        {'Stacks': raw_stacks[i:i + DESCRIBE_STACKS_PAGE_SIZE]}
+        for i in range(0, len(raw_stacks), DESCRIBE_STACKS_PAGE_SIZE)
+    ]
+
+
+def make_messages(count, stack_count):
+    # Half the messages name branches that still have stacks.
+    branch_count = max(stack_count // len(STACK_SUFFIXES), 1)
+    return [
+        {
+            'Body': json.dumps(
+                {
+                    'event': 'BRANCH_DELETED',
+                    'branch': (
+                        f'IGVF-{i % branch_count}-synthetic-branch'
+                        if i % 2 == 0
+                        else f'IGVF-{i}-gone-branch'
+                    ),
+                }
+            ),
+            'ReceiptHandle': str(i),
+        }
+        for i in range(count)
+    ]
+
+
+def get_importing_stack_names(client, export_name):
+    # Backend imports the Postgres stack's export.
+    return [
+        export_name.split(':')[0].replace('PostgresStack', 'BackendStack')
+    ]
+
+
+@contextlib.contextmanager
+def stubbed_aws(pages, messages):
+    with contextlib.ExitStack() as stack:
+        stack.enter_context(mock.patch.object(stacks, 'get_describe_stacks_pages', return_value=pages))
+        stack.enter_context(mock.patch.object(stacks, 'get_describe_stacks_paginator'))
+        stack.enter_context(mock.patch.object(stacks, 'get_cloudformation_client'))
+        stack.enter_context(mock.patch.object(stacks, 'get_messages_from_delete_branch_queue', autospec=True, return_value=messages))
+        stack.enter_context(mock.patch.object(stacks, 'delete_messages_from_delete_branch_queue', autospec=True, return_value=[]))
+        stack.enter_context(mock.patch.object(stacks, 'get_importing_stack_names', get_importing_stack_names))
+        stack.enter_context(mock.patch.object(stacks, 'get_deletion_list_bucket_or_none', return_value=None))
+        stack.enter_context(mock.patch.object(stacks, 'get_current_utc_time', return_value=NOW))
+        stack.enter_context(mock.patch.object(stacks, 'get_current_pacific_time', return_value=stacks.get_pacific_time(NOW)))
+        # Keeps EMF records out of the report.
+        stack.enter_context(contextlib.redirect_stdout(io.StringIO()))
+        yield
+
+
+def measure(function, repeat):
+    # Best of repeat for time, then a separate traced run for peak
+    # memory so tracing overhead doesn't skew the timings.
+    durations = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        durations.append(time.perf_counter() - start)
+    tracemalloc.start()
+    try:
+        function()
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return {
+        'seconds': min(durations),
+        'peak_bytes': peak,
+    }
+
+
+def get_benchmarks(raw_stacks, messages):
+    pages = make_pages(raw_stacks)
+    records = stacks.make_stack_inventory(pages).stacks
+    branches = stacks.group_messages_by_branch(messages)
+
+    def evaluate(make_rule):
+        # Rules can keep state, so each run gets a fresh one.
+        return lambda: stacks.evaluate_deletion_rules(records, [make_rule()])
+
+    def get_stacks_to_delete():
+        with stubbed_aws(pages, messages):
+            stacks.get_stacks_to_delete({}, {})
+
+    return {
+        'make_stack_inventory': lambda: stacks.make_stack_inventory(pages),
+        'group_messages_by_branch': lambda: stacks.group_messages_by_branch(messages),
+        'time_to_live_hours_rule': evaluate(lambda: stacks.TimeToLiveHoursRule(NOW)),
+        'friday_night_rule': evaluate(stacks.FridayNightRule),
+        'branch_deleted_rule': evaluate(lambda: stacks.BranchDeletedRule(branches)),
+        'get_stacks_to_delete': get_stacks_to_delete,
+    }
+
+
+def run(sizes, message_counts, repeat):
+    results = []
+    for size in sizes:
+        raw_stacks = make_raw_stacks(size)
+        for message_count in message_counts:
+            messages = make_messages(message_count, size)
+            for name, function in get_benchmarks(raw_stacks, messages).items():
+                results.append(
+                    {
+                        'benchmark': name,
+                        'stacks': size,
+                        'messages': message_count,
+                        **measure(function, repeat),
+                    }
+                )
+    return results
+
+
+def print_results(results, file):
+    print(
+        f'{"benchmark":<26}{"stacks":>8}{"messages":>10}{"ms":>12}{"peak KiB":>12}',
+        file=file
+    )
+    for result in results:
+        print(
+            f'{result["benchmark"]:<26}{result["stacks"]:>8}{result["messages"]:>10}'
+            f'{result["seconds"] * 1000:>12.2f}{result["peak_bytes"] / 1024:>12.1f}',
+            file=file
+        )
+
+
+def get_args(argv):
+    parser = argparse.ArgumentParser(
+        prog='python -m benchmarks.stacks',
+        description='Benchmark stack cleaner rule evaluation on synthetic inventories.'
+    )
+    parser.add_argument('--sizes', type=int, nargs='+', default=DEFAULT_SIZES)
+    parser.add_argument('--messages', type=int, nargs='+', default=DEFAULT_MESSAGE_COUNTS)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--json', action='store_true')
+    return parser.parse_args(argv)
+
+
+def main(argv=None, stdout=sys.stdout):
+    args = get_args(argv)
+    # Per-stack rule logs would dominate the timings.
+    logging.getLogger(stacks.__name__).setLevel(logging.ERROR)
+    results = run(args.sizes, args.messages, args.repeat)
+    if args.json:
+        print(json.dumps(results, indent=4), file=stdout)
+    else:
+        print_results(results, stdout)
+    return results
+
+
+if __name__ == '__main__':
+    main()
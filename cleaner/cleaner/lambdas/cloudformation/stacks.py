@@ -1,7 +1,20 @@
+import abc
 import boto3
 import logging
 import json
 import os
+import threading
+import time
+import uuid
+
+from array import array
+
+from botocore.config import Config
+from botocore.exceptions import ClientError
+
+from concurrent.futures import ThreadPoolExecutor
+
+from itertools import islice
 
 from datetime import datetime
 from datetime import timezone
@@ -32,12 +45,74 @@ TIME_TO_LIVE_HOURS = 'time-to-live-hours'
 TURN_OFF_ON_FRIDAY_NIGHT = 'turn-off-on-friday-night'
 BRANCH = 'branch'
 
+# Clients are cached at module level so warm invocations reuse their
+# loaded service models and open connections.
+BOTO_CONFIG = Config(
+    max_pool_connections=25,
+    connect_timeout=5,
+    read_timeout=30,
+    retries={
+        'mode': 'adaptive',
+        'max_attempts': 8,
+    },
+)
+
+clients = {}
+clients_lock = threading.Lock()
+
+INVENTORY_MODE_DESCRIBE_STACKS = 'describe_stacks'
+# Reads the stack inventory table kept current from CloudFormation
+# events, only fetching what changed since the previous warm run.
+INVENTORY_MODE_CACHE = 'cache'
+INVENTORY_CACHE_SHARD = 'stacks'
+INVENTORY_CACHE_INDEX_NAME = 'ByUpdatedAt'
+# Re-read writes that landed just before the last query, allowing for
+# clock skew and index propagation.
+INVENTORY_CACHE_OVERLAP_MILLISECONDS = 5 * 60 * 1000
+
+inventory_cache = {
+    'stacks_by_id': {},
+    'read_until': None,
+}
+
+SQS_MAX_BATCH_SIZE = 10
+DELETE_BRANCH_QUEUE_POLL_WAIT_SECONDS = 1
+DELETE_BRANCH_QUEUE_DEFAULT_MAX_MESSAGES = 1000
+# Left for the rule pass and acknowledgements after draining the queue.
+DELETE_BRANCH_QUEUE_RESERVED_SECONDS = 30
+DELETE_MESSAGE_BATCH_MAX_ATTEMPTS = 3
+DELETE_MESSAGE_BATCH_BACKOFF_SECONDS = 0.5
+
+METRICS_NAMESPACE = 'DemoCleaner'
+METRICS_SERVICE = 'GetStacksToDelete'
+
+# Stacks are evaluated in chunks so batch rules get columns to work on
+# without holding a streamed inventory in memory all at once.
+EVALUATION_BATCH_SIZE = 10000
+
+# Items the state machine writes to its DynamoDB tables expire this
+# long after the run started. Step Functions can't turn a timestamp into
+# epoch seconds, so the run's expiry comes from here.
+STATE_MACHINE_ITEM_TTL_SECONDS = 7 * 24 * 60 * 60
+
 SECONDS_IN_AN_HOUR = 3600
 SATURDAY_WEEKDAY_NUMBER = 5
 
 
+def get_client(service_name):
+    # Client creation isn't thread-safe, and the inventory and queue
+    # are fetched on separate threads.
+    with clients_lock:
+        if service_name not in clients:
+            clients[service_name] = boto3.client(
+                service_name,
+                config=BOTO_CONFIG,
+            )
+        return clients[service_name]
+
+
 def get_cloudformation_client():
-    return boto3.client('cloudformation')
+    return get_client('cloudformation')
 
 
 def get_describe_stacks_paginator(client):
@@ -45,52 +120,311 @@ def get_describe_stacks_paginator(client):
 
 
 def get_sqs_client():
-    return boto3.client('sqs')
+    return get_client('sqs')
+
+
+def get_s3_client():
+    return get_client('s3')
+
+
+def get_dynamodb_client():
+    return get_client('dynamodb')
+
+
+def get_inventory_table_name():
+    return os.environ['INVENTORY_TABLE_NAME']
+
+
+def get_deletion_list_bucket_or_none():
+    return os.environ.get('DELETION_LIST_BUCKET')
 
 
 def get_delete_branch_queue_url():
     return os.environ['DELETE_BRANCH_QUEUE_URL']
 
 
-def get_all_stacks(paginator):
-    return [
-        stack
-        for result in paginator.paginate()
-        for stack in result['Stacks']
-    ]
+def get_delete_branch_queue_max_messages():
+    return int(
+        os.environ.get(
+            'DELETE_BRANCH_QUEUE_MAX_MESSAGES',
+            DELETE_BRANCH_QUEUE_DEFAULT_MAX_MESSAGES
+        )
+    )
+
+
+def get_inventory_mode():
+    return os.environ.get(
+        'INVENTORY_MODE',
+        INVENTORY_MODE_DESCRIBE_STACKS
+    )
+
+
+def get_remaining_time_in_seconds(context):
+    if hasattr(context, 'get_remaining_time_in_millis'):
+        return context.get_remaining_time_in_millis() / 1000
+    return None
+
+
+def get_describe_stacks_pages(paginator):
+    return paginator.paginate()
+
+
+class StackRecord:
+    # Fields the deletion rules read, parsed once per stack with the
+    # tags indexed by key.
+
+    __slots__ = (
+        'name',
+        'status',
+        'creation_time',
+        'tags',
+        'exports',
+        'stack_id',
+    )
+
+    def __init__(self, name, status, creation_time, tags, exports=(), stack_id=None):
+        self.name = name
+        self.status = status
+        self.creation_time = creation_time
+        self.tags = tags
+        self.exports = exports
+        self.stack_id = stack_id
+
+
+def make_stack_record(stack):
+    return StackRecord(
+        name=stack['StackName'],
+        status=stack['StackStatus'],
+        creation_time=stack['CreationTime'],
+        tags={
+            tag['Key']: tag['Value']
+            for tag in stack.get('Tags', [])
+        },
+        exports=[
+            output['ExportName']
+            for output in stack.get('Outputs', [])
+            if 'ExportName' in output
+        ],
+        stack_id=stack['StackId'],
+    )
+
+
+class StackInventory:
+    # Snapshot of the account's stacks, fetched once per invocation
+    # and shared by every deletion rule.
+
+    def __init__(self):
+        self.stacks = []
+        self.pages = 0
+
+    def add_page(self, page):
+        self.pages += 1
+        self.stacks.extend(
+            make_stack_record(stack)
+            for stack in page['Stacks']
+        )
+
+
+def make_stack_inventory(pages):
+    inventory = StackInventory()
+    for page in pages:
+        inventory.add_page(page)
+    return inventory
+
+
+def get_inventory_cache_pages(client, table_name, since):
+    return client.get_paginator('query').paginate(
+        TableName=table_name,
+        IndexName=INVENTORY_CACHE_INDEX_NAME,
+        KeyConditionExpression='shard = :shard AND updated_at > :since',
+        ExpressionAttributeValues={
+            ':shard': {'S': INVENTORY_CACHE_SHARD},
+            ':since': {'N': str(since)},
+        },
+    )
 
 
-def get_messages_from_delete_branch_queue():
+def make_stack_record_from_cache_item(item):
+    return StackRecord(
+        name=item['stack_name']['S'],
+        status=item['status']['S'],
+        creation_time=datetime.fromisoformat(item['creation_time']['S']),
+        tags=json.loads(item['tags']['S']),
+        exports=json.loads(item['exports']['S']),
+        stack_id=item['stack_id']['S'],
+    )
+
+
+def get_stack_inventory_from_cache(client):
+    # A cold start reads the whole table, warm runs only the delta.
+    started_at = int(time.time() * 1000)
+    read_until = inventory_cache['read_until']
+    since = 0 if read_until is None else read_until - INVENTORY_CACHE_OVERLAP_MILLISECONDS
+    stacks_by_id = inventory_cache['stacks_by_id']
+    inventory = StackInventory()
+    changes = 0
+    for page in get_inventory_cache_pages(client, get_inventory_table_name(), since):
+        inventory.pages += 1
+        for item in page['Items']:
+            changes += 1
+            stack_id = item['stack_id']['S']
+            if item['status']['S'] == 'DELETE_COMPLETE':
+                stacks_by_id.pop(stack_id, None)
+            else:
+                stacks_by_id[stack_id] = make_stack_record_from_cache_item(item)
+    inventory_cache['read_until'] = started_at
+    inventory.stacks.extend(stacks_by_id.values())
+    logger.info(f'Read {changes} inventory changes since {since}')
+    return inventory
+
+
+def get_stack_inventory():
+    inventory_mode = get_inventory_mode()
+    if inventory_mode == INVENTORY_MODE_CACHE:
+        inventory = get_stack_inventory_from_cache(get_dynamodb_client())
+    else:
+        paginator = get_describe_stacks_paginator(
+            get_cloudformation_client()
+        )
+        inventory = make_stack_inventory(
+            get_describe_stacks_pages(paginator)
+        )
+    logger.info(
+        f'Got {len(inventory.stacks)} stacks from {inventory.pages} {inventory_mode} pages'
+    )
+    return inventory
+
+
+def get_messages_from_delete_branch_queue(context=None):
     messages = []
     logger.info('Getting messages from delete branch queue')
     client = get_sqs_client()
-    # Need multiple calls when # of messages < 1000.
+    queue_url = get_delete_branch_queue_url()
+    max_messages = get_delete_branch_queue_max_messages()
+    wait_time_seconds = DELETE_BRANCH_QUEUE_POLL_WAIT_SECONDS
+    receive_calls = 0
+    # Drain until a short poll comes back empty. Full batches mean there
+    # is a backlog, so the next call doesn't wait.
     # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/sqs/client/receive_message.html#SQS.Client.receive_message
-    for i in range(4):
-        messages.extend(
-            client.receive_message(
-                QueueUrl=get_delete_branch_queue_url(),
-                MaxNumberOfMessages=10,
-                WaitTimeSeconds=15,
-            ).get('Messages', [])
-        )
-    logger.info(f'Got {len(messages)} messages')
+    while len(messages) < max_messages:
+        remaining_seconds = get_remaining_time_in_seconds(context)
+        if (
+            remaining_seconds is not None
+            and remaining_seconds - wait_time_seconds < DELETE_BRANCH_QUEUE_RESERVED_SECONDS
+        ):
+            logger.warning(
+                f'Stopping queue drain with {remaining_seconds} seconds left'
+            )
+            break
+        batch = client.receive_message(
+            QueueUrl=queue_url,
+            MaxNumberOfMessages=min(
+                SQS_MAX_BATCH_SIZE,
+                max_messages - len(messages)
+            ),
+            WaitTimeSeconds=wait_time_seconds,
+        ).get('Messages', [])
+        receive_calls += 1
+        if not batch:
+            if wait_time_seconds > 0:
+                break
+            # Zero-wait receives sample a subset of SQS servers, so an
+            # empty one is confirmed with a short poll.
+            wait_time_seconds = DELETE_BRANCH_QUEUE_POLL_WAIT_SECONDS
+            continue
+        messages.extend(batch)
+        if len(batch) == SQS_MAX_BATCH_SIZE:
+            wait_time_seconds = 0
+        else:
+            wait_time_seconds = DELETE_BRANCH_QUEUE_POLL_WAIT_SECONDS
+    logger.info(
+        f'Got {len(messages)} messages in {receive_calls} receive_message calls'
+    )
     return messages
 
 
-def filter_stacks_by_statuses(stacks):
+def get_batches(items, batch_size):
     return [
-        stack
-        for stack in stacks
-        if stack['StackStatus'] in OKAY_STATUSES
+        items[i:i + batch_size]
+        for i in range(0, len(items), batch_size)
     ]
 
 
+def delete_message_batch_with_retries(client, queue_url, messages):
+    entries = {
+        str(i): message['ReceiptHandle']
+        for i, message in enumerate(messages)
+    }
+    # Sender faults (e.g. an expired receipt handle) fail the same way
+    # on every attempt, so they're kept aside instead of resent.
+    permanent_failures = []
+    failed = []
+    for attempt in range(DELETE_MESSAGE_BATCH_MAX_ATTEMPTS):
+        if attempt > 0:
+            time.sleep(
+                DELETE_MESSAGE_BATCH_BACKOFF_SECONDS * 2 ** (attempt - 1)
+            )
+        response = client.delete_message_batch(
+            QueueUrl=queue_url,
+            Entries=[
+                {
+                    'Id': entry_id,
+                    'ReceiptHandle': receipt_handle,
+                }
+                for entry_id, receipt_handle in entries.items()
+            ]
+        )
+        failed = response.get('Failed', [])
+        for failure in failed:
+            logger.warning(
+                f'Failed to delete message {failure["Id"]} (attempt {attempt + 1}): '
+                f'{failure.get("Code")} {failure.get("Message")}'
+            )
+        permanent_failures.extend(
+            failure
+            for failure in failed
+            if failure.get('SenderFault')
+        )
+        failed = [
+            failure
+            for failure in failed
+            if not failure.get('SenderFault')
+        ]
+        entries = {
+            failure['Id']: entries[failure['Id']]
+            for failure in failed
+        }
+        if not entries:
+            break
+    return permanent_failures + failed
+
+
+def delete_messages_from_delete_branch_queue(messages):
+    client = get_sqs_client()
+    queue_url = get_delete_branch_queue_url()
+    failed = []
+    for batch in get_batches(messages, SQS_MAX_BATCH_SIZE):
+        failed.extend(
+            delete_message_batch_with_retries(
+                client,
+                queue_url,
+                batch
+            )
+        )
+    logger.info(
+        f'Deleted {len(messages) - len(failed)} of {len(messages)} messages from delete branch queue'
+    )
+    if failed:
+        logger.error(f'Unable to delete messages: {failed}')
+    return failed
+
+
+def stack_has_okay_status(stack):
+    return stack.status in OKAY_STATUSES
+
+
 def get_tag_by_key(stack, key):
-    for tag in stack['Tags']:
-        if tag['Key'] == key:
-            return tag
-    return None
+    return stack.tags.get(key)
 
 
 def get_time_to_live_hours_tag_or_none(stack):
@@ -101,14 +435,6 @@ def stack_has_time_to_live_hours_tag(stack):
     return get_time_to_live_hours_tag_or_none(stack) is not None
 
 
-def filter_stacks_with_time_to_live_hours_tag(stacks):
-    return [
-        stack
-        for stack in stacks
-        if stack_has_time_to_live_hours_tag(stack)
-    ]
-
-
 def get_turn_off_on_friday_night_tag_or_none(stack):
     return get_tag_by_key(stack, TURN_OFF_ON_FRIDAY_NIGHT)
 
@@ -117,40 +443,30 @@ def stack_has_turn_off_on_friday_night_tag(stack):
     return get_turn_off_on_friday_night_tag_or_none(stack) is not None
 
 
-def filter_stacks_with_turn_off_on_friday_night_tag(stacks):
-    return [
-        stack
-        for stack in stacks
-        if stack_has_turn_off_on_friday_night_tag(stack)
-    ]
-
-
 def get_branch_tag_or_none(stack):
     return get_tag_by_key(stack, BRANCH)
 
 
-def stack_has_maching_branch_tag(stack, branch):
-    tag = get_branch_tag_or_none(stack)
-    if tag is not None:
-        return tag['Value'] == branch
-    return False
-
-
 def get_stack_name(stack):
-    return stack['StackName']
+    return stack.name
 
 
 def get_creation_time(stack):
-    return stack['CreationTime']
+    return stack.creation_time
 
 
 def try_parse_time_to_live_hours_tag(tag):
     try:
-        return int(tag['Value'])
+        return int(tag)
     except ValueError:
         logger.warning('Tag value not int')
 
 
+def parse_timestamp(timestamp):
+    # fromisoformat doesn't accept a Z suffix before Python 3.11.
+    return datetime.fromisoformat(timestamp.replace('Z', '+00:00'))
+
+
 def get_current_utc_time():
     return datetime.now(timezone.utc)
 
@@ -159,6 +475,12 @@ def get_current_pacific_time():
     return datetime.now(ZoneInfo('US/Pacific'))
 
 
+def get_pacific_time(now=None):
+    if now is None:
+        return get_current_pacific_time()
+    return now.astimezone(ZoneInfo('US/Pacific'))
+
+
 def is_saturday(now):
     return now.weekday() == SATURDAY_WEEKDAY_NUMBER
 
@@ -167,161 +489,563 @@ def is_before_seven_in_the_morning(now):
     return now.hour < 7
 
 
-def is_it_friday_night_in_LA():
-    now_pacific = get_current_pacific_time()
+def is_it_friday_night_in_LA(now=None):
+    now_pacific = get_pacific_time(now)
     return is_saturday(now_pacific) and is_before_seven_in_the_morning(now_pacific)
 
 
-def log_time_info(now, then, time_to_live_hours, hours_alive):
-    logger.info(f'creation time: {then}')
-    logger.info(f'now: {now}')
-    logger.info(f'hours to live: {time_to_live_hours}')
-    logger.info(f'hours alive: {hours_alive}')
-
-
-def time_to_live_hours_exceeded(creation_time, time_to_live_hours):
-    now = get_current_utc_time()
-    then = creation_time
-    delta = now - then
-    hours_alive = int(delta.total_seconds() // SECONDS_IN_AN_HOUR)
-    log_time_info(now, then, time_to_live_hours, hours_alive)
-    return hours_alive >= time_to_live_hours
+def time_to_live_hours_to_float(value):
+    try:
+        return float(value)
+    except OverflowError:
+        return float('inf') if value > 0 else float('-inf')
+
+
+def make_time_to_live_hours_columns(stacks):
+    # Creation time is only read for stacks with a usable tag. Any
+    # integer is a usable tag, so validity is kept in its own column.
+    # Hours are floats so tag values past 64-bit integers still compare,
+    # and values past the float range are treated as infinite.
+    creation_epochs = array('d')
+    time_to_live_hours = array('d')
+    valid = bytearray()
+    for stack in stacks:
+        tag = get_time_to_live_hours_tag_or_none(stack)
+        value = None if tag is None else try_parse_time_to_live_hours_tag(tag)
+        if value is None:
+            creation_epochs.append(0.0)
+            time_to_live_hours.append(0.0)
+            valid.append(False)
+        else:
+            creation_epochs.append(get_creation_time(stack).timestamp())
+            time_to_live_hours.append(time_to_live_hours_to_float(value))
+            valid.append(True)
+    return creation_epochs, time_to_live_hours, valid
+
+
+def time_to_live_hours_exceeded_batch(now_epoch, creation_epochs, time_to_live_hours, valid):
+    return [
+        bool(is_valid)
+        and (now_epoch - then) // SECONDS_IN_AN_HOUR >= ttl
+        for then, ttl, is_valid in zip(creation_epochs, time_to_live_hours, valid)
+    ]
 
 
-def stack_is_alive_longer_than_time_to_live_hours(stack):
+def log_time_to_live_hours_summary(now, checked, valid, exceeded):
     logger.info(
-        f'Checking if {get_stack_name(stack)} is alive longer than time to live hours'
-    )
-    creation_time = get_creation_time(
-        stack
+        f'Checked time to live hours of {checked} stacks at {now}: '
+        f'{valid} with valid tags, {exceeded} exceeded'
     )
-    time_to_live_hours_tag = get_time_to_live_hours_tag_or_none(
-        stack
+
+
+def stack_has_turn_off_on_friday_night_yes_tag(stack):
+    return get_turn_off_on_friday_night_tag_or_none(stack) == 'yes'
+
+
+def make_emf_record(metrics, dimensions, timestamp):
+    # metrics: name -> (value, unit). Values and dimensions are top-level
+    # members the _aws metadata points CloudWatch at.
+    # https://docs.aws.amazon.com/AmazonCloudWatch/latest/monitoring/CloudWatch_Embedded_Metric_Format_Specification.html
+    record = {
+        '_aws': {
+            'Timestamp': timestamp,
+            'CloudWatchMetrics': [
+                {
+                    'Namespace': METRICS_NAMESPACE,
+                    'Dimensions': [
+                        list(dimensions)
+                    ],
+                    'Metrics': [
+                        {
+                            'Name': name,
+                            'Unit': unit,
+                        }
+                        for name, (value, unit) in metrics.items()
+                    ],
+                }
+            ],
+        },
+    }
+    record.update(dimensions)
+    record.update(
+        {
+            name: value
+            for name, (value, unit) in metrics.items()
+        }
     )
-    time_to_live_hours = try_parse_time_to_live_hours_tag(
-        time_to_live_hours_tag
+    return record
+
+
+class RunMetrics:
+    # Collected over one invocation and flushed as EMF records, which
+    # CloudWatch Logs turns into metrics without any PutMetricData calls.
+
+    def __init__(self):
+        self.metrics = {}
+        self.phase_durations = {}
+        self.stacks_matched_by_rule = {}
+
+    def put(self, name, value, unit='Count'):
+        self.metrics[name] = (value, unit)
+
+    def put_phase_duration(self, phase, seconds):
+        self.phase_durations[phase] = seconds
+
+    def put_stacks_matched_by_rule(self, stacks_matched_by_rule):
+        self.stacks_matched_by_rule.update(stacks_matched_by_rule)
+
+    def get_emf_records(self, timestamp):
+        dimensions = {
+            'Service': METRICS_SERVICE,
+        }
+        records = [
+            make_emf_record(
+                self.metrics,
+                dimensions,
+                timestamp
+            )
+        ]
+        for phase, seconds in self.phase_durations.items():
+            records.append(
+                make_emf_record(
+                    {
+                        'PhaseDuration': (seconds * 1000, 'Milliseconds'),
+                    },
+                    {
+                        **dimensions,
+                        'Phase': phase,
+                    },
+                    timestamp
+                )
+            )
+        for rule_name, count in self.stacks_matched_by_rule.items():
+            records.append(
+                make_emf_record(
+                    {
+                        'StacksMatched': (count, 'Count'),
+                    },
+                    {
+                        **dimensions,
+                        'Rule': rule_name,
+                    },
+                    timestamp
+                )
+            )
+        return records
+
+    def emit(self):
+        # Printed rather than logged so each record is a bare JSON line.
+        for record in self.get_emf_records(int(time.time() * 1000)):
+            print(json.dumps(record), flush=True)
+
+
+def call_and_log_duration(function, *args, metrics=None):
+    start = time.perf_counter()
+    result = function(*args)
+    duration = time.perf_counter() - start
+    logger.info(
+        f'{function.__name__} took {duration:.3f} seconds'
     )
-    if time_to_live_hours is not None:
-        return time_to_live_hours_exceeded(
-            creation_time,
-            time_to_live_hours
+    if metrics is not None:
+        metrics.put_phase_duration(function.__name__, duration)
+    return result
+
+
+def get_stack_inventory_and_messages(context, metrics=None):
+    # Neither leg depends on the other, so a run takes as long as the
+    # slower one instead of both.
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        inventory = executor.submit(
+            call_and_log_duration,
+            get_stack_inventory,
+            metrics=metrics
         )
-    return False
+        messages = executor.submit(
+            call_and_log_duration,
+            get_messages_from_delete_branch_queue,
+            context,
+            metrics=metrics
+        )
+        return inventory.result(), messages.result()
 
 
-def filter_stacks_living_longer_than_time_to_live_hours(stacks):
-    return [
-        stack
-        for stack in stacks
-        if stack_is_alive_longer_than_time_to_live_hours(stack)
-    ]
+def get_branch_from_message(message):
+    return json.loads(message['Body'])['branch']
 
 
-def stack_has_turn_off_on_friday_night_yes_tag(stack):
-    tag = get_turn_off_on_friday_night_tag_or_none(stack)
-    if tag is not None:
-        return tag['Value'] == 'yes'
-    return False
+def group_messages_by_branch(messages):
+    # Duplicate messages for the same branch are collapsed so each
+    # branch is only looked up once.
+    messages_by_branch = {}
+    for message in messages:
+        branch = get_branch_from_message(message)
+        if branch not in ['dev', 'main']:
+            messages_by_branch.setdefault(branch, []).append(message)
+    logger.info(
+        f'Got delete queue messages for {len(messages_by_branch)} branches: {list(messages_by_branch)}'
+    )
+    return messages_by_branch
 
 
-def filter_stacks_by_turn_off_on_friday_night_is_yes(stacks):
-    return [
-        stack
-        for stack in stacks
-        if stack_has_turn_off_on_friday_night_yes_tag(stack)
-    ]
+class DeletionRule(abc.ABC):
+    # Predicate evaluated against every okay-status stack in a single
+    # pass by evaluate_deletion_rules.
 
+    name = None
 
-def handle_delete_queue_messages_and_filter_stacks_by_branch(messages, stacks):
-    sqs_client = get_sqs_client()
-    queue_url = get_delete_branch_queue_url()
-    stacks_to_delete = []
-    for message in messages:
-        branch = json.loads(message['Body'])['branch']
-        logger.info(f'Got delete queue message for branch {branch}')
-        if branch not in ['dev', 'main']:
-            matching_stacks = [
-                stack
-                for stack in stacks
-                if stack_has_maching_branch_tag(stack, branch)
-            ]
-            if not matching_stacks:
-                logger.info(f'delete message from queue for branch {branch}')
-                delete_response = sqs_client.delete_message(
-                    QueueUrl=queue_url,
-                    ReceiptHandle=message['ReceiptHandle']
-                )
-            else:
-                stacks_to_delete.extend(matching_stacks)
-    return stacks_to_delete
+    @abc.abstractmethod
+    def matches(self, stack):
+        pass
 
+    def matches_batch(self, stacks):
+        # Override to evaluate a chunk of stacks at once.
+        return [
+            self.matches(stack)
+            for stack in stacks
+        ]
 
-def get_stacks_to_delete_because_of_time_to_live_hours_tag():
-    client = get_cloudformation_client()
-    paginator = get_describe_stacks_paginator(client)
-    stacks = get_all_stacks(paginator)
-    stacks = filter_stacks_by_statuses(stacks)
-    stacks = filter_stacks_with_time_to_live_hours_tag(stacks)
-    stacks = filter_stacks_living_longer_than_time_to_live_hours(stacks)
-    return stacks
+    def log_summary(self):
+        # Called once after every chunk has been evaluated.
+        pass
 
 
-def get_stacks_to_delete_because_it_is_friday_night():
-    client = get_cloudformation_client()
-    paginator = get_describe_stacks_paginator(client)
-    stacks = get_all_stacks(paginator)
-    stacks = filter_stacks_by_statuses(stacks)
-    stacks = filter_stacks_with_turn_off_on_friday_night_tag(stacks)
-    stacks = filter_stacks_by_turn_off_on_friday_night_is_yes(stacks)
-    return stacks
+class TimeToLiveHoursRule(DeletionRule):
+
+    name = 'time-to-live-hours'
+
+    def __init__(self, now=None):
+        # Every stack in a run is compared against the same time.
+        self.now = get_current_utc_time() if now is None else now
+        self.checked = 0
+        self.valid = 0
+        self.exceeded = 0
 
+    def matches(self, stack):
+        return self.matches_batch([stack])[0]
 
-def maybe_get_stacks_to_delete_because_it_is_friday_night():
-    if is_it_friday_night_in_LA():
+    def matches_batch(self, stacks):
+        # Ages and thresholds are computed over flat columns.
+        creation_epochs, time_to_live_hours, valid = make_time_to_live_hours_columns(
+            stacks
+        )
+        matches = time_to_live_hours_exceeded_batch(
+            self.now.timestamp(),
+            creation_epochs,
+            time_to_live_hours,
+            valid
+        )
+        self.checked += len(matches)
+        self.valid += sum(valid)
+        self.exceeded += sum(matches)
+        return matches
+
+    def log_summary(self):
+        log_time_to_live_hours_summary(
+            self.now,
+            self.checked,
+            self.valid,
+            self.exceeded
+        )
+
+
+class FridayNightRule(DeletionRule):
+
+    name = 'friday-night'
+
+    def matches(self, stack):
+        return stack_has_turn_off_on_friday_night_yes_tag(stack)
+
+
+class BranchDeletedRule(DeletionRule):
+
+    name = 'branch-deleted'
+
+    def __init__(self, branches):
+        self.branches = branches
+        # Branch -> names of its stacks, filled in during the pass.
+        self.stacks_by_branch = {}
+
+    def matches(self, stack):
+        branch = get_branch_tag_or_none(stack)
+        if branch in self.branches:
+            self.stacks_by_branch.setdefault(
+                branch,
+                []
+            ).append(get_stack_name(stack))
+            return True
+        return False
+
+
+def get_deletion_rules(branches, now=None):
+    # Read once so every rule sees the same time.
+    if now is None:
+        now = get_current_utc_time()
+    rules = [
+        TimeToLiveHoursRule(now),
+    ]
+    if is_it_friday_night_in_LA(now):
         logger.info('It is Friday night, getting stacks to delete!')
-        return get_stacks_to_delete_because_it_is_friday_night()
-    else:
-        return []
+        rules.append(FridayNightRule())
+    if branches:
+        rules.append(BranchDeletedRule(branches))
+    # Extend with other rules here.
+    return rules
+
+
+def evaluate_deletion_rules(stacks, rules):
+    # Returns stack name -> names of the rules that matched it, in the
+    # order stacks were seen.
+    matched_rules_by_stack_name = {}
+    stacks = iter(stacks)
+    while True:
+        chunk = list(islice(stacks, EVALUATION_BATCH_SIZE))
+        if not chunk:
+            break
+        batch = [
+            stack
+            for stack in chunk
+            if stack_has_okay_status(stack)
+        ]
+        matches_by_rule = [
+            rule.matches_batch(batch)
+            for rule in rules
+        ]
+        for i, stack in enumerate(batch):
+            for rule, matches in zip(rules, matches_by_rule):
+                if matches[i]:
+                    matched_rules_by_stack_name.setdefault(
+                        get_stack_name(stack),
+                        []
+                    ).append(rule.name)
+    for rule in rules:
+        rule.log_summary()
+    return matched_rules_by_stack_name
+
+
+def count_stacks_matched_by_rule(matched_rules_by_stack_name, rules):
+    stacks_matched_by_rule = {
+        rule.name: 0
+        for rule in rules
+    }
+    for rule_names in matched_rules_by_stack_name.values():
+        for rule_name in rule_names:
+            stacks_matched_by_rule[rule_name] += 1
+    return stacks_matched_by_rule
+
+
+def get_stacks_by_branch(rules):
+    stacks_by_branch = {}
+    for rule in rules:
+        if isinstance(rule, BranchDeletedRule):
+            stacks_by_branch.update(rule.stacks_by_branch)
+    return stacks_by_branch
+
+
+def delete_messages_for_branches_without_stacks(messages_by_branch, stacks_by_branch):
+    messages_to_delete = []
+    for branch, messages in messages_by_branch.items():
+        if branch in stacks_by_branch:
+            logger.info(
+                f'Branch {branch} has stacks: {stacks_by_branch[branch]}'
+            )
+            continue
+        logger.info(f'delete message from queue for branch {branch}')
+        messages_to_delete.extend(messages)
+    if messages_to_delete:
+        return delete_messages_from_delete_branch_queue(
+            messages_to_delete
+        )
+    return []
 
 
-def get_stacks_to_delete_because_a_github_branch_was_deleted():
+def get_importing_stack_names(client, export_name):
+    try:
+        return [
+            stack_name
+            for page in client.get_paginator('list_imports').paginate(
+                ExportName=export_name
+            )
+            for stack_name in page['Imports']
+        ]
+    except ClientError as error:
+        # Raised for exports that no stack imports.
+        if error.response['Error']['Code'] == 'ValidationError':
+            return []
+        raise
+
+
+def get_importers_by_stack_name(stacks):
+    # Stack name -> names of the other stacks being deleted that import
+    # one of its exports.
     client = get_cloudformation_client()
-    paginator = get_describe_stacks_paginator(client)
-    stacks = get_all_stacks(paginator)
-    stacks = filter_stacks_by_statuses(stacks)
-    messages = get_messages_from_delete_branch_queue()
-    stacks = handle_delete_queue_messages_and_filter_stacks_by_branch(
-        messages,
-        stacks
-    )
-    return stacks
+    stack_names = {
+        get_stack_name(stack)
+        for stack in stacks
+    }
+    importers_by_stack_name = {}
+    for stack in stacks:
+        importers = set()
+        for export_name in stack.exports:
+            importers.update(
+                stack_name
+                for stack_name in get_importing_stack_names(client, export_name)
+                if stack_name in stack_names and stack_name != get_stack_name(stack)
+            )
+        importers_by_stack_name[get_stack_name(stack)] = importers
+    return importers_by_stack_name
+
+
+def get_deletion_levels(importers_by_stack_name):
+    # A stack can't be deleted while another stack imports its exports,
+    # so each stack goes one level after the last of its importers.
+    # Stacks within a level don't depend on each other.
+    levels = {}
+
+    def get_level(stack_name, visiting):
+        if stack_name in levels:
+            return levels[stack_name]
+        if stack_name in visiting:
+            return 0
+        visiting.add(stack_name)
+        level = max(
+            (
+                get_level(importer, visiting) + 1
+                for importer in importers_by_stack_name.get(stack_name, ())
+            ),
+            default=0
+        )
+        visiting.discard(stack_name)
+        levels[stack_name] = level
+        return level
+
+    for stack_name in importers_by_stack_name:
+        get_level(stack_name, set())
+    deletion_levels = [
+        []
+        for i in range(max(levels.values(), default=-1) + 1)
+    ]
+    for stack_name, level in levels.items():
+        deletion_levels[level].append(stack_name)
+    return deletion_levels
 
 
-def get_stack_names_from_stacks(stacks):
-    return [
-        get_stack_name(stack)
+def get_deletion_list_prefix(context):
+    request_id = getattr(context, 'aws_request_id', None) or str(uuid.uuid4())
+    return f'deletion-lists/{request_id}'
+
+
+def make_stacks_to_delete(deletion_levels, stacks):
+    # The state machine journals the StackId so it can tell a delete it
+    # started from one on a later stack with the same name.
+    stack_ids_by_name = {
+        get_stack_name(stack): stack.stack_id
         for stack in stacks
+    }
+    return [
+        [
+            {
+                'stack_to_delete': stack_name,
+                'stack_id': stack_ids_by_name[stack_name],
+            }
+            for stack_name in stack_names
+        ]
+        for stack_names in deletion_levels
     ]
 
 
+def make_deletion_list_body(stacks_to_delete):
+    return ''.join(
+        json.dumps(stack_to_delete) + '\n'
+        for stack_to_delete in stacks_to_delete
+    ).encode()
+
+
+def write_deletion_levels_to_bucket(bucket, prefix, deletion_levels):
+    # One JSONL object per level for the state machine's Distributed Map
+    # to read, keeping large sweeps out of the Lambda response payload.
+    client = get_s3_client()
+    keys = []
+    for i, stacks_to_delete in enumerate(deletion_levels):
+        key = f'{prefix}/level-{i}.jsonl'
+        client.put_object(
+            Bucket=bucket,
+            Key=key,
+            Body=make_deletion_list_body(stacks_to_delete),
+            ContentType='application/jsonl',
+        )
+        keys.append(key)
+    logger.info(f'Wrote deletion levels to s3://{bucket}/{prefix}')
+    return keys
+
+
 def get_stacks_to_delete(event, context):
-    list_of_lists_of_stacks_to_delete = [
-        get_stacks_to_delete_because_of_time_to_live_hours_tag(),
-        maybe_get_stacks_to_delete_because_it_is_friday_night(),
-        get_stacks_to_delete_because_a_github_branch_was_deleted(),
-        # Extend with other routines here.
-    ]
-    stacks_to_delete = [
-        stack
-        for stack_list in list_of_lists_of_stacks_to_delete
-        for stack in stack_list
-    ]
-    stack_names_to_delete = get_stack_names_from_stacks(
-        stacks_to_delete
+    metrics = RunMetrics()
+    # All rules evaluate the same snapshot instead of each paging
+    # through describe_stacks on its own.
+    inventory, messages = get_stack_inventory_and_messages(
+        context,
+        metrics=metrics
+    )
+    messages_by_branch = group_messages_by_branch(messages)
+    rules = get_deletion_rules(messages_by_branch)
+    matched_rules_by_stack_name = call_and_log_duration(
+        evaluate_deletion_rules,
+        inventory.stacks,
+        rules,
+        metrics=metrics
+    )
+    failed_message_deletes = call_and_log_duration(
+        delete_messages_for_branches_without_stacks,
+        messages_by_branch,
+        get_stacks_by_branch(rules),
+        metrics=metrics
+    )
+    logger.info(f'Stacks to delete: {matched_rules_by_stack_name}')
+    logger.info(
+        f'Used {inventory.pages} {get_inventory_mode()} pages for {len(inventory.stacks)} stacks'
     )
-    unique_stack_names_to_delete = set()
-    unique_stack_names_to_delete.update(
-        stack_names_to_delete
+    deletion_levels = call_and_log_duration(
+        get_deletion_levels,
+        call_and_log_duration(
+            get_importers_by_stack_name,
+            [
+                stack
+                for stack in inventory.stacks
+                if get_stack_name(stack) in matched_rules_by_stack_name
+            ],
+            metrics=metrics
+        ),
+        metrics=metrics
+    )
+    logger.info(f'Deletion levels: {deletion_levels}')
+    metrics.put('StacksScanned', len(inventory.stacks))
+    metrics.put('InventoryPages', inventory.pages)
+    metrics.put('MessagesDrained', len(messages))
+    metrics.put('BranchesDeleted', len(messages_by_branch))
+    metrics.put('MessageDeleteFailures', len(failed_message_deletes))
+    metrics.put('StacksToDelete', len(matched_rules_by_stack_name))
+    metrics.put('DeletionLevels', len(deletion_levels))
+    metrics.put_stacks_matched_by_rule(
+        count_stacks_matched_by_rule(
+            matched_rules_by_stack_name,
+            rules
+        )
     )
-    logger.info(f'Stacks to delete: {unique_stack_names_to_delete}')
-    return list(unique_stack_names_to_delete)
+    deletion_levels = make_stacks_to_delete(
+        deletion_levels,
+        inventory.stacks
+    )
+    bucket = get_deletion_list_bucket_or_none()
+    if bucket is not None:
+        deletion_levels = call_and_log_duration(
+            write_deletion_levels_to_bucket,
+            bucket,
+            get_deletion_list_prefix(context),
+            deletion_levels,
+            metrics=metrics
+        )
+    metrics.emit()
+    return {
+        'deletion_levels': deletion_levels,
+        'expires_at': int(time.time()) + STATE_MACHINE_ITEM_TTL_SECONDS,
+    }
@@ -0,0 +1,138 @@
+import json
+
+import os
+import time
+
+import boto3
+
+from datetime import datetime
+
+
+dynamodb_client = boto3.client('dynamodb')
+
+sfn_client = boto3.client('stepfunctions')
+
+TABLE_NAME = os.environ['TABLE_NAME']
+
+METRICS_NAMESPACE = 'DemoCleaner'
+
+
+def get_stack_name_from_stack_id(stack_id):
+    # arn:aws:cloudformation:region:account:stack/stack-name/uuid
+    return stack_id.split('/')[1]
+
+
+def get_callback_item_or_none(stack_name):
+    return dynamodb_client.get_item(
+        TableName=TABLE_NAME,
+        Key={
+            'stack_name': {
+                'S': stack_name
+            }
+        },
+        ConsistentRead=True,
+    ).get('Item')
+
+
+def parse_timestamp(timestamp):
+    # fromisoformat doesn't accept a Z suffix before Python 3.11.
+    return datetime.fromisoformat(timestamp.replace('Z', '+00:00'))
+
+
+def get_delete_latency_in_milliseconds_or_none(item, event):
+    # started_at is when the state machine started waiting on the stack.
+    if 'started_at' not in item or 'time' not in event:
+        return None
+    started_at = parse_timestamp(item['started_at']['S'])
+    finished_at = parse_timestamp(event['time'])
+    return (finished_at - started_at).total_seconds() * 1000
+
+
+def make_delete_latency_emf_record(latency, status, timestamp):
+    # https://docs.aws.amazon.com/AmazonCloudWatch/latest/monitoring/CloudWatch_Embedded_Metric_Format_Specification.html
+    return {
+        '_aws': {
+            'Timestamp': timestamp,
+            'CloudWatchMetrics': [
+                {
+                    'Namespace': METRICS_NAMESPACE,
+                    'Dimensions': [
+                        ['Service', 'Status']
+                    ],
+                    'Metrics': [
+                        {
+                            'Name': 'StackDeleteLatency',
+                            'Unit': 'Milliseconds',
+                        }
+                    ],
+                }
+            ],
+        },
+        'Service': 'DeleteStackCallback',
+        'Status': status,
+        'StackDeleteLatency': latency,
+    }
+
+
+def delete_task_token(stack_name):
+    dynamodb_client.delete_item(
+        TableName=TABLE_NAME,
+        Key={
+            'stack_name': {
+                'S': stack_name
+            }
+        },
+    )
+
+
+def send_task_result(task_token, stack_name, status, status_reason):
+    if status == 'DELETE_COMPLETE':
+        sfn_client.send_task_success(
+            taskToken=task_token,
+            output=json.dumps(
+                {
+                    'stack_to_delete': stack_name,
+                    'status': status,
+                }
+            )
+        )
+    else:
+        sfn_client.send_task_failure(
+            taskToken=task_token,
+            error='StackDeleteFailed',
+            cause=status_reason or status,
+        )
+
+
+def handler(event, context):
+    detail = event['detail']
+    stack_name = get_stack_name_from_stack_id(detail['stack-id'])
+    status = detail['status-details']['status']
+    status_reason = detail['status-details'].get('status-reason')
+    print('Got stack status change', stack_name, status)
+    item = get_callback_item_or_none(stack_name)
+    if item is None:
+        print('No cleaner execution waiting on stack, skipping.')
+        return
+    task_token = item['task_token']['S']
+    latency = get_delete_latency_in_milliseconds_or_none(item, event)
+    if latency is not None:
+        print(
+            json.dumps(
+                make_delete_latency_emf_record(
+                    latency,
+                    status,
+                    int(time.time() * 1000)
+                )
+            )
+        )
+    try:
+        send_task_result(task_token, stack_name, status, status_reason)
+    except (
+        sfn_client.exceptions.TaskTimedOut,
+        sfn_client.exceptions.TaskDoesNotExist,
+        sfn_client.exceptions.InvalidToken,
+    ) as error:
+        # Execution already moved on to polling or was stopped.
+        print('Unable to send task result', error)
+    delete_task_token(stack_name)
@@ -0,0 +1,93 @@
+from datetime import datetime
+
+
+# Longest failure list posted before it is summarized.
+MAX_LISTED_FAILURES = 20
+
+# Left to an overlapping execution that still owns the delete.
+SKIPPED = 'DELETE_SKIPPED'
+
+
+def parse_timestamp(timestamp):
+    # fromisoformat doesn't accept a Z suffix before Python 3.11.
+    return datetime.fromisoformat(timestamp.replace('Z', '+00:00'))
+
+
+def get_results(event):
+    # One list of stack results per deletion level.
+    return [
+        result
+        for level in event['results']
+        for result in level
+    ]
+
+
+def get_duration_in_seconds(result):
+    return (
+        parse_timestamp(result['finished_at']) - parse_timestamp(result['started_at'])
+    ).total_seconds()
+
+
+def format_duration(seconds):
+    minutes, seconds = divmod(int(seconds), 60)
+    return f'{minutes}m{seconds:02d}s'
+
+
+def make_digest_text(results):
+    succeeded = [
+        result
+        for result in results
+        if result['status'] == 'DELETE_SUCCEEDED'
+    ]
+    skipped = [
+        result
+        for result in results
+        if result['status'] == SKIPPED
+    ]
+    failed = [
+        result
+        for result in results
+        if result['status'] not in ('DELETE_SUCCEEDED', SKIPPED)
+    ]
+    icon = ':x:' if failed else ':white_check_mark:'
+    summary = f'{len(succeeded)} deleted, {len(failed)} failed'
+    if skipped:
+        summary += f', {len(skipped)} left to another run'
+    lines = [
+        f'{icon} *StackDeleteDigest* | {summary}'
+    ]
+    if succeeded:
+        durations = sorted(
+            get_duration_in_seconds(result)
+            for result in succeeded
+        )
+        lines.append(
+            f'Deleted in {format_duration(durations[0])} to {format_duration(durations[-1])}, '
+            f'median {format_duration(durations[len(durations) // 2])}'
+        )
+    for result in failed[:MAX_LISTED_FAILURES]:
+        lines.append(
+            f':x: {result["stack"]} after {result["attempts"]} attempts'
+        )
+    if len(failed) > MAX_LISTED_FAILURES:
+        lines.append(f'...and {len(failed) - MAX_LISTED_FAILURES} more')
+    return '\n'.join(lines)
+
+
+def handler(event, context):
+    results = get_results(event)
+    print('Making digest for', len(results), 'stacks')
+    return {
+        'detailType': 'StackDeleteDigest',
+        'source': 'cdk-igvf-dev.cleaner.DemoCleaner',
+        'detail': {
+            'metadata': {
+                'includes_slack_notification': True
+            },
+            'data': {
+                'slack': {
+                    'text': make_digest_text(results)
+                }
+            }
+        }
+    }
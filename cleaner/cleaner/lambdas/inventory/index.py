@@ -0,0 +1,164 @@
+import json
+
+import os
+import time
+
+import boto3
+
+from datetime import datetime
+
+
+cloudformation_client = boto3.client('cloudformation')
+
+dynamodb_client = boto3.client('dynamodb')
+
+TABLE_NAME = os.environ['TABLE_NAME']
+
+# Every item shares one partition in the ByUpdatedAt index so the
+# cleaner can query everything written since its last run.
+SHARD = 'stacks'
+
+# Deleted stacks stay as tombstones long enough for every cleaner
+# reading deltas to see them.
+TOMBSTONE_TTL_SECONDS = 7 * 24 * 60 * 60
+
+
+def get_stack_name_from_stack_id(stack_id):
+    # arn:aws:cloudformation:region:account:stack/stack-name/uuid
+    return stack_id.split('/')[1]
+
+
+def parse_timestamp(timestamp):
+    # fromisoformat doesn't accept a Z suffix before Python 3.11.
+    return datetime.fromisoformat(timestamp.replace('Z', '+00:00'))
+
+
+def get_epoch_milliseconds(timestamp=None):
+    if timestamp is None:
+        return int(time.time() * 1000)
+    return int(parse_timestamp(timestamp).timestamp() * 1000)
+
+
+def make_stack_item(stack, event_time):
+    return {
+        'stack_id': {'S': stack['StackId']},
+        'stack_name': {'S': stack['StackName']},
+        'status': {'S': stack['StackStatus']},
+        'creation_time': {'S': stack['CreationTime'].isoformat()},
+        'tags': {
+            'S': json.dumps(
+                {
+                    tag['Key']: tag['Value']
+                    for tag in stack.get('Tags', [])
+                }
+            )
+        },
+        'exports': {
+            'S': json.dumps(
+                [
+                    output['ExportName']
+                    for output in stack.get('Outputs', [])
+                    if 'ExportName' in output
+                ]
+            )
+        },
+        'shard': {'S': SHARD},
+        'updated_at': {'N': str(get_epoch_milliseconds())},
+        'event_time': {'N': str(event_time)},
+    }
+
+
+def make_tombstone_item(stack_id, event_time):
+    return {
+        'stack_id': {'S': stack_id},
+        'stack_name': {'S': get_stack_name_from_stack_id(stack_id)},
+        'status': {'S': 'DELETE_COMPLETE'},
+        'shard': {'S': SHARD},
+        'updated_at': {'N': str(get_epoch_milliseconds())},
+        'event_time': {'N': str(event_time)},
+        'expires_at': {'N': str(int(time.time()) + TOMBSTONE_TTL_SECONDS)},
+    }
+
+
+def put_item_if_newer(item):
+    # Events can arrive out of order, so older ones don't overwrite
+    # what a newer event already wrote.
+    try:
+        dynamodb_client.put_item(
+            TableName=TABLE_NAME,
+            Item=item,
+            ConditionExpression='attribute_not_exists(stack_id) OR event_time <= :event_time',
+            ExpressionAttributeValues={
+                ':event_time': item['event_time'],
+            },
+        )
+    except dynamodb_client.exceptions.ConditionalCheckFailedException:
+        print('Skipping stale event for', item['stack_name']['S'])
+
+
+def describe_stack_or_none(stack_id):
+    try:
+        return cloudformation_client.describe_stacks(
+            StackName=stack_id
+        )['Stacks'][0]
+    except cloudformation_client.exceptions.ClientError as error:
+        if error.response['Error']['Code'] == 'ValidationError':
+            return None
+        raise
+
+
+def handle_stack_status_change(event):
+    detail = event['detail']
+    stack_id = detail['stack-id']
+    status = detail['status-details']['status']
+    event_time = get_epoch_milliseconds(event['time'])
+    print('Got stack status change', stack_id, status)
+    if status == 'DELETE_COMPLETE':
+        put_item_if_newer(make_tombstone_item(stack_id, event_time))
+        return
+    # Status change events don't carry tags or outputs.
+    stack = describe_stack_or_none(stack_id)
+    if stack is None:
+        put_item_if_newer(make_tombstone_item(stack_id, event_time))
+        return
+    put_item_if_newer(make_stack_item(stack, event_time))
+
+
+def get_cached_stack_ids():
+    stack_ids = set()
+    pages = dynamodb_client.get_paginator('scan').paginate(
+        TableName=TABLE_NAME,
+        ProjectionExpression='stack_id, #status',
+        ExpressionAttributeNames={
+            '#status': 'status',
+        },
+    )
+    for page in pages:
+        for item in page['Items']:
+            if item['status']['S'] != 'DELETE_COMPLETE':
+                stack_ids.add(item['stack_id']['S'])
+    return stack_ids
+
+
+def reconcile():
+    # Backfills the table and catches up on any missed events.
+    event_time = get_epoch_milliseconds()
+    cached_stack_ids = get_cached_stack_ids()
+    stack_ids = set()
+    for page in cloudformation_client.get_paginator('describe_stacks').paginate():
+        for stack in page['Stacks']:
+            stack_ids.add(stack['StackId'])
+            put_item_if_newer(make_stack_item(stack, event_time))
+    for stack_id in cached_stack_ids - stack_ids:
+        put_item_if_newer(make_tombstone_item(stack_id, event_time))
+    print(
+        f'Reconciled {len(stack_ids)} stacks, '
+        f'removed {len(cached_stack_ids - stack_ids)}'
+    )
+
+
+def handler(event, context):
+    if event.get('detail-type') == 'Scheduled Event':
+        reconcile()
+        return
+    handle_stack_status_change(event)
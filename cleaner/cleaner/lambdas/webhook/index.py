@@ -1,3 +1,5 @@
+import base64
+
 import hmac
 
 import hashlib
@@ -6,6 +8,8 @@ import json
 
 import os
 
+import time
+
 import boto3
 
 
@@ -15,16 +19,55 @@ sqs_client = boto3.client('sqs')
 
 QUEUE_URL = os.environ['QUEUE_URL']
 
+SECRET_CACHE_TTL_SECONDS = int(
+    os.environ.get('SECRET_CACHE_TTL_SECONDS', '300')
+)
+
+# Invalid signatures can come from anyone who can reach the function
+# URL, so they only trigger a refresh once the cached secret is this old.
+SECRET_MIN_REFRESH_SECONDS = int(
+    os.environ.get('SECRET_MIN_REFRESH_SECONDS', '60')
+)
 
-def get_github_secret():
+# Kept across warm invocations so a burst of webhooks doesn't make one
+# Secrets Manager call each.
+secret_cache = {
+    'secret': None,
+    'fetched_at': 0.0,
+    'expires_at': 0.0,
+}
+
+
+def fetch_github_secret():
     secret_arn = os.environ['SECRET_ARN']
     return json.loads(sm_client.get_secret_value(SecretId=secret_arn)['SecretString'])['SECRET']
 
 
+def get_github_secret(force_refresh=False):
+    now = time.monotonic()
+    if force_refresh or secret_cache['secret'] is None or now >= secret_cache['expires_at']:
+        secret_cache['secret'] = fetch_github_secret()
+        secret_cache['fetched_at'] = now
+        secret_cache['expires_at'] = now + SECRET_CACHE_TTL_SECONDS
+    return secret_cache['secret']
+
+
+def can_refresh_github_secret():
+    return time.monotonic() - secret_cache['fetched_at'] >= SECRET_MIN_REFRESH_SECONDS
+
+
+def get_payload_body(event):
+    # Function URLs base64 encode non-text bodies. Signatures are
+    # computed over the raw bytes, which json.loads also accepts.
+    if event.get('isBase64Encoded'):
+        return base64.b64decode(event['body'])
+    return event['body'].encode()
+
+
 def verify_hmac(secret, body, signature):
     hmac_gen = hmac.new(
         secret.encode(),
-        body.encode(),
+        body,
         hashlib.sha256
     ).hexdigest()
 
@@ -33,8 +76,28 @@ def verify_hmac(secret, body, signature):
     return hmac.compare_digest(expected_signature, signature)
 
 
+def verify_hmac_with_cached_secret(body, signature):
+    if verify_hmac(get_github_secret(), body, signature):
+        return True
+    if not can_refresh_github_secret():
+        print('Invalid signature with recently fetched secret.')
+        return False
+    # Secret may have been rotated since it was cached.
+    print('Invalid signature with cached secret, refreshing.')
+    return verify_hmac(get_github_secret(force_refresh=True), body, signature)
+
+
 def handler(event, context):
-    github_secret = get_github_secret()
+    github_event = event['headers'].get('x-github-event', '')
+
+    # Push and pull_request payloads can be large, so anything that isn't
+    # a delete is ignored before the body is touched.
+    if github_event != 'delete':
+        print('Not delete, skipping.')
+        return {
+            'statusCode': 202,
+            'body': f'Ignored {github_event} event'
+        }
 
     github_signature = event['headers'].get('x-hub-signature-256')
 
@@ -45,21 +108,18 @@ def handler(event, context):
             'body': 'Unauthorized - Missing GitHub Signature'
         }
 
-    payload_body = event['body']
+    payload_body = get_payload_body(event)
 
-    payload_body_json = json.loads(event['body'])
-
-    github_event = event['headers'].get('x-github-event', '')
+    payload_body_json = json.loads(payload_body)
 
-    if github_event != 'delete' or payload_body_json.get('ref_type') != 'branch':
-        print('Not delete or not branch, skipping.')
+    if payload_body_json.get('ref_type') != 'branch':
+        print('Not branch, skipping.')
         return {
             'statusCode': 202,
             'body': f'Ignored {github_event} event'
         }
 
-    signature_valid = verify_hmac(
-        github_secret,
+    signature_valid = verify_hmac_with_cached_secret(
         payload_body,
         github_signature
     )
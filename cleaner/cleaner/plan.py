@@ -0,0 +1,230 @@
+import argparse
+import json
+import logging
+import sys
+import time
+
+from cleaner.lambdas.cloudformation.stacks import evaluate_deletion_rules
+from cleaner.lambdas.cloudformation.stacks import get_deletion_rules
+from cleaner.lambdas.cloudformation.stacks import get_stacks_by_branch
+from cleaner.lambdas.cloudformation.stacks import group_messages_by_branch
+from cleaner.lambdas.cloudformation.stacks import make_stack_record
+from cleaner.lambdas.cloudformation.stacks import parse_timestamp
+
+
+# Offline dry run of GetStacksToDelete. Replays a saved describe_stacks
+# dump and queued branch messages against the deletion rules with a
+# fixed clock, without calling AWS:
+#
+#   aws cloudformation describe-stacks > stacks.json
+#   python -m cleaner.plan stacks.json --branch IGVF-1-abc --now 2022-09-04T21:44:28Z
+
+READ_CHUNK_SIZE = 1 << 16
+
+
+def parse_now(timestamp):
+    # Without an offset, timestamp() and astimezone() would read it as
+    # the local time of whoever runs the plan.
+    now = parse_timestamp(timestamp)
+    if now.tzinfo is None:
+        raise argparse.ArgumentTypeError(
+            f'--now needs a UTC offset or Z suffix: {timestamp}'
+        )
+    return now
+
+
+def iter_json_array_items(file, chunk_size=READ_CHUNK_SIZE):
+    # Yields the items of the first JSON array in the file one at a time,
+    # so dumps with tens of thousands of stacks aren't loaded at once.
+    # Works for `aws cloudformation describe-stacks` output ({"Stacks": [...]})
+    # as well as a bare list.
+    decoder = json.JSONDecoder()
+    buffer = ''
+    position = 0
+    eof = False
+
+    def read_more():
+        nonlocal buffer, position, eof
+        chunk = file.read(chunk_size)
+        if not chunk:
+            eof = True
+        buffer = buffer[position:] + chunk
+        position = 0
+
+    while '[' not in buffer:
+        if eof:
+            return
+        read_more()
+    position = buffer.index('[') + 1
+    while True:
+        while position < len(buffer) and buffer[position] in ' \t\r\n,':
+            position += 1
+        if position == len(buffer):
+            if eof:
+                raise ValueError('Unterminated JSON array')
+            read_more()
+            continue
+        if buffer[position] == ']':
+            return
+        try:
+            item, position = decoder.raw_decode(buffer, position)
+        except json.JSONDecodeError:
+            # Item is split across chunks.
+            if eof:
+                raise
+            read_more()
+            continue
+        yield item
+
+
+def make_stack_record_from_dump(stack):
+    return make_stack_record(
+        {
+            **stack,
+            'CreationTime': parse_timestamp(stack['CreationTime']),
+        }
+    )
+
+
+def iter_stack_records(file):
+    for stack in iter_json_array_items(file):
+        yield make_stack_record_from_dump(stack)
+
+
+def make_branch_message(branch):
+    return {
+        'Body': json.dumps(
+            {
+                'event': 'BRANCH_DELETED',
+                'branch': branch,
+            }
+        )
+    }
+
+
+def load_messages(path):
+    # Accepts `aws sqs receive-message` output or a list of messages.
+    with open(path) as file:
+        messages = json.load(file)
+    if isinstance(messages, dict):
+        return messages.get('Messages', [])
+    return messages
+
+
+class CountingIterator:
+
+    def __init__(self, items):
+        self.items = iter(items)
+        self.count = 0
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        item = next(self.items)
+        self.count += 1
+        return item
+
+
+def make_plan(stack_records, messages, now):
+    messages_by_branch = group_messages_by_branch(messages)
+    rules = get_deletion_rules(messages_by_branch, now)
+    stacks = CountingIterator(stack_records)
+    start = time.perf_counter()
+    matched_rules_by_stack_name = evaluate_deletion_rules(stacks, rules)
+    duration = time.perf_counter() - start
+    stacks_by_branch = get_stacks_by_branch(rules)
+    return {
+        'now': now.isoformat(),
+        'stacks_scanned': stacks.count,
+        'evaluation_seconds': duration,
+        'rules': [
+            rule.name
+            for rule in rules
+        ],
+        'stacks_to_delete': matched_rules_by_stack_name,
+        'branches_without_stacks': [
+            branch
+            for branch in messages_by_branch
+            if branch not in stacks_by_branch
+        ],
+    }
+
+
+def print_plan(plan, file):
+    print(
+        f'Plan at {plan["now"]} with rules {", ".join(plan["rules"])}',
+        file=file
+    )
+    for stack_name, rule_names in plan['stacks_to_delete'].items():
+        print(f'delete {stack_name} ({", ".join(rule_names)})', file=file)
+    for branch in plan['branches_without_stacks']:
+        print(f'acknowledge message for branch {branch} (no stacks)', file=file)
+    print(
+        f'{len(plan["stacks_to_delete"])} of {plan["stacks_scanned"]} stacks '
+        f'would be deleted, evaluated in {plan["evaluation_seconds"]:.3f} seconds',
+        file=file
+    )
+
+
+def get_args(argv):
+    parser = argparse.ArgumentParser(
+        prog='python -m cleaner.plan',
+        description='Show which demo stacks the cleaner would delete, without calling AWS.'
+    )
+    parser.add_argument(
+        'stacks',
+        help='describe_stacks JSON dump, or - for stdin'
+    )
+    parser.add_argument(
+        '--messages',
+        help='Delete branch queue messages as receive_message JSON'
+    )
+    parser.add_argument(
+        '--branch',
+        action='append',
+        default=[],
+        help='Deleted branch to plan for, can be repeated'
+    )
+    parser.add_argument(
+        '--now',
+        type=parse_now,
+        required=True,
+        help='Fixed ISO 8601 timestamp with offset to evaluate rules at'
+    )
+    parser.add_argument(
+        '--json',
+        action='store_true',
+        help='Print the plan as JSON'
+    )
+    parser.add_argument(
+        '--verbose',
+        action='store_true',
+        help='Show per-stack rule logs'
+    )
+    return parser.parse_args(argv)
+
+
+def main(argv=None, stdout=sys.stdout):
+    args = get_args(argv)
+    if not args.verbose:
+        logging.getLogger('cleaner.lambdas.cloudformation.stacks').setLevel(logging.WARNING)
+    messages = load_messages(args.messages) if args.messages else []
+    messages.extend(
+        make_branch_message(branch)
+        for branch in args.branch
+    )
+    if args.stacks == '-':
+        plan = make_plan(iter_stack_records(sys.stdin), messages, args.now)
+    else:
+        with open(args.stacks) as file:
+            plan = make_plan(iter_stack_records(file), messages, args.now)
+    if args.json:
+        print(json.dumps(plan, indent=4), file=stdout)
+    else:
+        print_plan(plan, stdout)
+    return plan
+
+
+if __name__ == '__main__':
+    main()
@@ -1,3 +1,4 @@
+from aws_cdk import ArnFormat
 from aws_cdk import Stack
 from aws_cdk import Duration
 from aws_cdk import CfnOutput
@@ -10,18 +11,33 @@ from aws_cdk.aws_lambda_python_alpha import PythonFunction
 from aws_cdk.aws_lambda import Runtime
 from aws_cdk.aws_lambda import FunctionUrlAuthType
 
+from aws_cdk.aws_dynamodb import Attribute
+from aws_cdk.aws_dynamodb import AttributeType
+from aws_cdk.aws_dynamodb import BillingMode
+from aws_cdk.aws_dynamodb import Table
+
+from aws_cdk.aws_events import EventPattern
 from aws_cdk.aws_events import Rule
 from aws_cdk.aws_events import Schedule
 
+from aws_cdk.aws_events_targets import LambdaFunction
 from aws_cdk.aws_events_targets import SfnStateMachine
 
+from aws_cdk.aws_s3 import BlockPublicAccess
+from aws_cdk.aws_s3 import Bucket
+from aws_cdk.aws_s3 import BucketEncryption
+from aws_cdk.aws_s3 import LifecycleRule
+
 from aws_cdk.aws_stepfunctions import Condition
 from aws_cdk.aws_stepfunctions import Choice
+from aws_cdk.aws_stepfunctions import CustomState
+from aws_cdk.aws_stepfunctions import IntegrationPattern
 from aws_cdk.aws_stepfunctions import JsonPath
 from aws_cdk.aws_stepfunctions import Map
 from aws_cdk.aws_stepfunctions import Pass
 from aws_cdk.aws_stepfunctions import Result
 from aws_cdk.aws_stepfunctions import Succeed
+from aws_cdk.aws_stepfunctions import StateGraph
 from aws_cdk.aws_stepfunctions import StateMachine
 from aws_cdk.aws_stepfunctions import TaskInput
 from aws_cdk.aws_stepfunctions import Wait
@@ -37,11 +53,150 @@ from aws_cdk.aws_secretsmanager import Secret
 from aws_cdk.aws_sqs import DeadLetterQueue
 from aws_cdk.aws_sqs import Queue
 
+from dataclasses import dataclass
+
+from typing import Optional
+
+
+# Shared by every execution and Map iteration, so it holds across the
+# account rather than per run.
+DEFAULT_CLOUDFORMATION_CALLS_PER_SECOND = 5
+
+# Iterations that lose the race for a window retry after a random wait
+# of up to this many seconds, so they don't all collide again in the
+# next window.
+CLOUDFORMATION_TOKEN_MAX_WAIT_SECONDS = 5
+
+# Polling after a missed delete event starts here and doubles up to the
+# maximum while the stack is still deleting.
+DELETE_POLL_INITIAL_SECONDS = 30
+DELETE_POLL_MAX_SECONDS = 300
+
+# Waits between a failed delete and the next DeleteStack, doubling up to
+# the maximum. DELETE_FAILED often clears with time, e.g. once Lambda
+# ENIs are released.
+DELETE_RETRY_INITIAL_SECONDS = 600
+DELETE_RETRY_MAX_SECONDS = 1800
+
+
+def make_acquire_cloudformation_token(scope, construct_id, table, calls_per_second):
+    # Fixed one-second windows keyed by the time the state was entered.
+    # A full window waits and re-enters the state for a new timestamp;
+    # Retry would reuse the same EnteredTime. Unlike a semaphore there is
+    # nothing to release, so stopped executions can't leak tokens.
+    acquire_token = CallAwsService(
+        scope,
+        construct_id,
+        service='dynamodb',
+        action='updateItem',
+        iam_resources=[
+            table.table_arn
+        ],
+        parameters={
+            'TableName': table.table_name,
+            'Key': {
+                'window': {
+                    'S.$': "States.ArrayGetItem(States.StringSplit($$.State.EnteredTime, '.'), 0)"
+                }
+            },
+            'UpdateExpression': 'ADD tokens :one SET expires_at = :expires_at',
+            'ConditionExpression': 'attribute_not_exists(tokens) OR tokens < :limit',
+            'ExpressionAttributeValues': {
+                ':one': {
+                    'N': '1'
+                },
+                ':limit': {
+                    'N': str(calls_per_second)
+                },
+                ':expires_at': {
+                    'N.$': "States.Format('{}', $.iterator.expires_at)"
+                },
+            },
+        },
+        result_path=JsonPath.DISCARD,
+    )
+    choose_wait = Pass(
+        scope,
+        construct_id.replace('Acquire', 'ChooseWaitFor'),
+        parameters={
+            'seconds.$': f'States.MathRandom(1, {CLOUDFORMATION_TOKEN_MAX_WAIT_SECONDS + 1})',
+        },
+        result_path='$.token_wait',
+    )
+    wait_for_token = Wait(
+        scope,
+        construct_id.replace('Acquire', 'WaitFor'),
+        time=WaitTime.seconds_path('$.token_wait.seconds')
+    )
+    acquire_token.add_catch(
+        choose_wait,
+        errors=[
+            'DynamoDb.ConditionalCheckFailedException'
+        ],
+        result_path=JsonPath.DISCARD,
+    )
+    choose_wait.next(
+        wait_for_token
+    ).next(
+        acquire_token
+    )
+    return acquire_token
+
+
+def make_record_deletion_status(scope, construct_id, table, status):
+    # Keeps the journal row's last_status at what the cleaner last saw.
+    return CallAwsService(
+        scope,
+        construct_id,
+        service='dynamodb',
+        action='updateItem',
+        iam_resources=[
+            table.table_arn
+        ],
+        parameters={
+            'TableName': table.table_name,
+            'Key': {
+                'stack_name': {
+                    'S.$': '$.stack_to_delete'
+                }
+            },
+            'UpdateExpression': 'SET last_status = :last_status, updated_at = :updated_at',
+            'ExpressionAttributeValues': {
+                ':last_status': status,
+                ':updated_at': {
+                    'S.$': '$$.State.EnteredTime'
+                },
+            },
+        },
+        result_path=JsonPath.DISCARD,
+    )
+
+
+@dataclass(frozen=True)
+class DistributedMapProps:
+    max_concurrency: int = 50
+    tolerated_failure_percentage: int = 10
+    batch_size: int = 1
+
 
 class DemoCleaner(Stack):
-    def __init__(self, scope: Construct, construct_id: str, **kwargs) -> None:
+    def __init__(
+            self,
+            scope: Construct,
+            construct_id: str,
+            distributed_map: Optional[DistributedMapProps] = None,
+            inventory_cache: bool = False,
+            cloudformation_calls_per_second: int = DEFAULT_CLOUDFORMATION_CALLS_PER_SECOND,
+            slack_digest: bool = False,
+            **kwargs
+    ) -> None:
         super().__init__(scope, construct_id, **kwargs)
 
+        if slack_digest and distributed_map is not None:
+            raise ValueError(
+                'slack_digest needs the inline Map results and is not supported with distributed_map'
+            )
+
         delete_branch_webhook_secret = Secret.from_secret_complete_arn(
             self,
             'DeleteBranchWebhookSecret',
@@ -170,20 +325,200 @@ class DemoCleaner(Stack):
 
         get_stacks_to_delete_lambda.role.add_to_policy(
             PolicyStatement(
-                actions=['cloudformation:DescribeStacks'],
+                actions=[
+                    'cloudformation:DescribeStacks',
+                    'cloudformation:ListImports',
+                ],
                 resources=['*'],
             )
         )
 
+        if inventory_cache:
+            # Stack inventory kept current from CloudFormation events, so
+            # runs read what changed instead of describing every stack.
+            stack_inventory_table = Table(
+                self,
+                'StackInventoryTable',
+                partition_key=Attribute(
+                    name='stack_id',
+                    type=AttributeType.STRING,
+                ),
+                billing_mode=BillingMode.PAY_PER_REQUEST,
+                time_to_live_attribute='expires_at',
+            )
+
+            stack_inventory_table.add_global_secondary_index(
+                index_name='ByUpdatedAt',
+                partition_key=Attribute(
+                    name='shard',
+                    type=AttributeType.STRING,
+                ),
+                sort_key=Attribute(
+                    name='updated_at',
+                    type=AttributeType.NUMBER,
+                ),
+            )
+
+            stack_inventory_lambda = PythonFunction(
+                self,
+                'StackInventoryLambda',
+                runtime=Runtime.PYTHON_3_9,
+                entry='cleaner/lambdas/inventory',
+                timeout=Duration.seconds(300),
+                environment={
+                    'TABLE_NAME': stack_inventory_table.table_name,
+                }
+            )
+
+            stack_inventory_table.grant_read_write_data(
+                stack_inventory_lambda
+            )
+
+            stack_inventory_lambda.role.add_to_policy(
+                PolicyStatement(
+                    actions=[
+                        'cloudformation:DescribeStacks',
+                    ],
+                    resources=['*'],
+                )
+            )
+
+            Rule(
+                self,
+                'StackStatusChanged',
+                event_pattern=EventPattern(
+                    source=['aws.cloudformation'],
+                    detail_type=['CloudFormation Stack Status Change'],
+                ),
+                targets=[
+                    LambdaFunction(
+                        stack_inventory_lambda
+                    )
+                ]
+            )
+
+            # Backfills the table and catches up on missed events.
+            Rule(
+                self,
+                'ReconcileStackInventory',
+                schedule=Schedule.rate(
+                    Duration.days(1)
+                ),
+                targets=[
+                    LambdaFunction(
+                        stack_inventory_lambda
+                    )
+                ]
+            )
+
+            stack_inventory_table.grant_read_data(
+                get_stacks_to_delete_lambda
+            )
+
+            get_stacks_to_delete_lambda.add_environment(
+                'INVENTORY_MODE',
+                'cache',
+            )
+
+            get_stacks_to_delete_lambda.add_environment(
+                'INVENTORY_TABLE_NAME',
+                stack_inventory_table.table_name,
+            )
+
+        # Per-stack record of in-flight deletions, so a run that was
+        # stopped or timed out is resumed by the next one instead of
+        # starting over. Rows left by aborted runs expire.
+        deletion_journal_table = Table(
+            self,
+            'DeletionJournalTable',
+            partition_key=Attribute(
+                name='stack_name',
+                type=AttributeType.STRING,
+            ),
+            billing_mode=BillingMode.PAY_PER_REQUEST,
+            time_to_live_attribute='expires_at',
+        )
+
+        clear_deletion_journal_after_success = CallAwsService(
+            self,
+            'ClearDeletionJournalAfterSuccess',
+            service='dynamodb',
+            action='deleteItem',
+            iam_resources=[
+                deletion_journal_table.table_arn
+            ],
+            parameters={
+                'TableName': deletion_journal_table.table_name,
+                'Key': {
+                    'stack_name': {
+                        'S.$': '$.stack_to_delete'
+                    }
+                }
+            },
+            result_path=JsonPath.DISCARD,
+        )
+
+        clear_deletion_journal_after_failure = CallAwsService(
+            self,
+            'ClearDeletionJournalAfterFailure',
+            service='dynamodb',
+            action='deleteItem',
+            iam_resources=[
+                deletion_journal_table.table_arn
+            ],
+            parameters={
+                'TableName': deletion_journal_table.table_name,
+                'Key': {
+                    'stack_name': {
+                        'S.$': '$.stack_to_delete'
+                    }
+                }
+            },
+            result_path=JsonPath.DISCARD,
+        )
+
         delete_successful = Pass(
             self,
             'DeleteSuccessful'
         )
 
-        delete_successful_routine = delete_successful.next(
-            make_success_message
+        if slack_digest:
+            # Iterations return their result and one digest is sent after
+            # the Map instead of a Slack message per stack.
+            report_success = Pass(
+                self,
+                'RecordDeleteSucceeded',
+                parameters={
+                    'stack.$': '$.stack_to_delete',
+                    'status': 'DELETE_SUCCEEDED',
+                    'attempts.$': '$.iterator.index',
+                    'started_at.$': '$.iteration.started_at',
+                    'finished_at.$': '$$.State.EnteredTime',
+                },
+            )
+            report_failure = Pass(
+                self,
+                'RecordDeleteFailed',
+                parameters={
+                    'stack.$': '$.stack_to_delete',
+                    'status': 'DELETE_FAILED',
+                    'attempts.$': '$.iterator.index',
+                    'started_at.$': '$.iteration.started_at',
+                    'finished_at.$': '$$.State.EnteredTime',
+                },
+            )
+        else:
+            report_success = make_success_message.next(
+                send_slack_notification
+            )
+            report_failure = make_failure_message.next(
+                send_slack_notification
+            )
+
+        delete_successful_routine = clear_deletion_journal_after_success.next(
+            delete_successful
         ).next(
-            send_slack_notification
+            report_success
         )
 
         unable_to_delete = Pass(
@@ -191,20 +526,10 @@ class DemoCleaner(Stack):
             'UnableToDelete'
         )
 
-        unable_to_delete_routine = unable_to_delete.next(
-            make_failure_message
+        unable_to_delete_routine = clear_deletion_journal_after_failure.next(
+            unable_to_delete
         ).next(
-            send_slack_notification
-        )
-
-        increment_counter_lambda = PythonFunction(
-            self,
-            'IncrementCounterLambda',
-            entry='cleaner/lambdas/counter/',
-            runtime=Runtime.PYTHON_3_9,
-            index='increment.py',
-            handler='increment_counter',
-            timeout=Duration.seconds(60),
+            report_failure
         )
 
         get_stacks_to_delete = LambdaInvoke(
@@ -213,48 +538,161 @@ class DemoCleaner(Stack):
             lambda_function=get_stacks_to_delete_lambda,
             payload_response_only=True,
             result_selector={
-                'stacks_to_delete.$': '$'
+                'deletion_levels.$': '$.deletion_levels',
+                'expires_at.$': '$.expires_at',
             }
         )
 
+        # Carries the run's item expiry into every iteration.
         initialize_counter = Pass(
             self,
             'InitializeCounter',
+            parameters={
+                'index': 0,
+                'step': 1,
+                'count': 6,
+                'expires_at.$': '$.expires_at',
+            },
+            result_path='$.iterator',
+        )
+
+        # Intrinsic function instead of a Lambda invocation per attempt.
+        increment_counter = Pass(
+            self,
+            'IncrementCounter',
+            parameters={
+                'index.$': 'States.MathAdd($.iterator.index, $.iterator.step)',
+                'step.$': '$.iterator.step',
+                'count.$': '$.iterator.count',
+                'expires_at.$': '$.iterator.expires_at',
+            },
+            result_path='$.iterator',
+        )
+
+        delete_stack_callback_table = Table(
+            self,
+            'DeleteStackCallbackTable',
+            partition_key=Attribute(
+                name='stack_name',
+                type=AttributeType.STRING,
+            ),
+            billing_mode=BillingMode.PAY_PER_REQUEST,
+        )
+
+        delete_stack_callback_lambda = PythonFunction(
+            self,
+            'DeleteStackCallbackLambda',
+            runtime=Runtime.PYTHON_3_9,
+            entry='cleaner/lambdas/completion',
+            timeout=Duration.seconds(60),
+            environment={
+                'TABLE_NAME': delete_stack_callback_table.table_name,
+            }
+        )
+
+        delete_stack_callback_table.grant_read_write_data(
+            delete_stack_callback_lambda
+        )
+
+        # Stores the task token so the callback Lambda can resume the
+        # iteration as soon as CloudFormation reports the delete finished.
+        # Times out into polling in case the event never arrives.
+        wait_for_stack_delete_event = CallAwsService(
+            self,
+            'WaitForStackDeleteEvent',
+            service='dynamodb',
+            action='putItem',
+            iam_resources=[
+                delete_stack_callback_table.table_arn
+            ],
+            integration_pattern=IntegrationPattern.WAIT_FOR_TASK_TOKEN,
+            parameters={
+                'TableName': delete_stack_callback_table.table_name,
+                'Item': {
+                    'stack_name': {
+                        'S.$': '$.stack_to_delete'
+                    },
+                    'task_token': {
+                        'S': JsonPath.task_token
+                    },
+                    'started_at': {
+                        'S.$': '$$.State.EnteredTime'
+                    },
+                }
+            },
+            timeout=Duration.minutes(10),
+            result_path=JsonPath.DISCARD,
+        )
+
+        wait_before_retrying = Wait(
+            self,
+            'WaitBeforeRetrying',
+            time=WaitTime.seconds_path('$.retry.seconds')
+        )
+
+        wait_before_retrying.next(
+            increment_counter
+        )
+
+        initialize_retrying = Pass(
+            self,
+            'InitializeRetrying',
             result=Result.from_object(
                 {
-                    'index': 0,
-                    'step': 1,
-                    'count': 6,
+                    'seconds': DELETE_RETRY_INITIAL_SECONDS,
                 }
             ),
-            result_path='$.iterator',
+            result_path='$.retry',
+        ).next(
+            wait_before_retrying
         )
 
-        increment_counter = LambdaInvoke(
+        back_off_retrying = Pass(
             self,
-            'IncrementCounter',
-            lambda_function=increment_counter_lambda,
-            payload_response_only=True,
-            result_path='$.iterator',
+            'BackOffRetrying',
+            parameters={
+                'seconds.$': 'States.MathAdd($.retry.seconds, $.retry.seconds)',
+            },
+            result_path='$.retry',
+        ).next(
+            wait_before_retrying
         )
 
-        wait_ten_minutes = Wait(
+        # Nested so $.retry.seconds is only read once it exists.
+        should_back_off_retrying = Choice(
             self,
-            'WaitTenMinutes',
-            time=WaitTime.duration(
-                Duration.minutes(10)
-            )
+            'ShouldBackOffRetrying'
+        ).when(
+            Condition.number_less_than_equals(
+                '$.retry.seconds',
+                DELETE_RETRY_MAX_SECONDS // 2
+            ),
+            back_off_retrying
+        ).otherwise(
+            wait_before_retrying
+        )
+
+        has_retried = Choice(
+            self,
+            'HasRetried'
+        ).when(
+            Condition.is_present(
+                '$.retry'
+            ),
+            should_back_off_retrying
+        ).otherwise(
+            initialize_retrying
         )
 
         should_try_again = Choice(
             self,
             'ShouldTryAgain'
         ).when(
-            Condition.boolean_equals(
-                '$.iterator.continue',
-                True
+            Condition.number_less_than_json_path(
+                '$.iterator.index',
+                '$.iterator.count'
             ),
-            increment_counter
+            has_retried
         ).otherwise(
             unable_to_delete_routine
         )
@@ -268,11 +706,166 @@ class DemoCleaner(Stack):
             parameters={
                 'StackName.$': '$.stack_to_delete'
             },
-            result_path=JsonPath.DISCARD,
+            result_selector={
+                'status.$': '$.Stacks[0].StackStatus'
+            },
+            result_path='$.stack',
+        )
+
+        initialize_polling = Pass(
+            self,
+            'InitializePolling',
+            result=Result.from_object(
+                {
+                    'seconds': DELETE_POLL_INITIAL_SECONDS,
+                }
+            ),
+            result_path='$.poll',
+        )
+
+        wait_before_polling = Wait(
+            self,
+            'WaitBeforePolling',
+            time=WaitTime.seconds_path('$.poll.seconds')
+        )
+
+        back_off_polling = Pass(
+            self,
+            'BackOffPolling',
+            parameters={
+                'seconds.$': 'States.MathAdd($.poll.seconds, $.poll.seconds)',
+            },
+            result_path='$.poll',
+        )
+
+        # Doubles the interval until it reaches the maximum.
+        should_back_off_polling = Choice(
+            self,
+            'ShouldBackOffPolling'
+        ).when(
+            Condition.number_less_than_equals(
+                '$.poll.seconds',
+                DELETE_POLL_MAX_SECONDS // 2
+            ),
+            back_off_polling
+        )
+
+        # One small item per second in which the cleaner calls
+        # CloudFormation, expired with the run's other items.
+        cloudformation_rate_limit_table = Table(
+            self,
+            'CloudFormationRateLimitTable',
+            partition_key=Attribute(
+                name='window',
+                type=AttributeType.STRING,
+            ),
+            billing_mode=BillingMode.PAY_PER_REQUEST,
+            time_to_live_attribute='expires_at',
+        )
+
+        acquire_delete_stack_token = make_acquire_cloudformation_token(
+            self,
+            'AcquireDeleteStackToken',
+            cloudformation_rate_limit_table,
+            cloudformation_calls_per_second,
+        )
+
+        acquire_describe_stacks_token = make_acquire_cloudformation_token(
+            self,
+            'AcquireDescribeStacksToken',
+            cloudformation_rate_limit_table,
+            cloudformation_calls_per_second,
+        )
+
+        acquire_describe_stacks_token.next(
+            does_stack_exist
+        )
+
+        wait_before_polling.next(
+            should_back_off_polling.otherwise(
+                acquire_describe_stacks_token
+            )
+        )
+
+        back_off_polling.next(
+            acquire_describe_stacks_token
+        )
+
+        initialize_polling.next(
+            acquire_describe_stacks_token
+        )
+
+        # Without the event, poll until the delete is no longer in
+        # progress. Anything other than a finished delete is retried.
+        is_stack_still_deleting = Choice(
+            self,
+            'IsStackStillDeleting'
+        ).when(
+            Condition.string_equals(
+                '$.stack.status',
+                'DELETE_IN_PROGRESS'
+            ),
+            wait_before_polling
+        ).otherwise(
+            should_try_again
+        )
+
+        wait_for_stack_delete_event.add_catch(
+            initialize_polling,
+            errors=[
+                'States.Timeout'
+            ],
+            result_path='$.errors',
+        )
+
+        record_delete_failed_status = make_record_deletion_status(
+            self,
+            'RecordDeleteFailedStatus',
+            deletion_journal_table,
+            {
+                'S': 'DELETE_FAILED'
+            },
+        )
+
+        record_delete_failed_status.next(
+            should_try_again
+        )
+
+        wait_for_stack_delete_event.add_catch(
+            record_delete_failed_status,
+            errors=[
+                'StackDeleteFailed'
+            ],
+            result_path='$.errors',
+        )
+
+        # Throttling comes back as the same generic error as a missing
+        # stack, so retry it like DeleteStack and then tell the two apart
+        # by the cause.
+        does_stack_exist.add_retry(
+            errors=[
+                'CloudFormation.CloudFormationException'
+            ],
+            interval=Duration.seconds(2),
+            max_attempts=3,
+            backoff_rate=2,
+        )
+
+        is_stack_gone = Choice(
+            self,
+            'IsStackGone'
+        ).when(
+            Condition.string_matches(
+                '$.errors.Cause',
+                '*does not exist*'
+            ),
+            delete_successful_routine
+        ).otherwise(
+            should_try_again
         )
 
         does_stack_exist.add_catch(
-            delete_successful_routine,
+            is_stack_gone,
             errors=[
                 'CloudFormation.CloudFormationException'
             ],
@@ -291,6 +884,17 @@ class DemoCleaner(Stack):
             result_path=JsonPath.DISCARD,
         )
 
+        # Throttling comes back as the generic CloudFormation error, so
+        # back off a few times before giving up on the stack.
+        delete_stack.add_retry(
+            errors=[
+                'CloudFormation.CloudFormationException'
+            ],
+            interval=Duration.seconds(2),
+            max_attempts=3,
+            backoff_rate=2,
+        )
+
         delete_stack.add_catch(
             unable_to_delete_routine,
             errors=[
@@ -299,41 +903,518 @@ class DemoCleaner(Stack):
             result_path='$.errors',
         )
 
-        clean_up_routine = increment_counter.next(
-            delete_stack
+        record_polled_status = make_record_deletion_status(
+            self,
+            'RecordPolledStatus',
+            deletion_journal_table,
+            {
+                'S.$': '$.stack.status'
+            },
+        )
+
+        does_stack_exist.next(
+            record_polled_status
         ).next(
-            wait_ten_minutes
+            is_stack_still_deleting
+        )
+
+        record_delete_requested = CallAwsService(
+            self,
+            'RecordDeleteRequested',
+            service='dynamodb',
+            action='putItem',
+            iam_resources=[
+                deletion_journal_table.table_arn
+            ],
+            parameters={
+                'TableName': deletion_journal_table.table_name,
+                'Item': {
+                    'stack_name': {
+                        'S.$': '$.stack_to_delete'
+                    },
+                    'stack_id': {
+                        'S.$': '$.stack_id'
+                    },
+                    'attempts': {
+                        'N.$': "States.Format('{}', $.iterator.index)"
+                    },
+                    'last_status': {
+                        'S': 'DELETE_REQUESTED'
+                    },
+                    'updated_at': {
+                        'S.$': '$$.State.EnteredTime'
+                    },
+                    'execution_id': {
+                        'S.$': '$$.Execution.Id'
+                    },
+                    'expires_at': {
+                        'N.$': "States.Format('{}', $.iterator.expires_at)"
+                    },
+                }
+            },
+            result_path=JsonPath.DISCARD,
+        )
+
+        increment_counter.next(
+            record_delete_requested
         ).next(
-            does_stack_exist
+            acquire_delete_stack_token
         ).next(
-            should_try_again
+            delete_stack
+        ).next(
+            wait_for_stack_delete_event
+        ).next(
+            delete_successful_routine
         )
 
-        map_stacks = Map(
+        read_deletion_journal = CallAwsService(
             self,
-            'MapStacks',
-            items_path='$.stacks_to_delete',
-            max_concurrency=50,
+            'ReadDeletionJournal',
+            service='dynamodb',
+            action='getItem',
+            iam_resources=[
+                deletion_journal_table.table_arn
+            ],
             parameters={
-                'stack_to_delete.$': '$$.Map.Item.Value',
-                'iterator.$': '$.iterator'
-            }
+                'TableName': deletion_journal_table.table_name,
+                'Key': {
+                    'stack_name': {
+                        'S.$': '$.stack_to_delete'
+                    }
+                },
+                'ConsistentRead': True,
+            },
+            result_path='$.journal',
         )
 
-        map_stacks.iterator(clean_up_routine)
+        # Continues the attempt count from the interrupted run.
+        resume_counter = Pass(
+            self,
+            'ResumeCounter',
+            parameters={
+                'index.$': 'States.StringToJson($.journal.Item.attempts.N)',
+                'step.$': '$.iterator.step',
+                'count.$': '$.iterator.count',
+                'expires_at.$': '$.iterator.expires_at',
+            },
+            result_path='$.iterator',
+        )
 
-        definition = get_stacks_to_delete.next(
-            initialize_counter
-        ).next(
-            map_stacks
-        ).next(
-            succeed
+        resume_counter.next(
+            increment_counter
+        )
+
+        # An overlapping run still owns the row, so leave the stack to
+        # it instead of calling DeleteStack again and replacing its
+        # callback token.
+        deletion_owned_elsewhere = Pass(
+            self,
+            'DeletionOwnedElsewhere'
+        )
+
+        if slack_digest:
+            deletion_owned_elsewhere.next(
+                Pass(
+                    self,
+                    'RecordDeleteSkipped',
+                    parameters={
+                        'stack.$': '$.stack_to_delete',
+                        'status': 'DELETE_SKIPPED',
+                        'attempts.$': '$.iterator.index',
+                    },
+                )
+            )
+
+        describe_journal_execution = CallAwsService(
+            self,
+            'DescribeJournalExecution',
+            service='sfn',
+            action='describeExecution',
+            iam_resources=['*'],
+            parameters={
+                'ExecutionArn.$': '$.journal.Item.execution_id.S'
+            },
+            result_selector={
+                'status.$': '$.Status'
+            },
+            result_path='$.owner',
+        )
+
+        # Executions past the history retention period no longer exist.
+        describe_journal_execution.add_catch(
+            resume_counter,
+            errors=[
+                'Sfn.ExecutionDoesNotExistException'
+            ],
+            result_path='$.errors',
+        )
+
+        is_owner_running = Choice(
+            self,
+            'IsOwnerRunning'
+        ).when(
+            Condition.string_equals(
+                '$.owner.status',
+                'RUNNING'
+            ),
+            deletion_owned_elsewhere
+        ).otherwise(
+            resume_counter
+        )
+
+        describe_journal_execution.next(
+            is_owner_running
+        )
+
+        # A DELETE_IN_PROGRESS stack finishes without the cleaner and is
+        # selected again if it ends up DELETE_FAILED, so resuming only
+        # carries the attempt count over.
+        is_same_stack = Choice(
+            self,
+            'IsSameStack'
+        ).when(
+            Condition.string_equals_json_path(
+                '$.journal.Item.stack_id.S',
+                '$.stack_id'
+            ),
+            describe_journal_execution
+        ).otherwise(
+            increment_counter
         )
 
-        state_machine = StateMachine(
+        # Rows without a StackId predate it and are treated as stale.
+        is_deletion_in_flight = Choice(
             self,
-            'StateMachine',
-            definition=definition,
+            'IsDeletionInFlight'
+        ).when(
+            Condition.is_present(
+                '$.journal.Item.stack_id'
+            ),
+            is_same_stack
+        ).otherwise(
+            increment_counter
+        )
+
+        clean_up_routine = read_deletion_journal.next(
+            is_deletion_in_flight
+        )
+
+        if slack_digest:
+            # Durations are measured from when the iteration starts, not
+            # from when it was queued behind max_concurrency.
+            clean_up_routine = Pass(
+                self,
+                'StartIteration',
+                parameters={
+                    'started_at.$': '$$.State.EnteredTime',
+                },
+                result_path='$.iteration',
+            ).next(
+                clean_up_routine
+            )
+
+        if distributed_map is None:
+            map_stacks = Map(
+                self,
+                'MapStacks',
+                items_path='$.stacks_to_delete',
+                max_concurrency=50,
+                parameters={
+                    'stack_to_delete.$': '$$.Map.Item.Value.stack_to_delete',
+                    'stack_id.$': '$$.Map.Item.Value.stack_id',
+                    'iterator.$': '$.iterator'
+                }
+            )
+
+            map_stacks.iterator(clean_up_routine)
+
+            # Levels run one after another so stacks importing another
+            # stack's exports are gone before that stack is deleted.
+            map_deletion_levels = Map(
+                self,
+                'MapDeletionLevels',
+                items_path='$.deletion_levels',
+                max_concurrency=1,
+                parameters={
+                    'stacks_to_delete.$': '$$.Map.Item.Value',
+                    'iterator.$': '$.iterator'
+                },
+                result_path='$.results' if slack_digest else None,
+            )
+
+            map_deletion_levels.iterator(map_stacks)
+
+            if slack_digest:
+                make_slack_digest_lambda = PythonFunction(
+                    self,
+                    'MakeSlackDigestLambda',
+                    runtime=Runtime.PYTHON_3_9,
+                    entry='cleaner/lambdas/digest',
+                    timeout=Duration.seconds(60),
+                )
+
+                make_slack_digest = LambdaInvoke(
+                    self,
+                    'MakeSlackDigest',
+                    lambda_function=make_slack_digest_lambda,
+                    payload_response_only=True,
+                )
+
+                send_slack_digest = EventBridgePutEvents(
+                    self,
+                    'SendSlackDigest',
+                    entries=[
+                        EventBridgePutEventsEntry(
+                            detail_type=JsonPath.string_at('$.detailType'),
+                            detail=TaskInput.from_json_path_at('$.detail'),
+                            source=JsonPath.string_at('$.source')
+                        )
+                    ],
+                    result_path=JsonPath.DISCARD,
+                )
+
+                # Nothing is posted when there was nothing to delete.
+                report_results = Choice(
+                    self,
+                    'HasDeletionResults'
+                ).when(
+                    Condition.is_present(
+                        '$.results[0]'
+                    ),
+                    make_slack_digest.next(
+                        send_slack_digest
+                    ).next(
+                        succeed
+                    )
+                ).otherwise(
+                    succeed
+                )
+            else:
+                report_results = succeed
+
+            definition = get_stacks_to_delete.next(
+                initialize_counter
+            ).next(
+                map_deletion_levels
+            ).next(
+                report_results
+            )
+
+            state_machine = StateMachine(
+                self,
+                'StateMachine',
+                definition=definition,
+            )
+        else:
+            # Large sweeps: the Lambda writes one JSONL object per deletion
+            # level to S3 and returns the keys, and each level is processed
+            # by a Distributed Map in child executions.
+            deletion_list_bucket = Bucket(
+                self,
+                'DeletionListBucket',
+                block_public_access=BlockPublicAccess.BLOCK_ALL,
+                encryption=BucketEncryption.S3_MANAGED,
+                lifecycle_rules=[
+                    LifecycleRule(
+                        expiration=Duration.days(14),
+                    )
+                ],
+            )
+
+            get_stacks_to_delete_lambda.add_environment(
+                'DELETION_LIST_BUCKET',
+                deletion_list_bucket.bucket_name,
+            )
+
+            deletion_list_bucket.grant_put(
+                get_stacks_to_delete_lambda
+            )
+
+            map_stack_batch = Map(
+                self,
+                'MapStackBatch',
+                items_path='$.Items',
+                parameters={
+                    'stack_to_delete.$': '$$.Map.Item.Value.stack_to_delete',
+                    'stack_id.$': '$$.Map.Item.Value.stack_id',
+                    'iterator.$': '$.BatchInput.iterator'
+                }
+            )
+
+            map_stack_batch.iterator(clean_up_routine)
+
+            child_workflow = StateGraph(
+                map_stack_batch,
+                'MapStacks child workflow'
+            )
+
+            # Distributed Map isn't modeled in this CDK version.
+            map_stacks = CustomState(
+                self,
+                'MapStacks',
+                state_json={
+                    'Type': 'Map',
+                    'ItemReader': {
+                        'Resource': f'arn:{self.partition}:states:::s3:getObject',
+                        'ReaderConfig': {
+                            'InputType': 'JSONL',
+                        },
+                        'Parameters': {
+                            'Bucket': deletion_list_bucket.bucket_name,
+                            'Key.$': '$.deletion_level.key',
+                        },
+                    },
+                    'ItemBatcher': {
+                        'MaxItemsPerBatch': distributed_map.batch_size,
+                        'BatchInput': {
+                            'iterator.$': '$.iterator',
+                        },
+                    },
+                    'ItemProcessor': {
+                        'ProcessorConfig': {
+                            'Mode': 'DISTRIBUTED',
+                            'ExecutionType': 'STANDARD',
+                        },
+                        **child_workflow.to_graph_json(),
+                    },
+                    'MaxConcurrency': distributed_map.max_concurrency,
+                    'ToleratedFailurePercentage': distributed_map.tolerated_failure_percentage,
+                    'ResultPath': None,
+                }
+            )
+
+            # Distributed Map has to be at the top level of the state
+            # machine, so levels are walked with a loop instead of a Map.
+            initialize_level = Pass(
+                self,
+                'InitializeLevel',
+                parameters={
+                    'index': 0,
+                    'count.$': 'States.ArrayLength($.deletion_levels)',
+                },
+                result_path='$.level',
+            )
+
+            select_deletion_level = Pass(
+                self,
+                'SelectDeletionLevel',
+                parameters={
+                    'key.$': 'States.ArrayGetItem($.deletion_levels, $.level.index)',
+                },
+                result_path='$.deletion_level',
+            )
+
+            next_level = Pass(
+                self,
+                'NextLevel',
+                parameters={
+                    'index.$': 'States.MathAdd($.level.index, 1)',
+                    'count.$': '$.level.count',
+                },
+                result_path='$.level',
+            )
+
+            has_more_levels = Choice(
+                self,
+                'HasMoreLevels'
+            ).when(
+                Condition.number_less_than_json_path(
+                    '$.level.index',
+                    '$.level.count'
+                ),
+                select_deletion_level
+            ).otherwise(
+                succeed
+            )
+
+            select_deletion_level.next(
+                map_stacks
+            ).next(
+                next_level
+            ).next(
+                has_more_levels
+            )
+
+            definition = get_stacks_to_delete.next(
+                initialize_counter
+            ).next(
+                initialize_level
+            ).next(
+                has_more_levels
+            )
+
+            state_machine = StateMachine(
+                self,
+                'StateMachine',
+                definition=definition,
+            )
+
+            for policy_statement in child_workflow.policy_statements:
+                state_machine.add_to_role_policy(
+                    policy_statement
+                )
+
+            deletion_list_bucket.grant_read(
+                state_machine
+            )
+
+            state_machine.add_to_role_policy(
+                PolicyStatement(
+                    actions=[
+                        'states:StartExecution',
+                    ],
+                    resources=[
+                        self.format_arn(
+                            service='states',
+                            resource='stateMachine',
+                            resource_name='*',
+                            arn_format=ArnFormat.COLON_RESOURCE_NAME,
+                        )
+                    ],
+                )
+            )
+
+            state_machine.add_to_role_policy(
+                PolicyStatement(
+                    actions=[
+                        'states:DescribeExecution',
+                        'states:StopExecution',
+                    ],
+                    resources=[
+                        self.format_arn(
+                            service='states',
+                            resource='execution',
+                            resource_name='*',
+                            arn_format=ArnFormat.COLON_RESOURCE_NAME,
+                        )
+                    ],
+                )
+            )
+
+        state_machine.grant_task_response(
+            delete_stack_callback_lambda
+        )
+
+        Rule(
+            self,
+            'StackDeleteFinished',
+            event_pattern=EventPattern(
+                source=['aws.cloudformation'],
+                detail_type=['CloudFormation Stack Status Change'],
+                detail={
+                    'status-details': {
+                        'status': [
+                            'DELETE_COMPLETE',
+                            'DELETE_FAILED',
+                        ]
+                    }
+                }
+            ),
+            targets=[
+                LambdaFunction(
+                    delete_stack_callback_lambda
+                )
+            ]
         )
 
         state_machine_target = SfnStateMachine(
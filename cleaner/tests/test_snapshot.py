@@ -30,3 +30,74 @@ def test_match_with_snapshot(snapshot):
         ),
         'demo_cleaner_template.json'
     )
+
+
+def test_distributed_map_match_with_snapshot(snapshot):
+    from aws_cdk import App
+    from cleaner.stacks.demo import DemoCleaner
+    from cleaner.stacks.demo import DistributedMapProps
+    from aws_cdk.assertions import Template
+    app = App()
+    stack = DemoCleaner(
+        app,
+        'DemoCleaner',
+        distributed_map=DistributedMapProps(
+            max_concurrency=100,
+            tolerated_failure_percentage=5,
+            batch_size=10,
+        ),
+        env=ENVIRONMENT
+    )
+    template = Template.from_stack(stack)
+    snapshot.assert_match(
+        json.dumps(
+            template.to_json(),
+            indent=4,
+            sort_keys=True
+        ),
+        'demo_cleaner_distributed_map_template.json'
+    )
+
+
+def test_inventory_cache_match_with_snapshot(snapshot):
+    from aws_cdk import App
+    from cleaner.stacks.demo import DemoCleaner
+    from aws_cdk.assertions import Template
+    app = App()
+    stack = DemoCleaner(
+        app,
+        'DemoCleaner',
+        inventory_cache=True,
+        env=ENVIRONMENT
+    )
+    template = Template.from_stack(stack)
+    snapshot.assert_match(
+        json.dumps(
+            template.to_json(),
+            indent=4,
+            sort_keys=True
+        ),
+        'demo_cleaner_inventory_cache_template.json'
+    )
+
+
+def test_slack_digest_match_with_snapshot(snapshot):
+    from aws_cdk import App
+    from cleaner.stacks.demo import DemoCleaner
+    from aws_cdk.assertions import Template
+    app = App()
+    stack = DemoCleaner(
+        app,
+        'DemoCleaner',
+        slack_digest=True,
+        env=ENVIRONMENT
+    )
+    template = Template.from_stack(stack)
+    snapshot.assert_match(
+        json.dumps(
+            template.to_json(),
+            indent=4,
+            sort_keys=True
+        ),
+        'demo_cleaner_slack_digest_template.json'
+    )
@@ -0,0 +1,48 @@
+def test_benchmarks_stacks_make_raw_stacks():
+    from benchmarks.stacks import make_raw_stacks
+    from cleaner.lambdas.cloudformation.stacks import make_stack_record
+    raw_stacks = make_raw_stacks(8)
+    assert len(raw_stacks) == 8
+    assert raw_stacks == make_raw_stacks(8)
+    record = make_stack_record(raw_stacks[2])
+    assert record.name == 'igvfd-IGVF-0-synthetic-branch-DeployDevelopment-PostgresStack'
+    assert record.tags['branch'] == 'IGVF-0-synthetic-branch'
+    assert record.exports == [
+        'igvfd-IGVF-0-synthetic-branch-DeployDevelopment-PostgresStack:ExportsOutputRefPostgres'
+    ]
+
+
+def test_benchmarks_stacks_main():
+    import io
+    import json
+    from benchmarks.stacks import main
+    stdout = io.StringIO()
+    main(
+        [
+            '--sizes', '100',
+            '--messages', '1', '10',
+            '--repeat', '1',
+            '--json',
+        ],
+        stdout=stdout
+    )
+    results = json.loads(stdout.getvalue())
+    assert [
+        (result['benchmark'], result['messages'])
+        for result in results
+        if result['stacks'] == 100
+    ] == [
+        (benchmark, messages)
+        for messages in [1, 10]
+        for benchmark in [
+            'make_stack_inventory',
+            'group_messages_by_branch',
+            'time_to_live_hours_rule',
+            'friday_night_rule',
+            'branch_deleted_rule',
+            'get_stacks_to_delete',
+        ]
+    ]
+    for result in results:
+        assert result['seconds'] > 0
+        assert result['peak_bytes'] > 0
@@ -1,6 +1,8 @@
 import pytest
 
 from moto import mock_cloudformation
+from moto import mock_dynamodb
+from moto import mock_s3
 from moto import mock_sqs
 
 from dateutil.parser import isoparse
@@ -16,6 +18,21 @@ def aws_credentials():
     os.environ['AWS_DEFAULT_REGION'] = 'us-west-1'
 
 
+@pytest.fixture(autouse=True)
+def clear_clients(mocker):
+    from cleaner.lambdas.cloudformation.stacks import clients
+    clients.clear()
+    mocker.patch.dict(
+        'cleaner.lambdas.cloudformation.stacks.inventory_cache',
+        {
+            'stacks_by_id': {},
+            'read_until': None,
+        }
+    )
+    yield
+    clients.clear()
+
+
 @pytest.fixture
 def raw_stacks():
     return [
@@ -616,6 +633,15 @@ def raw_stacks():
     ]
 
 
+@pytest.fixture
+def stacks(raw_stacks):
+    from cleaner.lambdas.cloudformation.stacks import make_stack_record
+    return [
+        make_stack_record(stack)
+        for stack in raw_stacks
+    ]
+
+
 @mock_cloudformation
 def test_lambdas_cloudformation_stacks_get_cloudformation_client(aws_credentials):
     from cleaner.lambdas.cloudformation.stacks import get_cloudformation_client
@@ -623,6 +649,19 @@ def test_lambdas_cloudformation_stacks_get_cloudformation_client(aws_credentials
     assert hasattr(client, 'describe_stacks')
 
 
+@mock_cloudformation
+@mock_sqs
+def test_lambdas_cloudformation_stacks_get_client_is_cached(aws_credentials):
+    from cleaner.lambdas.cloudformation.stacks import get_cloudformation_client
+    from cleaner.lambdas.cloudformation.stacks import get_sqs_client
+    client = get_cloudformation_client()
+    assert get_cloudformation_client() is client
+    assert get_sqs_client() is get_sqs_client()
+    assert get_sqs_client() is not client
+    assert client.meta.config.retries['mode'] == 'adaptive'
+    assert client.meta.config.max_pool_connections == 25
+
+
 @mock_cloudformation
 def test_lambdas_cloudformation_stacks_get_describe_stacks_paginator(aws_credentials):
     from cleaner.lambdas.cloudformation.stacks import get_cloudformation_client
@@ -634,89 +673,190 @@ def test_lambdas_cloudformation_stacks_get_describe_stacks_paginator(aws_credent
 
 
 @mock_cloudformation
-def test_lambdas_cloudformation_stacks_get_all_stacks(aws_credentials):
-    from cleaner.lambdas.cloudformation.stacks import get_cloudformation_client
-    from cleaner.lambdas.cloudformation.stacks import get_describe_stacks_paginator
-    from cleaner.lambdas.cloudformation.stacks import get_all_stacks
-    client = get_cloudformation_client()
-    paginator = get_describe_stacks_paginator(client)
-    stacks = get_all_stacks(paginator)
-    assert stacks == []
+def test_lambdas_cloudformation_stacks_get_stack_inventory(aws_credentials):
+    from cleaner.lambdas.cloudformation.stacks import get_stack_inventory
+    inventory = get_stack_inventory()
+    assert inventory.stacks == []
+    assert inventory.pages == 1
+
+
+def create_inventory_table(client):
+    client.create_table(
+        TableName='inventory',
+        AttributeDefinitions=[
+            {'AttributeName': 'stack_id', 'AttributeType': 'S'},
+            {'AttributeName': 'shard', 'AttributeType': 'S'},
+            {'AttributeName': 'updated_at', 'AttributeType': 'N'},
+        ],
+        KeySchema=[
+            {'AttributeName': 'stack_id', 'KeyType': 'HASH'},
+        ],
+        GlobalSecondaryIndexes=[
+            {
+                'IndexName': 'ByUpdatedAt',
+                'KeySchema': [
+                    {'AttributeName': 'shard', 'KeyType': 'HASH'},
+                    {'AttributeName': 'updated_at', 'KeyType': 'RANGE'},
+                ],
+                'Projection': {'ProjectionType': 'ALL'},
+            }
+        ],
+        BillingMode='PAY_PER_REQUEST',
+    )
 
 
-def test_lambdas_cloudformation_stacks_filter_stacks_by_statuses(raw_stacks):
-    from cleaner.lambdas.cloudformation.stacks import filter_stacks_by_statuses
-    assert len(raw_stacks) == 15
-    filtered_stacks = filter_stacks_by_statuses(raw_stacks)
-    assert len(filtered_stacks) == 14
+def put_inventory_item(client, stack_id, status, updated_at, tags=None):
+    import json
+    client.put_item(
+        TableName='inventory',
+        Item={
+            'stack_id': {'S': stack_id},
+            'stack_name': {'S': stack_id.split('/')[1]},
+            'status': {'S': status},
+            'creation_time': {'S': '2022-09-03T19:44:28.625000+00:00'},
+            'tags': {'S': json.dumps(tags or {})},
+            'exports': {'S': json.dumps([])},
+            'shard': {'S': 'stacks'},
+            'updated_at': {'N': str(updated_at)},
+        }
+    )
+
+
+@mock_dynamodb
+def test_lambdas_cloudformation_stacks_get_stack_inventory_from_cache(aws_credentials, mocker):
+    import os
+    from cleaner.lambdas.cloudformation import stacks
+    from cleaner.lambdas.cloudformation.stacks import get_dynamodb_client
+    from cleaner.lambdas.cloudformation.stacks import get_stack_inventory
+    from cleaner.lambdas.cloudformation.stacks import inventory_cache
+    mocker.patch.dict(
+        os.environ,
+        {
+            'INVENTORY_MODE': 'cache',
+            'INVENTORY_TABLE_NAME': 'inventory',
+        }
+    )
+    patched_time = mocker.patch('time.time')
+    patched_time.return_value = 1000000.0
+    client = get_dynamodb_client()
+    create_inventory_table(client)
+    put_inventory_item(client, 'stack/a/1', 'CREATE_COMPLETE', 100, {'time-to-live-hours': '24'})
+    put_inventory_item(client, 'stack/b/2', 'CREATE_COMPLETE', 200)
+    put_inventory_item(client, 'stack/c/3', 'DELETE_COMPLETE', 300)
+    spied_query_pages = mocker.spy(stacks, 'get_inventory_cache_pages')
+    inventory = get_stack_inventory()
+    assert sorted(stack.name for stack in inventory.stacks) == ['a', 'b']
+    assert inventory.stacks[0].tags == {'time-to-live-hours': '24'}
+    assert str(inventory.stacks[0].creation_time) == '2022-09-03 19:44:28.625000+00:00'
+    assert spied_query_pages.call_args[0][2] == 0
+    assert inventory_cache['read_until'] == 1000000000
+    # Warm runs only read what changed since the last one.
+    put_inventory_item(client, 'stack/a/1', 'DELETE_COMPLETE', 1000000001)
+    put_inventory_item(client, 'stack/d/4', 'UPDATE_COMPLETE', 1000000002)
+    inventory = get_stack_inventory()
+    assert sorted(stack.name for stack in inventory.stacks) == ['b', 'd']
+    assert spied_query_pages.call_args[0][2] == 1000000000 - 5 * 60 * 1000
 
 
-def test_lambdas_cloudformation_stacks_get_tag_by_key(raw_stacks):
+def test_lambdas_cloudformation_stacks_make_stack_inventory(raw_stacks):
+    from cleaner.lambdas.cloudformation.stacks import make_stack_inventory
+    inventory = make_stack_inventory(
+        [
+            {'Stacks': raw_stacks[:10]},
+            {'Stacks': raw_stacks[10:]},
+        ]
+    )
+    assert [stack.name for stack in inventory.stacks] == [
+        stack['StackName']
+        for stack in raw_stacks
+    ]
+    assert inventory.pages == 2
+
+
+def test_lambdas_cloudformation_stacks_make_stack_record(raw_stacks):
+    from cleaner.lambdas.cloudformation.stacks import make_stack_record
+    stack = make_stack_record(raw_stacks[0])
+    assert stack.name == 'igvf-ui-IGVF-246-remove-uuid-as-unique-key-for-treatments-DeployDevelopment-FrontendStack'
+    assert stack.status == 'CREATE_COMPLETE'
+    assert str(stack.creation_time) == '2022-08-29 21:44:28.625000+00:00'
+    assert stack.tags['time-to-live-hours'] == '72'
+    assert stack.tags['branch'] == 'IGVF-246-remove-uuid-as-unique-key-for-treatments'
+    assert stack.stack_id == raw_stacks[0]['StackId']
+    assert not hasattr(stack, '__dict__')
+    assert make_stack_record(raw_stacks[14]).tags == {}
+
+
+def test_lambdas_cloudformation_stacks_stack_has_okay_status(stacks):
+    from cleaner.lambdas.cloudformation.stacks import stack_has_okay_status
+    assert len(stacks) == 15
+    okay_stacks = [
+        stack
+        for stack in stacks
+        if stack_has_okay_status(stack)
+    ]
+    assert len(okay_stacks) == 14
+
+
+def test_lambdas_cloudformation_stacks_get_tag_by_key(stacks):
     from cleaner.lambdas.cloudformation.stacks import get_tag_by_key
-    tag = get_tag_by_key(raw_stacks[0], 'time-to-live-hours')
-    assert tag == {'Key': 'time-to-live-hours', 'Value': '72'}
-    tag = get_tag_by_key(raw_stacks[0], 'key-that-does-not-exist')
+    tag = get_tag_by_key(stacks[0], 'time-to-live-hours')
+    assert tag == '72'
+    tag = get_tag_by_key(stacks[0], 'key-that-does-not-exist')
     assert tag is None
 
 
-def test_lambdas_cloudformation_stacks_get_time_to_live_hours_tag_or_none(raw_stacks):
+def test_lambdas_cloudformation_stacks_get_time_to_live_hours_tag_or_none(stacks):
     from cleaner.lambdas.cloudformation.stacks import get_time_to_live_hours_tag_or_none
     assert get_time_to_live_hours_tag_or_none(
-        raw_stacks[0]) == {'Key': 'time-to-live-hours', 'Value': '72'}
-    assert get_time_to_live_hours_tag_or_none(raw_stacks[10]) is None
+        stacks[0]) == '72'
+    assert get_time_to_live_hours_tag_or_none(stacks[10]) is None
 
 
-def test_lambdas_cloudformation_stacks_stack_has_time_to_live_hours_tag(raw_stacks):
+def test_lambdas_cloudformation_stacks_stack_has_time_to_live_hours_tag(stacks):
     from cleaner.lambdas.cloudformation.stacks import stack_has_time_to_live_hours_tag
-    assert stack_has_time_to_live_hours_tag(raw_stacks[0])
-    assert not stack_has_time_to_live_hours_tag(raw_stacks[10])
-
-
-def test_lambdas_cloudformation_stacks_filter_stacks_with_time_to_live_hours_tag(raw_stacks):
-    from cleaner.lambdas.cloudformation.stacks import filter_stacks_with_time_to_live_hours_tag
-    filtered_stacks = filter_stacks_with_time_to_live_hours_tag(raw_stacks)
-    assert len(filtered_stacks) == 5
+    assert stack_has_time_to_live_hours_tag(stacks[0])
+    assert not stack_has_time_to_live_hours_tag(stacks[10])
 
 
-def test_lambdas_cloudformation_stacks_get_turn_off_on_friday_night_tag_or_none(raw_stacks):
+def test_lambdas_cloudformation_stacks_get_turn_off_on_friday_night_tag_or_none(stacks):
     from cleaner.lambdas.cloudformation.stacks import get_turn_off_on_friday_night_tag_or_none
     assert get_turn_off_on_friday_night_tag_or_none(
-        raw_stacks[0]) == {'Key': 'turn-off-on-friday-night', 'Value': 'yes'}
-    assert get_turn_off_on_friday_night_tag_or_none(raw_stacks[10]) is None
+        stacks[0]) == 'yes'
+    assert get_turn_off_on_friday_night_tag_or_none(stacks[10]) is None
 
 
-def test_lambdas_cloudformation_stacks_stack_has_turn_off_on_friday_night_tag(raw_stacks):
+def test_lambdas_cloudformation_stacks_stack_has_turn_off_on_friday_night_tag(stacks):
     from cleaner.lambdas.cloudformation.stacks import stack_has_turn_off_on_friday_night_tag
-    assert stack_has_turn_off_on_friday_night_tag(raw_stacks[0])
-    assert not stack_has_turn_off_on_friday_night_tag(raw_stacks[10])
+    assert stack_has_turn_off_on_friday_night_tag(stacks[0])
+    assert not stack_has_turn_off_on_friday_night_tag(stacks[10])
 
 
-def test_lambdas_cloudformation_stacks_filter_stacks_with_turn_off_on_friday_night_tag(raw_stacks):
-    from cleaner.lambdas.cloudformation.stacks import filter_stacks_with_turn_off_on_friday_night_tag
-    filtered_stacks = filter_stacks_with_turn_off_on_friday_night_tag(
-        raw_stacks)
-    assert len(filtered_stacks) == 5
-
-
-def test_lambdas_cloudformation_stacks_get_stack_name(raw_stacks):
+def test_lambdas_cloudformation_stacks_get_stack_name(stacks):
     from cleaner.lambdas.cloudformation.stacks import get_stack_name
     assert get_stack_name(
-        raw_stacks[0]) == 'igvf-ui-IGVF-246-remove-uuid-as-unique-key-for-treatments-DeployDevelopment-FrontendStack'
+        stacks[0]) == 'igvf-ui-IGVF-246-remove-uuid-as-unique-key-for-treatments-DeployDevelopment-FrontendStack'
 
 
-def test_lambdas_cloudformation_stacks_get_creation_time(raw_stacks):
+def test_lambdas_cloudformation_stacks_get_creation_time(stacks):
     from cleaner.lambdas.cloudformation.stacks import get_creation_time
     assert str(get_creation_time(
-        raw_stacks[0])) == '2022-08-29 21:44:28.625000+00:00'
+        stacks[0])) == '2022-08-29 21:44:28.625000+00:00'
 
 
 def test_lambdas_cloudformation_stacks_try_parse_time_to_live_hours_tag():
     from cleaner.lambdas.cloudformation.stacks import try_parse_time_to_live_hours_tag
-    tag = {'Key': 'time-to-live-hours', 'Value': '72'}
-    ttl = try_parse_time_to_live_hours_tag(tag)
+    ttl = try_parse_time_to_live_hours_tag('72')
     assert ttl == 72
-    tag = {'Key': 'time-to-live-hours', 'Value': 'xyz72'}
-    assert try_parse_time_to_live_hours_tag(tag) is None
+    assert try_parse_time_to_live_hours_tag('xyz72') is None
+
+
+def test_lambdas_cloudformation_stacks_parse_timestamp():
+    import datetime
+    from cleaner.lambdas.cloudformation.stacks import parse_timestamp
+    assert parse_timestamp('2022-09-04T21:44:28Z') == datetime.datetime(
+        2022, 9, 4, 21, 44, 28, tzinfo=datetime.timezone.utc
+    )
+    assert parse_timestamp('2022-09-04T21:44:28.625000+00:00').microsecond == 625000
 
 
 def test_lambdas_cloudformation_stacks_get_current_utc_time():
@@ -734,80 +874,60 @@ def test_lambdas_cloudformation_stacks_get_current_pacific_time():
     assert now.tzinfo == ZoneInfo('US/Pacific')
 
 
-def test_lambdas_cloudformation_stacks_time_to_live_hours_exceeded(mocker):
+def test_lambdas_cloudformation_stacks_time_to_live_hours_rule_thresholds():
     import datetime
     from dateutil.tz import tzutc
-    from cleaner.lambdas.cloudformation.stacks import time_to_live_hours_exceeded
-    from cleaner.lambdas.cloudformation.stacks import get_current_utc_time
-    patched_current_time = mocker.patch(
-        'cleaner.lambdas.cloudformation.stacks.get_current_utc_time')
-    patched_current_time.return_value = datetime.datetime(
-        2022, 8, 29, 21, 44, 28, 625000, tzinfo=tzutc())
-    creation_time = datetime.datetime(
-        2022, 8, 28, 21, 44, 28, 625000, tzinfo=tzutc())
-    assert not time_to_live_hours_exceeded(creation_time, 26)
-    assert time_to_live_hours_exceeded(creation_time, 24)
+    from cleaner.lambdas.cloudformation.stacks import StackRecord
+    from cleaner.lambdas.cloudformation.stacks import TimeToLiveHoursRule
+    rule = TimeToLiveHoursRule(
+        datetime.datetime(2022, 8, 29, 21, 44, 28, 625000, tzinfo=tzutc())
+    )
 
+    def make_stack(tags):
+        return StackRecord(
+            name='igvfd-IGVF-1-abc-BackendStack',
+            status='CREATE_COMPLETE',
+            creation_time=datetime.datetime(2022, 8, 28, 21, 44, 28, 625000, tzinfo=tzutc()),
+            tags=tags,
+        )
 
-def test_lambdas_cloudformation_stacks_stack_is_alive_longer_than_time_to_live_hours(raw_stacks, mocker):
-    import datetime
-    from dateutil.tz import tzutc
-    from cleaner.lambdas.cloudformation.stacks import stack_is_alive_longer_than_time_to_live_hours
-    patched_current_time = mocker.patch(
-        'cleaner.lambdas.cloudformation.stacks.get_current_utc_time')
-    patched_current_time.return_value = datetime.datetime(
-        2022, 8, 29, 21, 44, 28, 625000, tzinfo=tzutc())
-    assert not stack_is_alive_longer_than_time_to_live_hours(raw_stacks[0])
-    patched_current_time.return_value = datetime.datetime(
-        2022, 9, 4, 21, 44, 28, 625000, tzinfo=tzutc())
-    assert stack_is_alive_longer_than_time_to_live_hours(raw_stacks[0])
+    assert not rule.matches(make_stack({'time-to-live-hours': '26'}))
+    assert rule.matches(make_stack({'time-to-live-hours': '24'}))
+    # Negative values are valid and already exceeded.
+    assert rule.matches(make_stack({'time-to-live-hours': '-1'}))
+    assert rule.matches(make_stack({'time-to-live-hours': '0'}))
+    assert not rule.matches(make_stack({'time-to-live-hours': 'never'}))
+    assert not rule.matches(make_stack({}))
+    assert not rule.matches(make_stack({'time-to-live-hours': '1' * 30}))
+    # Past the float range, so the stack never expires.
+    assert not rule.matches(make_stack({'time-to-live-hours': '9' * 400}))
+    assert rule.matches(make_stack({'time-to-live-hours': '-' + '9' * 400}))
 
 
-def test_lambdas_cloudformation_stacks_filter_stacks_living_longer_than_time_to_live_hours(raw_stacks, mocker):
-    import datetime
-    from dateutil.tz import tzutc
-    from cleaner.lambdas.cloudformation.stacks import filter_stacks_living_longer_than_time_to_live_hours
-    from cleaner.lambdas.cloudformation.stacks import filter_stacks_with_time_to_live_hours_tag
-    patched_current_time = mocker.patch(
-        'cleaner.lambdas.cloudformation.stacks.get_current_utc_time')
-    patched_current_time.return_value = datetime.datetime(
-        2022, 9, 4, 21, 44, 28, 625000, tzinfo=tzutc()
-    )
-    filtered_stacks = filter_stacks_living_longer_than_time_to_live_hours(
-        filter_stacks_with_time_to_live_hours_tag(
-            raw_stacks
-        )
-    )
-    assert len(filtered_stacks) == 5
+def test_lambdas_cloudformation_stacks_time_to_live_hours_to_float():
+    from cleaner.lambdas.cloudformation.stacks import time_to_live_hours_to_float
+    assert time_to_live_hours_to_float(24) == 24.0
+    assert time_to_live_hours_to_float(int('9' * 400)) == float('inf')
+    assert time_to_live_hours_to_float(-int('9' * 400)) == float('-inf')
 
 
-def test_lambdas_cloudformation_stacks_stack_has_turn_off_on_friday_night_yes_tag(raw_stacks):
+def test_lambdas_cloudformation_stacks_stack_has_turn_off_on_friday_night_yes_tag(stacks):
     from cleaner.lambdas.cloudformation.stacks import stack_has_turn_off_on_friday_night_yes_tag
     from copy import deepcopy
-    stack = deepcopy(raw_stacks[0])
+    stack = deepcopy(stacks[0])
     assert stack_has_turn_off_on_friday_night_yes_tag(
         stack
     )
-    stack['Tags'][4]['Value'] = 'no'
+    stack.tags['turn-off-on-friday-night'] = 'no'
     assert not stack_has_turn_off_on_friday_night_yes_tag(
         stack
     )
-    stack['Tags'] = []
+    stack.tags = {}
     assert not stack_has_turn_off_on_friday_night_yes_tag(
         stack
     )
 
 
-def test_lambdas_cloudformation_stacks_filter_stacks_by_turn_off_on_friday_night_is_yes(raw_stacks, mocker):
-    import datetime
-    from zoneinfo import ZoneInfo
-    from cleaner.lambdas.cloudformation.stacks import filter_stacks_by_turn_off_on_friday_night_is_yes
-    filtered_stacks = filter_stacks_by_turn_off_on_friday_night_is_yes(
-        raw_stacks
-    )
-    assert len(filtered_stacks) == 5
-
-
 def test_lambdas_cloudformation_stacks_is_it_friday_night_in_LA_it_is_not(mocker):
     import datetime
     from zoneinfo import ZoneInfo
@@ -830,86 +950,712 @@ def test_lambdas_cloudformation_stacks_is_it_friday_night_in_LA_it_is(mocker):
     assert is_it_friday_night_in_LA() == True
 
 
-@mock_cloudformation
-def test_lambdas_cloudformation_stacks_get_stacks_to_delete_because_of_time_to_live_hours_tag(aws_credentials, raw_stacks, mocker):
+@mock_sqs
+def test_lambdas_cloudformation_stacks_get_messages_from_delete_branch_queue(aws_credentials, mocker):
+    import os
+    import time
+    import boto3
+    from cleaner.lambdas.cloudformation.stacks import get_messages_from_delete_branch_queue
+    client = boto3.client('sqs')
+    queue_url = client.create_queue(QueueName='abc')['QueueUrl']
+    mocker.patch.dict(os.environ, {'DELETE_BRANCH_QUEUE_URL': queue_url})
+    start = time.time()
+    assert get_messages_from_delete_branch_queue() == []
+    # Empty queue stops after a single short poll.
+    assert time.time() - start < 5
+    for i in range(25):
+        client.send_message(QueueUrl=queue_url, MessageBody=str(i))
+    messages = get_messages_from_delete_branch_queue()
+    assert sorted(
+        int(message['Body'])
+        for message in messages
+    ) == list(range(25))
+
+
+def test_lambdas_cloudformation_stacks_get_messages_from_delete_branch_queue_bounds(mocker):
+    import os
+    from cleaner.lambdas.cloudformation.stacks import get_messages_from_delete_branch_queue
+    mocker.patch.dict(
+        os.environ,
+        {
+            'DELETE_BRANCH_QUEUE_URL': 'abc',
+            'DELETE_BRANCH_QUEUE_MAX_MESSAGES': '15',
+        }
+    )
+    patched_sqs_client = mocker.patch(
+        'cleaner.lambdas.cloudformation.stacks.get_sqs_client'
+    )
+    receive_message = patched_sqs_client.return_value.receive_message
+    receive_message.side_effect = lambda **kwargs: {
+        'Messages': [
+            {'Body': '{}'}
+            for i in range(kwargs['MaxNumberOfMessages'])
+        ]
+    }
+    messages = get_messages_from_delete_branch_queue()
+    assert len(messages) == 15
+    assert [
+        (call.kwargs['MaxNumberOfMessages'], call.kwargs['WaitTimeSeconds'])
+        for call in receive_message.call_args_list
+    ] == [(10, 1), (5, 0)]
+    context = mocker.MagicMock()
+    context.get_remaining_time_in_millis.return_value = 20000
+    receive_message.reset_mock()
+    assert get_messages_from_delete_branch_queue(context) == []
+    receive_message.assert_not_called()
+
+
+def validate_emf_record(record):
+    # Checks the structure CloudWatch Logs requires before it extracts
+    # metrics from a log line.
+    metadata = record['_aws']
+    assert isinstance(metadata['Timestamp'], int)
+    assert len(metadata['CloudWatchMetrics']) >= 1
+    for directive in metadata['CloudWatchMetrics']:
+        assert directive['Namespace'] == 'DemoCleaner'
+        for dimension_set in directive['Dimensions']:
+            for dimension in dimension_set:
+                assert isinstance(record[dimension], str)
+        for metric in directive['Metrics']:
+            assert metric['Unit'] in ['Count', 'Milliseconds']
+            assert isinstance(record[metric['Name']], (int, float))
+
+
+def test_lambdas_cloudformation_stacks_make_emf_record():
+    from cleaner.lambdas.cloudformation.stacks import make_emf_record
+    record = make_emf_record(
+        {
+            'StacksScanned': (15, 'Count'),
+            'PhaseDuration': (12.5, 'Milliseconds'),
+        },
+        {
+            'Service': 'GetStacksToDelete',
+        },
+        1662327868000
+    )
+    validate_emf_record(record)
+    assert record['_aws']['CloudWatchMetrics'][0]['Dimensions'] == [['Service']]
+    assert record['StacksScanned'] == 15
+    assert record['PhaseDuration'] == 12.5
+
+
+def test_lambdas_cloudformation_stacks_run_metrics_emit(capsys):
+    import json
+    from cleaner.lambdas.cloudformation.stacks import RunMetrics
+    metrics = RunMetrics()
+    metrics.put('StacksScanned', 15)
+    metrics.put_phase_duration('evaluate_deletion_rules', 0.25)
+    metrics.put_stacks_matched_by_rule(
+        {
+            'time-to-live-hours': 3,
+            'branch-deleted': 0,
+        }
+    )
+    metrics.emit()
+    records = [
+        json.loads(line)
+        for line in capsys.readouterr().out.splitlines()
+    ]
+    assert len(records) == 4
+    for record in records:
+        validate_emf_record(record)
+    assert records[0]['StacksScanned'] == 15
+    assert records[1]['Phase'] == 'evaluate_deletion_rules'
+    assert records[1]['PhaseDuration'] == 250
+    assert [
+        (record['Rule'], record['StacksMatched'])
+        for record in records[2:]
+    ] == [
+        ('time-to-live-hours', 3),
+        ('branch-deleted', 0),
+    ]
+
+
+def test_lambdas_cloudformation_stacks_get_stack_inventory_and_messages(mocker):
+    import time
+    from cleaner.lambdas.cloudformation.stacks import get_stack_inventory_and_messages
+
+    def get_stack_inventory():
+        time.sleep(0.5)
+        return 'inventory'
+
+    def get_messages_from_delete_branch_queue(context):
+        time.sleep(0.5)
+        return ['message']
+
+    mocker.patch(
+        'cleaner.lambdas.cloudformation.stacks.get_stack_inventory',
+        get_stack_inventory
+    )
+    mocker.patch(
+        'cleaner.lambdas.cloudformation.stacks.get_messages_from_delete_branch_queue',
+        get_messages_from_delete_branch_queue
+    )
+    start = time.time()
+    assert get_stack_inventory_and_messages({}) == ('inventory', ['message'])
+    assert time.time() - start < 0.9
+
+
+def test_lambdas_cloudformation_stacks_group_messages_by_branch():
+    import json
+    from cleaner.lambdas.cloudformation.stacks import group_messages_by_branch
+    messages = [
+        {'Body': json.dumps({'branch': 'IGVF-1-abc'}), 'ReceiptHandle': '1'},
+        {'Body': json.dumps({'branch': 'dev'}), 'ReceiptHandle': '2'},
+        {'Body': json.dumps({'branch': 'IGVF-1-abc'}), 'ReceiptHandle': '3'},
+        {'Body': json.dumps({'branch': 'main'}), 'ReceiptHandle': '4'},
+    ]
+    messages_by_branch = group_messages_by_branch(messages)
+    assert list(messages_by_branch) == ['IGVF-1-abc']
+    assert [
+        message['ReceiptHandle']
+        for message in messages_by_branch['IGVF-1-abc']
+    ] == ['1', '3']
+
+
+def test_lambdas_cloudformation_stacks_time_to_live_hours_rule(stacks, mocker):
     import datetime
     from dateutil.tz import tzutc
-    from cleaner.lambdas.cloudformation.stacks import get_stacks_to_delete_because_of_time_to_live_hours_tag
+    from cleaner.lambdas.cloudformation.stacks import TimeToLiveHoursRule
     patched_current_time = mocker.patch(
-        'cleaner.lambdas.cloudformation.stacks.get_current_utc_time'
-    )
+        'cleaner.lambdas.cloudformation.stacks.get_current_utc_time')
     patched_current_time.return_value = datetime.datetime(
         2022, 9, 4, 21, 44, 28, 625000, tzinfo=tzutc()
     )
-    patched_stacks = mocker.patch(
-        'cleaner.lambdas.cloudformation.stacks.get_all_stacks'
+    rule = TimeToLiveHoursRule()
+    assert len([stack for stack in stacks if rule.matches(stack)]) == 5
+    patched_current_time.return_value = datetime.datetime(
+        2022, 8, 29, 21, 44, 28, 625000, tzinfo=tzutc()
     )
-    patched_stacks.return_value = raw_stacks
-    stacks_to_delete = get_stacks_to_delete_because_of_time_to_live_hours_tag()
-    assert len(stacks_to_delete) == 5
+    rule = TimeToLiveHoursRule()
+    assert not rule.matches(stacks[0])
+    assert not rule.matches(stacks[10])
 
 
-@mock_cloudformation
-def test_lambdas_cloudformation_stacks_get_stacks_to_delete_because_it_is_friday_night(aws_credentials, raw_stacks, mocker):
+def test_lambdas_cloudformation_stacks_make_time_to_live_hours_columns(stacks):
+    from cleaner.lambdas.cloudformation.stacks import make_time_to_live_hours_columns
+    creation_epochs, time_to_live_hours, valid = make_time_to_live_hours_columns(stacks)
+    assert len(creation_epochs) == len(time_to_live_hours) == len(valid) == 15
+    assert list(time_to_live_hours[:3]) == [72, 72, 72]
+    assert creation_epochs[0] == stacks[0].creation_time.timestamp()
+    assert list(valid[:3]) == [True, True, True]
+    assert list(valid[-5:]) == [False, False, False, False, False]
+
+
+def test_lambdas_cloudformation_stacks_time_to_live_hours_exceeded_batch():
+    from array import array
+    from cleaner.lambdas.cloudformation.stacks import time_to_live_hours_exceeded_batch
+    now_epoch = 1662327868.625
+    assert time_to_live_hours_exceeded_batch(
+        now_epoch,
+        array('d', [now_epoch - 3600 * 24, now_epoch - 3600 * 24 + 1, 0.0, now_epoch, now_epoch]),
+        array('d', [24, 24, 0, 0, -1]),
+        bytearray([True, True, False, True, True])
+    ) == [True, False, False, True, True]
+
+
+def test_lambdas_cloudformation_stacks_time_to_live_hours_rule_matches_batch(stacks, mocker, caplog):
     import datetime
-    from zoneinfo import ZoneInfo
-    from cleaner.lambdas.cloudformation.stacks import get_stacks_to_delete_because_it_is_friday_night
-    patched_stacks = mocker.patch(
-        'cleaner.lambdas.cloudformation.stacks.get_all_stacks')
-    patched_stacks.return_value = raw_stacks
-    stacks_to_delete = get_stacks_to_delete_because_it_is_friday_night()
-    assert len(stacks_to_delete) == 5
+    import logging
+    from dateutil.tz import tzutc
+    from cleaner.lambdas.cloudformation.stacks import TimeToLiveHoursRule
+    patched_current_time = mocker.patch(
+        'cleaner.lambdas.cloudformation.stacks.get_current_utc_time')
+    patched_current_time.return_value = datetime.datetime(
+        2022, 9, 4, 21, 44, 28, 625000, tzinfo=tzutc()
+    )
+    expected = [TimeToLiveHoursRule().matches(stack) for stack in stacks]
+    patched_current_time.reset_mock()
+    caplog.clear()
+    with caplog.at_level(logging.INFO, logger='cleaner.lambdas.cloudformation.stacks'):
+        rule = TimeToLiveHoursRule()
+        assert rule.matches_batch(stacks[:10]) + rule.matches_batch(stacks[10:]) == expected
+        rule.log_summary()
+    assert sum(expected) == 5
+    # One clock read and one log record for the whole run.
+    assert patched_current_time.call_count == 1
+    assert len(caplog.records) == 1
+    assert 'of 15 stacks' in caplog.records[0].getMessage()
+    assert '5 exceeded' in caplog.records[0].getMessage()
+    rule = TimeToLiveHoursRule(
+        datetime.datetime(2022, 8, 29, 21, 44, 28, 625000, tzinfo=tzutc())
+    )
+    patched_current_time.reset_mock()
+    assert not any(rule.matches_batch(stacks[:1]))
+    patched_current_time.assert_not_called()
 
 
-@mock_cloudformation
-def test_lambdas_cloudformation_stacks_maybe_get_stacks_to_delete_because_it_is_friday_night(aws_credentials, raw_stacks, mocker):
+def test_lambdas_cloudformation_stacks_deletion_rule_is_abstract():
+    from cleaner.lambdas.cloudformation.stacks import DeletionRule
+    with pytest.raises(TypeError):
+        DeletionRule()
+
+    class IncompleteRule(DeletionRule):
+        name = 'incomplete'
+
+    with pytest.raises(TypeError):
+        IncompleteRule()
+
+
+def test_lambdas_cloudformation_stacks_friday_night_rule(stacks):
+    from cleaner.lambdas.cloudformation.stacks import FridayNightRule
+    rule = FridayNightRule()
+    assert len([stack for stack in stacks if rule.matches(stack)]) == 5
+
+
+def test_lambdas_cloudformation_stacks_branch_deleted_rule(stacks):
+    from cleaner.lambdas.cloudformation.stacks import BranchDeletedRule
+    rule = BranchDeletedRule(
+        {
+            'IGVF-246-remove-uuid-as-unique-key-for-treatments',
+            'IGVF-999-no-stacks',
+        }
+    )
+    assert len([stack for stack in stacks if rule.matches(stack)]) == 5
+    assert list(rule.stacks_by_branch) == [
+        'IGVF-246-remove-uuid-as-unique-key-for-treatments'
+    ]
+    assert len(
+        rule.stacks_by_branch['IGVF-246-remove-uuid-as-unique-key-for-treatments']
+    ) == 5
+
+
+def test_lambdas_cloudformation_stacks_get_deletion_rules(mocker):
     import datetime
     from zoneinfo import ZoneInfo
-    from cleaner.lambdas.cloudformation.stacks import maybe_get_stacks_to_delete_because_it_is_friday_night
+    from cleaner.lambdas.cloudformation.stacks import get_deletion_rules
     patched_current_time = mocker.patch(
-        'cleaner.lambdas.cloudformation.stacks.get_current_pacific_time'
+        'cleaner.lambdas.cloudformation.stacks.get_current_utc_time'
     )
     patched_current_time.return_value = datetime.datetime(
         2022, 9, 4, 21, 44, 28, 625000, tzinfo=ZoneInfo('US/Pacific')
     )
-    patched_stacks = mocker.patch(
-        'cleaner.lambdas.cloudformation.stacks.get_all_stacks'
-    )
-    patched_stacks.return_value = raw_stacks
-    stacks_to_delete = maybe_get_stacks_to_delete_because_it_is_friday_night()
-    assert len(stacks_to_delete) == 0
+    assert [rule.name for rule in get_deletion_rules(set())] == [
+        'time-to-live-hours'
+    ]
     patched_current_time.return_value = datetime.datetime(
         2022, 9, 3, 6, 44, 28, 625000, tzinfo=ZoneInfo('US/Pacific')
     )
-    stacks_to_delete = maybe_get_stacks_to_delete_because_it_is_friday_night()
-    assert len(stacks_to_delete) == 5
+    rules = get_deletion_rules({'IGVF-1-abc'})
+    assert [rule.name for rule in rules] == [
+        'time-to-live-hours',
+        'friday-night',
+        'branch-deleted',
+    ]
+    # The clock is read once and shared by the rules.
+    assert patched_current_time.call_count == 2
+    assert rules[0].now == patched_current_time.return_value
 
 
-def test_lambdas_cloudformation_stacks_get_stack_names_from_stacks(raw_stacks):
-    from cleaner.lambdas.cloudformation.stacks import get_stack_names_from_stacks
-    assert get_stack_names_from_stacks(raw_stacks) == [
+def test_lambdas_cloudformation_stacks_evaluate_deletion_rules(stacks, mocker):
+    import datetime
+    from dateutil.tz import tzutc
+    from cleaner.lambdas.cloudformation.stacks import evaluate_deletion_rules
+    from cleaner.lambdas.cloudformation.stacks import TimeToLiveHoursRule
+    from cleaner.lambdas.cloudformation.stacks import FridayNightRule
+    from cleaner.lambdas.cloudformation.stacks import BranchDeletedRule
+    patched_current_time = mocker.patch(
+        'cleaner.lambdas.cloudformation.stacks.get_current_utc_time')
+    patched_current_time.return_value = datetime.datetime(
+        2022, 8, 29, 21, 44, 28, 625000, tzinfo=tzutc()
+    )
+    rules = [
+        TimeToLiveHoursRule(),
+        FridayNightRule(),
+        BranchDeletedRule(
+            {'IGVF-246-remove-uuid-as-unique-key-for-treatments'}
+        ),
+    ]
+    matched_rules_by_stack_name = evaluate_deletion_rules(stacks, rules)
+    assert list(matched_rules_by_stack_name) == [
         'igvf-ui-IGVF-246-remove-uuid-as-unique-key-for-treatments-DeployDevelopment-FrontendStack',
         'igvf-ui-IGVF-246-remove-uuid-as-unique-key-for-treatments-DemoDeploymentPipelineStack',
         'igvfd-IGVF-t-BackendStack',
         'igvfd-IGVF-246-remove-uuid-as-unique-key-for-treatments-DeployDevelopment-PostgresStack',
         'igvfd-IGVF-246-remove-uuid-as-unique-key-for-treatments-DemoDeploymentPipelineStack',
-        'ADemoCleaner',
-        'igvfd-dev-PipelineStack',
-        'igvf-ui-dev-FrontendStack',
-        'igvf-ui-dev-PipelineStack',
-        'igvfd-dev-BackendStack',
-        'igvfd-dev-PostgresStack',
-        'igvfd-dev-ContinuousIntegrationStack',
-        'ationStack',
-        'astack',
-        'cdet'
     ]
+    assert matched_rules_by_stack_name['igvfd-IGVF-t-BackendStack'] == [
+        'friday-night',
+        'branch-deleted',
+    ]
+    assert evaluate_deletion_rules(stacks, []) == {}
+    # Chunked evaluation gives the same result.
+    mocker.patch(
+        'cleaner.lambdas.cloudformation.stacks.EVALUATION_BATCH_SIZE',
+        2
+    )
+    assert evaluate_deletion_rules(
+        iter(stacks),
+        [
+            TimeToLiveHoursRule(),
+            FridayNightRule(),
+            BranchDeletedRule(
+                {'IGVF-246-remove-uuid-as-unique-key-for-treatments'}
+            ),
+        ]
+    ) == matched_rules_by_stack_name
+
+
+def test_lambdas_cloudformation_stacks_count_stacks_matched_by_rule():
+    from cleaner.lambdas.cloudformation.stacks import count_stacks_matched_by_rule
+    from cleaner.lambdas.cloudformation.stacks import TimeToLiveHoursRule
+    from cleaner.lambdas.cloudformation.stacks import FridayNightRule
+    from cleaner.lambdas.cloudformation.stacks import BranchDeletedRule
+    assert count_stacks_matched_by_rule(
+        {
+            'a': ['time-to-live-hours'],
+            'b': ['time-to-live-hours', 'friday-night'],
+        },
+        [
+            TimeToLiveHoursRule(),
+            FridayNightRule(),
+            BranchDeletedRule({}),
+        ]
+    ) == {
+        'time-to-live-hours': 2,
+        'friday-night': 1,
+        'branch-deleted': 0,
+    }
+
+
+def test_lambdas_cloudformation_stacks_delete_messages_for_branches_without_stacks(mocker):
+    import os
+    import json
+    from cleaner.lambdas.cloudformation.stacks import delete_messages_for_branches_without_stacks
+    mocker.patch.dict(os.environ, {'DELETE_BRANCH_QUEUE_URL': 'abc'})
+    patched_sqs_client = mocker.patch(
+        'cleaner.lambdas.cloudformation.stacks.get_sqs_client'
+    )
+    messages_by_branch = {
+        'IGVF-1-abc': [
+            {'Body': json.dumps({'branch': 'IGVF-1-abc'}), 'ReceiptHandle': '1'},
+        ],
+        'IGVF-2-xyz': [
+            {'Body': json.dumps({'branch': 'IGVF-2-xyz'}), 'ReceiptHandle': '2'},
+            {'Body': json.dumps({'branch': 'IGVF-2-xyz'}), 'ReceiptHandle': '3'},
+        ],
+    }
+    patched_sqs_client.return_value.delete_message_batch.return_value = {
+        'Successful': [{'Id': '0'}, {'Id': '1'}]
+    }
+    failed = delete_messages_for_branches_without_stacks(
+        messages_by_branch,
+        {'IGVF-1-abc': ['igvfd-IGVF-1-abc-BackendStack']}
+    )
+    assert failed == []
+    patched_sqs_client.return_value.delete_message_batch.assert_called_once_with(
+        QueueUrl='abc',
+        Entries=[
+            {'Id': '0', 'ReceiptHandle': '2'},
+            {'Id': '1', 'ReceiptHandle': '3'},
+        ]
+    )
+
+
+def test_lambdas_cloudformation_stacks_get_batches():
+    from cleaner.lambdas.cloudformation.stacks import get_batches
+    assert get_batches(list(range(23)), 10) == [
+        list(range(10)),
+        list(range(10, 20)),
+        list(range(20, 23)),
+    ]
+    assert get_batches([], 10) == []
+
+
+def test_lambdas_cloudformation_stacks_delete_message_batch_with_retries(mocker):
+    from cleaner.lambdas.cloudformation.stacks import delete_message_batch_with_retries
+    patched_sleep = mocker.patch('time.sleep')
+    client = mocker.MagicMock()
+    client.delete_message_batch.side_effect = [
+        {
+            'Successful': [{'Id': '0'}],
+            'Failed': [
+                {'Id': '1', 'SenderFault': False, 'Code': 'InternalError'},
+                {'Id': '2', 'SenderFault': True, 'Code': 'ReceiptHandleIsInvalid'},
+            ]
+        },
+        {
+            'Successful': [{'Id': '1'}],
+        },
+    ]
+    messages = [
+        {'ReceiptHandle': 'a'},
+        {'ReceiptHandle': 'b'},
+        {'ReceiptHandle': 'c'},
+    ]
+    failed = delete_message_batch_with_retries(client, 'abc', messages)
+    # The sender fault isn't resent but is still reported.
+    assert failed == [
+        {'Id': '2', 'SenderFault': True, 'Code': 'ReceiptHandleIsInvalid'}
+    ]
+    assert client.delete_message_batch.call_count == 2
+    # Only the server-side failure is retried.
+    assert client.delete_message_batch.call_args.kwargs['Entries'] == [
+        {'Id': '1', 'ReceiptHandle': 'b'}
+    ]
+    patched_sleep.assert_called_once_with(0.5)
+    client.delete_message_batch.side_effect = None
+    client.delete_message_batch.return_value = {
+        'Failed': [
+            {'Id': '0', 'SenderFault': False, 'Code': 'InternalError'},
+        ]
+    }
+    failed = delete_message_batch_with_retries(client, 'abc', messages[:1])
+    assert failed == [
+        {'Id': '0', 'SenderFault': False, 'Code': 'InternalError'}
+    ]
+    assert client.delete_message_batch.call_count == 5
+
+
+def test_lambdas_cloudformation_stacks_delete_message_batch_with_retries_keeps_permanent_failures(mocker):
+    from cleaner.lambdas.cloudformation.stacks import delete_message_batch_with_retries
+    mocker.patch('time.sleep')
+    client = mocker.MagicMock()
+    client.delete_message_batch.side_effect = [
+        {
+            'Failed': [
+                {'Id': '0', 'SenderFault': True, 'Code': 'ReceiptHandleIsInvalid'},
+                {'Id': '1', 'SenderFault': False, 'Code': 'InternalError'},
+                {'Id': '2', 'SenderFault': False, 'Code': 'InternalError'},
+            ]
+        },
+        {
+            'Successful': [{'Id': '1'}],
+            'Failed': [
+                {'Id': '2', 'SenderFault': False, 'Code': 'InternalError'},
+            ]
+        },
+        {
+            'Failed': [
+                {'Id': '2', 'SenderFault': False, 'Code': 'InternalError'},
+            ]
+        },
+    ]
+    messages = [
+        {'ReceiptHandle': 'a'},
+        {'ReceiptHandle': 'b'},
+        {'ReceiptHandle': 'c'},
+    ]
+    failed = delete_message_batch_with_retries(client, 'abc', messages)
+    assert failed == [
+        {'Id': '0', 'SenderFault': True, 'Code': 'ReceiptHandleIsInvalid'},
+        {'Id': '2', 'SenderFault': False, 'Code': 'InternalError'},
+    ]
+    assert client.delete_message_batch.call_count == 3
+
+
+@mock_sqs
+def test_lambdas_cloudformation_stacks_delete_messages_from_delete_branch_queue(aws_credentials, mocker):
+    import os
+    import boto3
+    from cleaner.lambdas.cloudformation.stacks import delete_messages_from_delete_branch_queue
+    client = boto3.client('sqs')
+    queue_url = client.create_queue(QueueName='abc')['QueueUrl']
+    mocker.patch.dict(os.environ, {'DELETE_BRANCH_QUEUE_URL': queue_url})
+    for i in range(12):
+        client.send_message(QueueUrl=queue_url, MessageBody=str(i))
+    messages = []
+    while len(messages) < 12:
+        messages.extend(
+            client.receive_message(
+                QueueUrl=queue_url,
+                MaxNumberOfMessages=10,
+            ).get('Messages', [])
+        )
+    assert delete_messages_from_delete_branch_queue(messages) == []
+    attributes = client.get_queue_attributes(
+        QueueUrl=queue_url,
+        AttributeNames=['All']
+    )['Attributes']
+    assert attributes['ApproximateNumberOfMessages'] == '0'
+    assert attributes['ApproximateNumberOfMessagesNotVisible'] == '0'
+
+
+def test_lambdas_cloudformation_stacks_make_stack_record_exports(raw_stacks):
+    from copy import deepcopy
+    from cleaner.lambdas.cloudformation.stacks import make_stack_record
+    stack = deepcopy(raw_stacks[3])
+    stack['Outputs'] = [
+        {
+            'OutputKey': 'DatabaseEndpoint',
+            'OutputValue': 'abc',
+            'ExportName': 'igvfd-IGVF-246-DatabaseEndpoint',
+        },
+        {
+            'OutputKey': 'NotExported',
+            'OutputValue': 'xyz',
+        },
+    ]
+    assert make_stack_record(stack).exports == [
+        'igvfd-IGVF-246-DatabaseEndpoint'
+    ]
+    assert make_stack_record(raw_stacks[0]).exports == []
+
+
+def test_lambdas_cloudformation_stacks_get_importing_stack_names(mocker):
+    from botocore.exceptions import ClientError
+    from cleaner.lambdas.cloudformation.stacks import get_importing_stack_names
+    client = mocker.MagicMock()
+    client.get_paginator.return_value.paginate.return_value = [
+        {'Imports': ['a', 'b']},
+        {'Imports': ['c']},
+    ]
+    assert get_importing_stack_names(client, 'export') == ['a', 'b', 'c']
+    client.get_paginator.assert_called_with('list_imports')
+    client.get_paginator.return_value.paginate.side_effect = ClientError(
+        {
+            'Error': {
+                'Code': 'ValidationError',
+                'Message': "Export 'export' is not imported by any stack."
+            }
+        },
+        'ListImports'
+    )
+    assert get_importing_stack_names(client, 'export') == []
+    client.get_paginator.return_value.paginate.side_effect = ClientError(
+        {'Error': {'Code': 'Throttling', 'Message': 'Rate exceeded'}},
+        'ListImports'
+    )
+    with pytest.raises(ClientError):
+        get_importing_stack_names(client, 'export')
+
+
+def test_lambdas_cloudformation_stacks_get_importers_by_stack_name(mocker):
+    from cleaner.lambdas.cloudformation.stacks import StackRecord
+    from cleaner.lambdas.cloudformation.stacks import get_importers_by_stack_name
+    mocker.patch('cleaner.lambdas.cloudformation.stacks.get_cloudformation_client')
+    imports = {
+        'postgres-endpoint': ['backend', 'dev-backend'],
+        'backend-url': ['frontend'],
+        'frontend-url': [],
+    }
+    mocker.patch(
+        'cleaner.lambdas.cloudformation.stacks.get_importing_stack_names',
+        lambda client, export_name: imports[export_name]
+    )
+    stacks = [
+        StackRecord('postgres', 'CREATE_COMPLETE', None, {}, ['postgres-endpoint']),
+        StackRecord('backend', 'CREATE_COMPLETE', None, {}, ['backend-url']),
+        StackRecord('frontend', 'CREATE_COMPLETE', None, {}, ['frontend-url']),
+    ]
+    assert get_importers_by_stack_name(stacks) == {
+        'postgres': {'backend'},
+        'backend': {'frontend'},
+        'frontend': set(),
+    }
+
+
+def test_lambdas_cloudformation_stacks_get_deletion_levels():
+    from cleaner.lambdas.cloudformation.stacks import get_deletion_levels
+    assert get_deletion_levels({}) == []
+    assert get_deletion_levels(
+        {
+            'postgres': {'backend'},
+            'backend': {'frontend'},
+            'frontend': set(),
+            'pipeline': set(),
+        }
+    ) == [
+        ['frontend', 'pipeline'],
+        ['backend'],
+        ['postgres'],
+    ]
+    assert get_deletion_levels(
+        {
+            'postgres': {'backend', 'frontend'},
+            'backend': {'frontend'},
+            'frontend': set(),
+        }
+    ) == [
+        ['frontend'],
+        ['backend'],
+        ['postgres'],
+    ]
+
+
+def test_lambdas_cloudformation_stacks_make_stacks_to_delete():
+    from cleaner.lambdas.cloudformation.stacks import StackRecord
+    from cleaner.lambdas.cloudformation.stacks import make_stacks_to_delete
+    stacks = [
+        StackRecord('backend', 'CREATE_COMPLETE', None, {}, stack_id='arn:backend'),
+        StackRecord('frontend', 'CREATE_COMPLETE', None, {}, stack_id='arn:frontend'),
+        StackRecord('other', 'CREATE_COMPLETE', None, {}, stack_id='arn:other'),
+    ]
+    assert make_stacks_to_delete([['frontend'], ['backend']], stacks) == [
+        [{'stack_to_delete': 'frontend', 'stack_id': 'arn:frontend'}],
+        [{'stack_to_delete': 'backend', 'stack_id': 'arn:backend'}],
+    ]
+    assert make_stacks_to_delete([], stacks) == []
+
+
+def test_lambdas_cloudformation_stacks_make_deletion_list_body():
+    import json
+    from cleaner.lambdas.cloudformation.stacks import make_deletion_list_body
+    body = make_deletion_list_body(
+        [
+            {'stack_to_delete': 'a', 'stack_id': 'arn:a'},
+            {'stack_to_delete': 'b', 'stack_id': 'arn:b'},
+        ]
+    )
+    assert [
+        json.loads(line)
+        for line in body.decode().splitlines()
+    ] == [
+        {'stack_to_delete': 'a', 'stack_id': 'arn:a'},
+        {'stack_to_delete': 'b', 'stack_id': 'arn:b'},
+    ]
+    assert make_deletion_list_body([]) == b''
+
+
+def test_lambdas_cloudformation_stacks_get_deletion_list_prefix(mocker):
+    from cleaner.lambdas.cloudformation.stacks import get_deletion_list_prefix
+    context = mocker.MagicMock()
+    context.aws_request_id = 'abc-123'
+    assert get_deletion_list_prefix(context) == 'deletion-lists/abc-123'
+    assert get_deletion_list_prefix({}).startswith('deletion-lists/')
+
+
+@mock_s3
+def test_lambdas_cloudformation_stacks_write_deletion_levels_to_bucket(aws_credentials):
+    import boto3
+    from cleaner.lambdas.cloudformation.stacks import write_deletion_levels_to_bucket
+    client = boto3.client('s3')
+    client.create_bucket(
+        Bucket='deletion-lists',
+        CreateBucketConfiguration={'LocationConstraint': 'us-west-1'}
+    )
+    keys = write_deletion_levels_to_bucket(
+        'deletion-lists',
+        'deletion-lists/abc',
+        [
+            [
+                {'stack_to_delete': 'frontend', 'stack_id': 'arn:frontend'},
+                {'stack_to_delete': 'pipeline', 'stack_id': 'arn:pipeline'},
+            ],
+            [
+                {'stack_to_delete': 'backend', 'stack_id': 'arn:backend'},
+            ],
+        ]
+    )
+    assert keys == [
+        'deletion-lists/abc/level-0.jsonl',
+        'deletion-lists/abc/level-1.jsonl',
+    ]
+    body = client.get_object(
+        Bucket='deletion-lists',
+        Key='deletion-lists/abc/level-0.jsonl'
+    )['Body'].read()
+    assert body == (
+        b'{"stack_to_delete": "frontend", "stack_id": "arn:frontend"}\n'
+        b'{"stack_to_delete": "pipeline", "stack_id": "arn:pipeline"}\n'
+    )
 
 
 @mock_cloudformation
 @mock_sqs
-def test_lambdas_cloudformation_stacks_get_stacks_to_delete(aws_credentials, raw_stacks, mocker):
+def test_lambdas_cloudformation_stacks_get_stacks_to_delete(aws_credentials, raw_stacks, mocker, capsys):
     import os
+    import json
     import datetime
     import boto3
     from dateutil.tz import tzutc
@@ -920,14 +1666,56 @@ def test_lambdas_cloudformation_stacks_get_stacks_to_delete(aws_credentials, raw
         'cleaner.lambdas.cloudformation.stacks.get_current_utc_time')
     patched_current_time.return_value = datetime.datetime(
         2022, 9, 4, 21, 44, 28, 625000, tzinfo=tzutc())
-    patched_stacks = mocker.patch(
-        'cleaner.lambdas.cloudformation.stacks.get_all_stacks')
-    patched_stacks.return_value = raw_stacks
-    stacks_to_delete = get_stacks_to_delete({}, {})
-    assert list(sorted(stacks_to_delete)) == list(sorted([
+    patched_pages = mocker.patch(
+        'cleaner.lambdas.cloudformation.stacks.get_describe_stacks_pages')
+    patched_pages.return_value = [
+        {'Stacks': raw_stacks[:10]},
+        {'Stacks': raw_stacks[10:]},
+    ]
+    mocker.patch('time.time', return_value=1662327868.625)
+    result = get_stacks_to_delete({}, {})
+    assert result['expires_at'] == 1662327868 + 7 * 24 * 60 * 60
+    deletion_levels = result['deletion_levels']
+    # Every routine shares one describe_stacks scan.
+    assert patched_pages.call_count == 1
+    # None of the stacks export anything, so they're deleted together.
+    assert len(deletion_levels) == 1
+    stack_ids_by_name = {
+        stack['StackName']: stack['StackId']
+        for stack in raw_stacks
+    }
+    for stack_to_delete in deletion_levels[0]:
+        assert stack_to_delete['stack_id'] == stack_ids_by_name[stack_to_delete['stack_to_delete']]
+    assert list(sorted(
+        stack_to_delete['stack_to_delete']
+        for stack_to_delete in deletion_levels[0]
+    )) == list(sorted([
         'igvfd-IGVF-t-BackendStack',
         'igvfd-IGVF-246-remove-uuid-as-unique-key-for-treatments-DemoDeploymentPipelineStack',
         'igvf-ui-IGVF-246-remove-uuid-as-unique-key-for-treatments-DemoDeploymentPipelineStack',
         'igvfd-IGVF-246-remove-uuid-as-unique-key-for-treatments-DeployDevelopment-PostgresStack',
         'igvf-ui-IGVF-246-remove-uuid-as-unique-key-for-treatments-DeployDevelopment-FrontendStack'
     ]))
+    records = [
+        json.loads(line)
+        for line in capsys.readouterr().out.splitlines()
+    ]
+    for record in records:
+        validate_emf_record(record)
+    assert records[0]['StacksScanned'] == 15
+    assert records[0]['InventoryPages'] == 2
+    assert records[0]['MessagesDrained'] == 0
+    assert records[0]['StacksToDelete'] == 5
+    assert records[0]['DeletionLevels'] == 1
+    assert {
+        record['Phase']
+        for record in records
+        if 'Phase' in record
+    } == {
+        'get_stack_inventory',
+        'get_messages_from_delete_branch_queue',
+        'evaluate_deletion_rules',
+        'delete_messages_for_branches_without_stacks',
+        'get_importers_by_stack_name',
+        'get_deletion_levels',
+    }
@@ -0,0 +1,133 @@
+import pytest
+
+import json
+
+
+@pytest.fixture
+def index(mocker):
+    import os
+    import boto3
+    mocker.patch.dict(
+        os.environ,
+        {
+            'AWS_DEFAULT_REGION': 'us-west-1',
+            'TABLE_NAME': 'abc',
+        }
+    )
+    from cleaner.lambdas.completion import index
+    mocker.patch.object(index, 'dynamodb_client')
+    # Keep real exception classes so except clauses still work.
+    sfn_client = boto3.client('stepfunctions', region_name='us-west-1')
+    patched_sfn_client = mocker.patch.object(index, 'sfn_client')
+    patched_sfn_client.exceptions = sfn_client.exceptions
+    return index
+
+
+def make_event(status, stack_name='igvfd-IGVF-1-abc-BackendStack'):
+    return {
+        'time': '2022-09-04T21:50:28Z',
+        'source': 'aws.cloudformation',
+        'detail-type': 'CloudFormation Stack Status Change',
+        'detail': {
+            'stack-id': f'arn:aws:cloudformation:us-west-2:654654139991:stack/{stack_name}/c1f10110-27e3-11ed-b366-0add85ad3a49',
+            'status-details': {
+                'status': status,
+                'status-reason': 'Export in use',
+            }
+        }
+    }
+
+
+def test_lambdas_completion_index_get_stack_name_from_stack_id(index):
+    assert index.get_stack_name_from_stack_id(
+        'arn:aws:cloudformation:us-west-2:654654139991:stack/igvfd-dev-BackendStack/c1f10110'
+    ) == 'igvfd-dev-BackendStack'
+
+
+def test_lambdas_completion_index_handler_sends_task_success(index):
+    index.dynamodb_client.get_item.return_value = {
+        'Item': {
+            'stack_name': {'S': 'igvfd-IGVF-1-abc-BackendStack'},
+            'task_token': {'S': 'token'},
+        }
+    }
+    index.handler(make_event('DELETE_COMPLETE'), {})
+    index.sfn_client.send_task_success.assert_called_once_with(
+        taskToken='token',
+        output=json.dumps(
+            {
+                'stack_to_delete': 'igvfd-IGVF-1-abc-BackendStack',
+                'status': 'DELETE_COMPLETE',
+            }
+        )
+    )
+    index.dynamodb_client.delete_item.assert_called_once_with(
+        TableName='abc',
+        Key={'stack_name': {'S': 'igvfd-IGVF-1-abc-BackendStack'}},
+    )
+
+
+def test_lambdas_completion_index_handler_sends_task_failure(index):
+    index.dynamodb_client.get_item.return_value = {
+        'Item': {
+            'stack_name': {'S': 'igvfd-IGVF-1-abc-BackendStack'},
+            'task_token': {'S': 'token'},
+        }
+    }
+    index.handler(make_event('DELETE_FAILED'), {})
+    index.sfn_client.send_task_failure.assert_called_once_with(
+        taskToken='token',
+        error='StackDeleteFailed',
+        cause='Export in use',
+    )
+    index.sfn_client.send_task_success.assert_not_called()
+
+
+def test_lambdas_completion_index_handler_skips_stacks_without_token(index):
+    index.dynamodb_client.get_item.return_value = {}
+    index.handler(make_event('DELETE_COMPLETE'), {})
+    index.sfn_client.send_task_success.assert_not_called()
+    index.dynamodb_client.delete_item.assert_not_called()
+
+
+def test_lambdas_completion_index_handler_ignores_expired_token(index):
+    index.dynamodb_client.get_item.return_value = {
+        'Item': {
+            'stack_name': {'S': 'igvfd-IGVF-1-abc-BackendStack'},
+            'task_token': {'S': 'token'},
+        }
+    }
+    index.sfn_client.send_task_success.side_effect = index.sfn_client.exceptions.TaskTimedOut(
+        {'Error': {'Code': 'TaskTimedOut', 'Message': 'Task timed out'}},
+        'SendTaskSuccess'
+    )
+    index.handler(make_event('DELETE_COMPLETE'), {})
+    index.dynamodb_client.delete_item.assert_called_once()
+
+
+def test_lambdas_completion_index_handler_emits_delete_latency(index, capsys):
+    index.dynamodb_client.get_item.return_value = {
+        'Item': {
+            'stack_name': {'S': 'igvfd-IGVF-1-abc-BackendStack'},
+            'task_token': {'S': 'token'},
+            'started_at': {'S': '2022-09-04T21:44:28.625Z'},
+        }
+    }
+    index.handler(make_event('DELETE_COMPLETE'), {})
+    records = [
+        json.loads(line)
+        for line in capsys.readouterr().out.splitlines()
+        if line.startswith('{')
+    ]
+    assert len(records) == 1
+    record = records[0]
+    directive = record['_aws']['CloudWatchMetrics'][0]
+    assert isinstance(record['_aws']['Timestamp'], int)
+    assert directive['Namespace'] == 'DemoCleaner'
+    assert directive['Metrics'] == [
+        {'Name': 'StackDeleteLatency', 'Unit': 'Milliseconds'}
+    ]
+    for dimension in directive['Dimensions'][0]:
+        assert dimension in record
+    assert record['Status'] == 'DELETE_COMPLETE'
+    assert record['StackDeleteLatency'] == 359375
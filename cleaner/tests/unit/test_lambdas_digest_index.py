@@ -0,0 +1,82 @@
+def make_result(stack, status, finished_at='2022-09-04T21:50:28.000Z', attempts=1):
+    return {
+        'stack': stack,
+        'status': status,
+        'attempts': attempts,
+        'started_at': '2022-09-04T21:44:28.000Z',
+        'finished_at': finished_at,
+    }
+
+
+def test_lambdas_digest_index_get_results():
+    from cleaner.lambdas.digest.index import get_results
+    assert get_results(
+        {
+            'results': [
+                [make_result('a', 'DELETE_SUCCEEDED')],
+                [],
+                [make_result('b', 'DELETE_FAILED')],
+            ]
+        }
+    ) == [
+        make_result('a', 'DELETE_SUCCEEDED'),
+        make_result('b', 'DELETE_FAILED'),
+    ]
+
+
+def test_lambdas_digest_index_make_digest_text():
+    from cleaner.lambdas.digest.index import make_digest_text
+    assert make_digest_text(
+        [
+            make_result('a', 'DELETE_SUCCEEDED', '2022-09-04T21:46:28.000Z'),
+            make_result('b', 'DELETE_SUCCEEDED', '2022-09-04T21:50:28.000Z'),
+            make_result('c', 'DELETE_SUCCEEDED', '2022-09-04T21:54:29.000Z'),
+        ]
+    ) == (
+        ':white_check_mark: *StackDeleteDigest* | 3 deleted, 0 failed\n'
+        'Deleted in 2m00s to 10m01s, median 6m00s'
+    )
+    text = make_digest_text(
+        [
+            make_result(f'stack-{i}', 'DELETE_FAILED', attempts=6)
+            for i in range(22)
+        ]
+    )
+    lines = text.split('\n')
+    assert lines[0] == ':x: *StackDeleteDigest* | 0 deleted, 22 failed'
+    assert lines[1] == ':x: stack-0 after 6 attempts'
+    assert len(lines) == 22
+    assert lines[-1] == '...and 2 more'
+
+
+def test_lambdas_digest_index_make_digest_text_with_skipped():
+    from cleaner.lambdas.digest.index import make_digest_text
+    assert make_digest_text(
+        [
+            make_result('a', 'DELETE_SUCCEEDED', '2022-09-04T21:46:28.000Z'),
+            {'stack': 'b', 'status': 'DELETE_SKIPPED', 'attempts': 2},
+        ]
+    ) == (
+        ':white_check_mark: *StackDeleteDigest* | 1 deleted, 0 failed, 1 left to another run\n'
+        'Deleted in 2m00s to 2m00s, median 2m00s'
+    )
+
+
+def test_lambdas_digest_index_handler():
+    from cleaner.lambdas.digest.index import handler
+    event = handler(
+        {
+            'results': [
+                [
+                    make_result('a', 'DELETE_SUCCEEDED'),
+                    make_result('b', 'DELETE_FAILED'),
+                ]
+            ]
+        },
+        {}
+    )
+    assert event['detailType'] == 'StackDeleteDigest'
+    assert event['detail']['metadata']['includes_slack_notification'] is True
+    assert event['detail']['data']['slack']['text'].startswith(
+        ':x: *StackDeleteDigest* | 1 deleted, 1 failed'
+    )
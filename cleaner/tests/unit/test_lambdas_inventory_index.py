@@ -0,0 +1,141 @@
+import pytest
+
+import datetime
+
+
+@pytest.fixture
+def index(mocker):
+    import os
+    import boto3
+    mocker.patch.dict(
+        os.environ,
+        {
+            'AWS_DEFAULT_REGION': 'us-west-1',
+            'TABLE_NAME': 'abc',
+        }
+    )
+    from cleaner.lambdas.inventory import index
+    # Keep real exception classes so except clauses still work.
+    dynamodb_client = boto3.client('dynamodb', region_name='us-west-1')
+    patched_dynamodb_client = mocker.patch.object(index, 'dynamodb_client')
+    patched_dynamodb_client.exceptions = dynamodb_client.exceptions
+    cloudformation_client = boto3.client('cloudformation', region_name='us-west-1')
+    patched_cloudformation_client = mocker.patch.object(index, 'cloudformation_client')
+    patched_cloudformation_client.exceptions = cloudformation_client.exceptions
+    return index
+
+
+STACK_ID = 'arn:aws:cloudformation:us-west-2:654654139991:stack/igvfd-IGVF-1-abc-BackendStack/c1f10110'
+
+
+def make_stack(stack_id=STACK_ID):
+    return {
+        'StackId': stack_id,
+        'StackName': stack_id.split('/')[1],
+        'StackStatus': 'CREATE_COMPLETE',
+        'CreationTime': datetime.datetime(2022, 9, 3, 19, 44, 28, 625000, tzinfo=datetime.timezone.utc),
+        'Tags': [
+            {'Key': 'time-to-live-hours', 'Value': '24'},
+        ],
+        'Outputs': [
+            {'OutputKey': 'Url', 'OutputValue': 'abc'},
+            {'OutputKey': 'Arn', 'OutputValue': 'abc', 'ExportName': 'igvfd-IGVF-1-abc:Arn'},
+        ],
+    }
+
+
+def make_event(status, time='2022-09-04T21:50:28Z'):
+    return {
+        'time': time,
+        'source': 'aws.cloudformation',
+        'detail-type': 'CloudFormation Stack Status Change',
+        'detail': {
+            'stack-id': STACK_ID,
+            'status-details': {
+                'status': status,
+            }
+        }
+    }
+
+
+def test_lambdas_inventory_index_make_stack_item(index, mocker):
+    mocker.patch('time.time', return_value=1662328228.5)
+    item = index.make_stack_item(make_stack(), 1662328228000)
+    assert item == {
+        'stack_id': {'S': STACK_ID},
+        'stack_name': {'S': 'igvfd-IGVF-1-abc-BackendStack'},
+        'status': {'S': 'CREATE_COMPLETE'},
+        'creation_time': {'S': '2022-09-03T19:44:28.625000+00:00'},
+        'tags': {'S': '{"time-to-live-hours": "24"}'},
+        'exports': {'S': '["igvfd-IGVF-1-abc:Arn"]'},
+        'shard': {'S': 'stacks'},
+        'updated_at': {'N': '1662328228500'},
+        'event_time': {'N': '1662328228000'},
+    }
+
+
+def test_lambdas_inventory_index_handler_puts_described_stack(index):
+    index.cloudformation_client.describe_stacks.return_value = {
+        'Stacks': [make_stack()]
+    }
+    index.handler(make_event('UPDATE_COMPLETE'), {})
+    index.cloudformation_client.describe_stacks.assert_called_once_with(
+        StackName=STACK_ID
+    )
+    kwargs = index.dynamodb_client.put_item.call_args[1]
+    assert kwargs['Item']['status'] == {'S': 'CREATE_COMPLETE'}
+    assert kwargs['Item']['event_time'] == {'N': '1662328228000'}
+    assert kwargs['ExpressionAttributeValues'] == {
+        ':event_time': {'N': '1662328228000'}
+    }
+
+
+def test_lambdas_inventory_index_handler_puts_tombstone(index):
+    index.handler(make_event('DELETE_COMPLETE'), {})
+    index.cloudformation_client.describe_stacks.assert_not_called()
+    item = index.dynamodb_client.put_item.call_args[1]['Item']
+    assert item['status'] == {'S': 'DELETE_COMPLETE'}
+    assert item['stack_name'] == {'S': 'igvfd-IGVF-1-abc-BackendStack'}
+    assert 'expires_at' in item
+
+
+def test_lambdas_inventory_index_handler_skips_stale_event(index):
+    index.cloudformation_client.describe_stacks.return_value = {
+        'Stacks': [make_stack()]
+    }
+    index.dynamodb_client.put_item.side_effect = index.dynamodb_client.exceptions.ConditionalCheckFailedException(
+        {'Error': {'Code': 'ConditionalCheckFailedException', 'Message': 'The conditional request failed'}},
+        'PutItem'
+    )
+    index.handler(make_event('UPDATE_COMPLETE'), {})
+    index.dynamodb_client.put_item.assert_called_once()
+
+
+def test_lambdas_inventory_index_handler_reconciles_on_schedule(index):
+    other_stack_id = STACK_ID.replace('IGVF-1-abc', 'IGVF-2-def')
+    gone_stack_id = STACK_ID.replace('IGVF-1-abc', 'IGVF-3-ghi')
+    index.dynamodb_client.get_paginator.return_value.paginate.return_value = [
+        {
+            'Items': [
+                {'stack_id': {'S': STACK_ID}, 'status': {'S': 'CREATE_COMPLETE'}},
+                {'stack_id': {'S': gone_stack_id}, 'status': {'S': 'CREATE_COMPLETE'}},
+                {'stack_id': {'S': 'deleted'}, 'status': {'S': 'DELETE_COMPLETE'}},
+            ]
+        }
+    ]
+    index.cloudformation_client.get_paginator.return_value.paginate.return_value = [
+        {'Stacks': [make_stack(), make_stack(other_stack_id)]}
+    ]
+    index.handler({'detail-type': 'Scheduled Event', 'detail': {}}, {})
+    items = [
+        call[1]['Item']
+        for call in index.dynamodb_client.put_item.call_args_list
+    ]
+    assert [
+        (item['stack_id']['S'], item['status']['S'])
+        for item in items
+    ] == [
+        (STACK_ID, 'CREATE_COMPLETE'),
+        (other_stack_id, 'CREATE_COMPLETE'),
+        (gone_stack_id, 'DELETE_COMPLETE'),
+    ]
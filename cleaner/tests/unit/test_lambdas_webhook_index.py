@@ -0,0 +1,158 @@
+import pytest
+
+import hashlib
+import hmac
+import json
+
+
+@pytest.fixture
+def index(mocker):
+    import os
+    mocker.patch.dict(
+        os.environ,
+        {
+            'AWS_DEFAULT_REGION': 'us-west-1',
+            'QUEUE_URL': 'abc',
+            'SECRET_ARN': 'arn',
+        }
+    )
+    from cleaner.lambdas.webhook import index
+    mocker.patch.object(index, 'sm_client')
+    mocker.patch.object(index, 'sqs_client')
+    index.sm_client.get_secret_value.return_value = {
+        'SecretString': json.dumps({'SECRET': 'abc123'})
+    }
+    mocker.patch.dict(
+        index.secret_cache,
+        {
+            'secret': None,
+            'fetched_at': 0.0,
+            'expires_at': 0.0,
+        }
+    )
+    return index
+
+
+def sign(secret, body):
+    return 'sha256=' + hmac.new(
+        secret.encode(),
+        body.encode(),
+        hashlib.sha256
+    ).hexdigest()
+
+
+def make_event(github_event, body, secret='abc123'):
+    return {
+        'headers': {
+            'x-github-event': github_event,
+            'x-hub-signature-256': sign(secret, body),
+        },
+        'body': body,
+    }
+
+
+def test_lambdas_webhook_index_verify_hmac(index):
+    body = json.dumps({'ref': 'IGVF-1-abc'})
+    assert index.verify_hmac('abc123', body.encode(), sign('abc123', body))
+    assert not index.verify_hmac('abc123', body.encode(), sign('xyz', body))
+
+
+def test_lambdas_webhook_index_get_payload_body(index):
+    import base64
+    body = json.dumps({'ref': 'IGVF-1-abc'})
+    assert index.get_payload_body({'body': body}) == body.encode()
+    assert index.get_payload_body(
+        {
+            'body': base64.b64encode(body.encode()).decode(),
+            'isBase64Encoded': True,
+        }
+    ) == body.encode()
+
+
+def test_lambdas_webhook_index_get_github_secret_is_cached(index, mocker):
+    patched_monotonic = mocker.patch('time.monotonic')
+    patched_monotonic.return_value = 1000.0
+    assert index.get_github_secret() == 'abc123'
+    assert index.get_github_secret() == 'abc123'
+    assert index.sm_client.get_secret_value.call_count == 1
+    patched_monotonic.return_value = 1000.0 + index.SECRET_CACHE_TTL_SECONDS
+    assert index.get_github_secret() == 'abc123'
+    assert index.sm_client.get_secret_value.call_count == 2
+    assert index.get_github_secret(force_refresh=True) == 'abc123'
+    assert index.sm_client.get_secret_value.call_count == 3
+
+
+def test_lambdas_webhook_index_handler_sends_branch_deleted_message(index):
+    body = json.dumps({'ref': 'IGVF-1-abc', 'ref_type': 'branch'})
+    response = index.handler(make_event('delete', body), {})
+    assert response['statusCode'] == 200
+    index.sqs_client.send_message.assert_called_once_with(
+        QueueUrl='abc',
+        MessageBody=json.dumps(
+            {
+                'event': 'BRANCH_DELETED',
+                'branch': 'IGVF-1-abc',
+            }
+        )
+    )
+    index.handler(make_event('delete', body), {})
+    assert index.sm_client.get_secret_value.call_count == 1
+
+
+def test_lambdas_webhook_index_handler_accepts_base64_body(index):
+    import base64
+    body = json.dumps({'ref': 'IGVF-1-abc', 'ref_type': 'branch'})
+    event = make_event('delete', body)
+    event['body'] = base64.b64encode(body.encode()).decode()
+    event['isBase64Encoded'] = True
+    response = index.handler(event, {})
+    assert response['statusCode'] == 200
+    index.sqs_client.send_message.assert_called_once()
+
+
+def test_lambdas_webhook_index_handler_ignores_events_without_fetching_secret(index):
+    body = json.dumps({'ref': 'IGVF-1-abc'})
+    # Body of ignored events isn't parsed.
+    response = index.handler(make_event('push', 'not json'), {})
+    assert response['statusCode'] == 202
+    response = index.handler(make_event('delete', json.dumps({'ref_type': 'tag'})), {})
+    assert response['statusCode'] == 202
+    event = make_event('delete', body)
+    del event['headers']['x-hub-signature-256']
+    assert index.handler(event, {})['statusCode'] == 401
+    index.sm_client.get_secret_value.assert_not_called()
+    index.sqs_client.send_message.assert_not_called()
+
+
+def test_lambdas_webhook_index_handler_refreshes_rotated_secret(index, mocker):
+    patched_monotonic = mocker.patch('time.monotonic')
+    patched_monotonic.return_value = 1000.0
+    body = json.dumps({'ref': 'IGVF-1-abc', 'ref_type': 'branch'})
+    index.handler(make_event('delete', body), {})
+    index.sm_client.get_secret_value.return_value = {
+        'SecretString': json.dumps({'SECRET': 'rotated'})
+    }
+    patched_monotonic.return_value = 1000.0 + index.SECRET_MIN_REFRESH_SECONDS
+    response = index.handler(make_event('delete', body, 'rotated'), {})
+    assert response['statusCode'] == 200
+    assert index.sm_client.get_secret_value.call_count == 2
+    response = index.handler(make_event('delete', body, 'wrong'), {})
+    assert response['statusCode'] == 403
+    assert index.sqs_client.send_message.call_count == 2
+    assert index.sm_client.get_secret_value.call_count == 2
+
+
+def test_lambdas_webhook_index_handler_limits_refreshes_on_invalid_signatures(index, mocker):
+    patched_monotonic = mocker.patch('time.monotonic')
+    patched_monotonic.return_value = 1000.0
+    body = json.dumps({'ref': 'IGVF-1-abc', 'ref_type': 'branch'})
+    for i in range(5):
+        response = index.handler(make_event('delete', body, 'wrong'), {})
+        assert response['statusCode'] == 403
+    # Only the initial fetch.
+    assert index.sm_client.get_secret_value.call_count == 1
+    patched_monotonic.return_value = 1000.0 + index.SECRET_MIN_REFRESH_SECONDS
+    for i in range(5):
+        index.handler(make_event('delete', body, 'wrong'), {})
+    assert index.sm_client.get_secret_value.call_count == 2
+    index.sqs_client.send_message.assert_not_called()
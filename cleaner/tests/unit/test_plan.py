@@ -0,0 +1,220 @@
+import pytest
+
+import json
+
+
+def make_dump_stack(name, creation_time, tags, status='CREATE_COMPLETE'):
+    return {
+        'StackId': f'arn:aws:cloudformation:us-west-2:654654139991:stack/{name}/c1f10110',
+        'StackName': name,
+        'CreationTime': creation_time,
+        'StackStatus': status,
+        'Tags': [
+            {
+                'Key': key,
+                'Value': value,
+            }
+            for key, value in tags.items()
+        ],
+    }
+
+
+@pytest.fixture
+def dump():
+    return {
+        'Stacks': [
+            make_dump_stack(
+                'igvfd-IGVF-1-abc-BackendStack',
+                '2022-09-03T19:44:28.625000+00:00',
+                {
+                    'time-to-live-hours': '24',
+                    'branch': 'IGVF-1-abc',
+                }
+            ),
+            make_dump_stack(
+                'igvfd-IGVF-2-def-BackendStack',
+                '2022-09-04T19:44:28.625000+00:00',
+                {
+                    'time-to-live-hours': '24',
+                    'branch': 'IGVF-2-def',
+                }
+            ),
+            make_dump_stack(
+                'igvfd-IGVF-3-ghi-BackendStack',
+                '2022-09-03T19:44:28.625000+00:00',
+                {
+                    'time-to-live-hours': '24',
+                    'branch': 'IGVF-3-ghi',
+                },
+                status='DELETE_IN_PROGRESS'
+            ),
+            make_dump_stack(
+                'igvfd-dev-BackendStack',
+                '2022-09-01T19:44:28Z',
+                {
+                    'branch': 'dev',
+                }
+            ),
+        ]
+    }
+
+
+def test_plan_iter_json_array_items(dump):
+    import io
+    from cleaner.plan import iter_json_array_items
+    text = json.dumps(dump, indent=4)
+    # Small chunks split items across reads.
+    for chunk_size in [7, 64, 1 << 16]:
+        assert list(
+            iter_json_array_items(io.StringIO(text), chunk_size=chunk_size)
+        ) == dump['Stacks']
+    assert list(
+        iter_json_array_items(io.StringIO(json.dumps(dump['Stacks'])))
+    ) == dump['Stacks']
+    assert list(iter_json_array_items(io.StringIO('{"Stacks": []}'))) == []
+    with pytest.raises(ValueError):
+        list(iter_json_array_items(io.StringIO('{"Stacks": [{"StackName": "a"}')))
+
+
+def test_plan_make_plan(dump):
+    import io
+    from cleaner.plan import iter_stack_records
+    from cleaner.plan import make_branch_message
+    from cleaner.plan import make_plan
+    from cleaner.plan import parse_timestamp
+    plan = make_plan(
+        iter_stack_records(io.StringIO(json.dumps(dump))),
+        [
+            make_branch_message('IGVF-2-def'),
+            make_branch_message('IGVF-9-xyz'),
+            make_branch_message('dev'),
+        ],
+        parse_timestamp('2022-09-04T21:44:28Z')
+    )
+    assert plan['stacks_scanned'] == 4
+    assert plan['rules'] == ['time-to-live-hours', 'branch-deleted']
+    assert plan['stacks_to_delete'] == {
+        'igvfd-IGVF-1-abc-BackendStack': ['time-to-live-hours'],
+        'igvfd-IGVF-2-def-BackendStack': ['branch-deleted'],
+    }
+    assert plan['branches_without_stacks'] == ['IGVF-9-xyz']
+
+
+def test_plan_make_plan_on_friday_night(dump):
+    import io
+    from cleaner.plan import iter_stack_records
+    from cleaner.plan import make_plan
+    from cleaner.plan import parse_timestamp
+    # Saturday 03:00 in Los Angeles.
+    plan = make_plan(
+        iter_stack_records(io.StringIO(json.dumps(dump))),
+        [],
+        parse_timestamp('2022-09-03T10:00:00Z')
+    )
+    assert plan['rules'] == ['time-to-live-hours', 'friday-night']
+
+
+def test_plan_parse_now():
+    import argparse
+    import datetime
+    from cleaner.plan import parse_now
+    assert parse_now('2022-09-04T21:44:28Z') == datetime.datetime(
+        2022, 9, 4, 21, 44, 28, tzinfo=datetime.timezone.utc
+    )
+    assert parse_now('2022-09-04T14:44:28-07:00').utcoffset() == datetime.timedelta(hours=-7)
+    with pytest.raises(argparse.ArgumentTypeError):
+        parse_now('2022-09-04T21:44:28')
+
+
+def test_plan_main_rejects_now_without_offset(dump, tmp_path):
+    stacks_path = tmp_path / 'stacks.json'
+    stacks_path.write_text(json.dumps(dump))
+    from cleaner.plan import main
+    with pytest.raises(SystemExit):
+        main([str(stacks_path), '--now', '2022-09-04T21:44:28'])
+
+
+def test_plan_main(dump, tmp_path, mocker):
+    import io
+    stacks_path = tmp_path / 'stacks.json'
+    stacks_path.write_text(json.dumps(dump))
+    messages_path = tmp_path / 'messages.json'
+    messages_path.write_text(
+        json.dumps(
+            {
+                'Messages': [
+                    {
+                        'Body': json.dumps({'branch': 'IGVF-2-def'}),
+                        'ReceiptHandle': 'abc',
+                    }
+                ]
+            }
+        )
+    )
+    # No AWS calls are made while planning.
+    patched_client = mocker.patch('boto3.client')
+    from cleaner.plan import main
+    stdout = io.StringIO()
+    main(
+        [
+            str(stacks_path),
+            '--messages',
+            str(messages_path),
+            '--now',
+            '2022-09-04T21:44:28Z',
+        ],
+        stdout=stdout
+    )
+    patched_client.assert_not_called()
+    lines = stdout.getvalue().splitlines()
+    assert lines[:-1] == [
+        'Plan at 2022-09-04T21:44:28+00:00 with rules time-to-live-hours, branch-deleted',
+        'delete igvfd-IGVF-1-abc-BackendStack (time-to-live-hours)',
+        'delete igvfd-IGVF-2-def-BackendStack (branch-deleted)',
+    ]
+    assert lines[-1].startswith('2 of 4 stacks would be deleted')
+    stdout = io.StringIO()
+    main(
+        [
+            str(stacks_path),
+            '--branch',
+            'IGVF-9-xyz',
+            '--now',
+            '2022-09-04T21:44:28Z',
+            '--json',
+        ],
+        stdout=stdout
+    )
+    assert json.loads(stdout.getvalue())['branches_without_stacks'] == ['IGVF-9-xyz']
+
+
+def test_plan_streams_large_inventory():
+    import io
+    from cleaner.plan import iter_stack_records
+    from cleaner.plan import make_plan
+    from cleaner.plan import parse_timestamp
+    dump = {
+        'Stacks': [
+            make_dump_stack(
+                f'igvfd-IGVF-{i}-abc-BackendStack',
+                '2022-09-03T19:44:28.625000+00:00',
+                {
+                    'time-to-live-hours': str(i % 48),
+                    'branch': f'IGVF-{i}-abc',
+                }
+            )
+            for i in range(10000)
+        ]
+    }
+    plan = make_plan(
+        iter_stack_records(io.StringIO(json.dumps(dump))),
+        [],
+        parse_timestamp('2022-09-04T21:44:28Z')
+    )
+    assert plan['stacks_scanned'] == 10000
+    # Alive 25 full hours, so TTLs 0-25 of every 48 match.
+    assert len(plan['stacks_to_delete']) == sum(
+        1
+        for i in range(10000)
+        if i % 48 <= 25
+    )
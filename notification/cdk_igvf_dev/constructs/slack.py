@@ -1,3 +1,4 @@
+from aws_cdk import Duration
 from aws_cdk import SecretValue
 
 from constructs import Construct
@@ -8,14 +9,41 @@ from aws_cdk.aws_events import EventPattern
 from aws_cdk.aws_events import Connection
 from aws_cdk.aws_events import Authorization
 from aws_cdk.aws_events import ApiDestination
+from aws_cdk.aws_events import EventBus
 
 from aws_cdk.aws_events_targets import ApiDestination as ApiDestinationToTarget
+from aws_cdk.aws_events_targets import SqsQueue
 
-from aws_cdk.aws_ssm import StringParameter
+from aws_cdk.aws_lambda_event_sources import SqsEventSource
+
+from aws_cdk.aws_lambda import Code
+from aws_cdk.aws_lambda import Function
+from aws_cdk.aws_lambda import Runtime
 
-from dataclasses import dataclass
+from aws_cdk.aws_sqs import DeadLetterQueue
+from aws_cdk.aws_sqs import Queue
+
+from aws_cdk.aws_ssm import StringParameter
 
 from typing import Any
+from typing import Dict
+
+
+SLACK_WEBHOOK_URL_PARAMETER_NAME = 'SLACK_WEBHOOK_URL_FOR_AWS_IGVF_DEV_CHANNEL'
+
+# Slack accepts about one message per second per incoming webhook.
+DEFAULT_RATE_LIMIT_PER_SECOND = 1
+
+# EventBridge maximums, so bursts wait out throttling instead of
+# being dropped.
+DEFAULT_RETRY_ATTEMPTS = 185
+
+DEFAULT_MAX_EVENT_AGE = Duration.hours(24)
+
+# Lambda can wait at most five minutes to fill an SQS batch.
+DEFAULT_AGGREGATION_WINDOW = Duration.minutes(1)
+
+AGGREGATION_BATCH_SIZE = 1000
 
 
 class SlackWebhook(Construct):
@@ -24,6 +52,10 @@ class SlackWebhook(Construct):
             self,
             scope: Construct,
             construct_id: str,
+            rate_limit_per_second: int = DEFAULT_RATE_LIMIT_PER_SECOND,
+            retry_attempts: int = DEFAULT_RETRY_ATTEMPTS,
+            max_event_age: Duration = DEFAULT_MAX_EVENT_AGE,
+            aggregated: bool = False,
             **kwargs: Any
     ) -> None:
         super().__init__(scope, construct_id, **kwargs)
@@ -41,33 +73,136 @@ class SlackWebhook(Construct):
         endpoint = StringParameter.from_string_parameter_name(
             self,
             'SlackWebhookUrl',
-            string_parameter_name='SLACK_WEBHOOK_URL_FOR_AWS_IGVF_DEV_CHANNEL'
+            string_parameter_name=SLACK_WEBHOOK_URL_PARAMETER_NAME
         )
         api_destination = ApiDestination(
             self,
             'SlackIncomingWebhookDestination',
             connection=connection,
             endpoint=endpoint.string_value,
+            rate_limit_per_second=rate_limit_per_second,
+        )
+        # Events that still can't be delivered after retries end up here
+        # and can be replayed with the replay function.
+        self.dead_letter_queue = Queue(
+            self,
+            'DeadLetterQueue',
+            retention_period=Duration.days(14),
         )
         # $.detail.data.slack value from event is posted to Slack webhook if
         # $.detail.metadata.includes_slack_notification is True.
+        metadata: Dict[str, Any] = {
+            'includes_slack_notification': [True]
+        }
+        if aggregated:
+            # Only merged events from SlackNotificationAggregator.
+            metadata['aggregated'] = [True]
         target = ApiDestinationToTarget(
             api_destination=api_destination,
             event=RuleTargetInput.from_event_path(
                 '$.detail.data.slack'
-            )
+            ),
+            dead_letter_queue=self.dead_letter_queue,
+            retry_attempts=retry_attempts,
+            max_event_age=max_event_age,
         )
         rule = Rule(
             self,
             'PassEventsToSlack',
+            event_pattern=EventPattern(
+                detail={
+                    'metadata': metadata
+                }
+            ),
+            targets=[
+                target
+            ]
+        )
+        # Invoke manually once Slack is reachable again:
+        # aws lambda invoke --function-name <name> /dev/stdout
+        self.replay_function = Function(
+            self,
+            'ReplayDeadLetterQueue',
+            runtime=Runtime.PYTHON_3_9,
+            handler='index.handler',
+            code=Code.from_asset(
+                'cdk_igvf_dev/lambdas/replay',
+                exclude=['__pycache__'],
+            ),
+            timeout=Duration.minutes(5),
+            environment={
+                'QUEUE_URL': self.dead_letter_queue.queue_url,
+                'WEBHOOK_URL_PARAMETER_NAME': SLACK_WEBHOOK_URL_PARAMETER_NAME,
+                'RATE_LIMIT_PER_SECOND': str(rate_limit_per_second),
+            }
+        )
+        self.dead_letter_queue.grant_consume_messages(
+            self.replay_function
+        )
+        endpoint.grant_read(
+            self.replay_function
+        )
+
+
+class SlackNotificationAggregator(Construct):
+
+    def __init__(
+            self,
+            scope: Construct,
+            construct_id: str,
+            dead_letter_queue: Queue,
+            window: Duration = DEFAULT_AGGREGATION_WINDOW,
+            **kwargs: Any
+    ) -> None:
+        super().__init__(scope, construct_id, **kwargs)
+        # Notifications wait here for up to window before being merged.
+        # Batches that keep failing go to the webhook's dead-letter queue,
+        # which holds the same event bodies and can be replayed.
+        self.buffer_queue = Queue(
+            self,
+            'BufferQueue',
+            visibility_timeout=Duration.minutes(10),
+            dead_letter_queue=DeadLetterQueue(
+                max_receive_count=3,
+                queue=dead_letter_queue,
+            )
+        )
+        rule = Rule(
+            self,
+            'BufferSlackNotifications',
             event_pattern=EventPattern(
                 detail={
                     'metadata': {
-                        'includes_slack_notification': [True]
+                        'includes_slack_notification': [True],
+                        'aggregated': [{'exists': False}],
                     }
                 }
             ),
             targets=[
-                target
+                SqsQueue(
+                    self.buffer_queue
+                )
             ]
         )
+        self.aggregate_function = Function(
+            self,
+            'AggregateSlackNotifications',
+            runtime=Runtime.PYTHON_3_9,
+            handler='index.handler',
+            code=Code.from_asset(
+                'cdk_igvf_dev/lambdas/aggregator',
+                exclude=['__pycache__'],
+            ),
+            timeout=Duration.minutes(1),
+        )
+        self.aggregate_function.add_event_source(
+            SqsEventSource(
+                self.buffer_queue,
+                batch_size=AGGREGATION_BATCH_SIZE,
+                max_batching_window=window,
+                report_batch_item_failures=True,
+            )
+        )
+        EventBus.grant_all_put_events(
+            self.aggregate_function
+        )
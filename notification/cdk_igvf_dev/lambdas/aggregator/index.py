@@ -0,0 +1,208 @@
+import json
+
+import os
+
+import boto3
+
+from botocore.exceptions import ClientError
+
+from typing import Any
+from typing import Dict
+from typing import List
+from typing import Optional
+from typing import Tuple
+
+
+events_client = boto3.client('events')
+
+EVENT_BUS_NAME = os.environ.get('EVENT_BUS_NAME', 'default')
+
+# Merged events come from here and carry detail.metadata.aggregated so
+# the buffer rule doesn't pick them up again.
+AGGREGATED_SOURCE = 'igvf-dev.notification.aggregator'
+
+# Slack truncates longer message text.
+MAX_TEXT_LENGTH = 3500
+
+PUT_EVENTS_BATCH_SIZE = 10
+
+
+def parse_record_or_none(record: Dict[str, Any]) -> Optional[Tuple[str, str, Dict[str, Any]]]:
+    # EventBridge puts the whole event in the SQS message body.
+    try:
+        event = json.loads(record['body'])
+        return (
+            event['detail-type'],
+            event['source'],
+            event['detail']['data']['slack'],
+        )
+    except (KeyError, TypeError, ValueError) as error:
+        print('Failed to parse message', record['messageId'], repr(error))
+        return None
+
+
+def get_events(
+        records: List[Dict[str, Any]]
+) -> Tuple[List[Tuple[str, Tuple[str, str, Dict[str, Any]]]], List[str]]:
+    # Returns parsed events and the message ids of records that couldn't
+    # be parsed, so one bad record doesn't fail the whole batch.
+    events: List[Tuple[str, Tuple[str, str, Dict[str, Any]]]] = []
+    unparsed_message_ids: List[str] = []
+    for record in records:
+        parsed = parse_record_or_none(record)
+        if parsed is None:
+            unparsed_message_ids.append(record['messageId'])
+        else:
+            events.append((record['messageId'], parsed))
+    return events, unparsed_message_ids
+
+
+def group_events(
+        events: List[Tuple[str, Tuple[str, str, Dict[str, Any]]]]
+) -> Dict[Tuple[str, str], Tuple[List[str], List[Dict[str, Any]]]]:
+    # Message ids and Slack payloads by (detail-type, source).
+    groups: Dict[Tuple[str, str], Tuple[List[str], List[Dict[str, Any]]]] = {}
+    for message_id, (detail_type, source, slack) in events:
+        message_ids, payloads = groups.setdefault((detail_type, source), ([], []))
+        message_ids.append(message_id)
+        payloads.append(slack)
+    return groups
+
+
+def count_identical_payloads(payloads: List[Dict[str, Any]]) -> List[Tuple[Dict[str, Any], int]]:
+    # Keeps first-seen order.
+    counts: Dict[str, int] = {}
+    for payload in payloads:
+        key = json.dumps(payload, sort_keys=True)
+        counts[key] = counts.get(key, 0) + 1
+    return [
+        (json.loads(key), count)
+        for key, count in counts.items()
+    ]
+
+
+def is_text_only(payload: Dict[str, Any]) -> bool:
+    return list(payload) == ['text']
+
+
+def format_line(text: str, count: int) -> str:
+    if count == 1:
+        return text
+    return f'{text} (x{count})'
+
+
+def split_lines(lines: List[str], max_length: int = MAX_TEXT_LENGTH) -> List[List[str]]:
+    chunks: List[List[str]] = []
+    chunk: List[str] = []
+    length = 0
+    for line in lines:
+        if chunk and length + len(line) + 1 > max_length:
+            chunks.append(chunk)
+            chunk = []
+            length = 0
+        chunk.append(line)
+        length += len(line) + 1
+    if chunk:
+        chunks.append(chunk)
+    return chunks
+
+
+def make_texts(detail_type: str, source: str, payloads: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    counted = count_identical_payloads(payloads)
+    texts = [
+        (payload['text'], count)
+        for payload, count in counted
+        if is_text_only(payload)
+    ]
+    # Blocks and attachments can't be merged, so each distinct one
+    # goes out as it is.
+    others = [
+        payload
+        for payload, count in counted
+        if not is_text_only(payload)
+    ]
+    if len(texts) == 1 and texts[0][1] == 1:
+        return [{'text': texts[0][0]}] + others
+    messages: List[Dict[str, Any]] = []
+    lines = [
+        format_line(text, count)
+        for text, count in texts
+    ]
+    for chunk in split_lines(lines):
+        header = f'*{detail_type}* from {source}: {len(payloads)} notifications'
+        messages.append(
+            {
+                'text': '\n'.join([header] + chunk)
+            }
+        )
+    return messages + others
+
+
+def make_aggregated_event(detail_type: str, slack: Dict[str, Any]) -> Dict[str, Any]:
+    return {
+        'EventBusName': EVENT_BUS_NAME,
+        'Source': AGGREGATED_SOURCE,
+        'DetailType': detail_type,
+        'Detail': json.dumps(
+            {
+                'metadata': {
+                    'includes_slack_notification': True,
+                    'aggregated': True,
+                },
+                'data': {
+                    'slack': slack,
+                },
+            }
+        ),
+    }
+
+
+def make_entries(
+        groups: Dict[Tuple[str, str], Tuple[List[str], List[Dict[str, Any]]]]
+) -> List[Tuple[List[str], Dict[str, Any]]]:
+    # Each aggregated event keeps the message ids of its whole group.
+    return [
+        (message_ids, make_aggregated_event(detail_type, slack))
+        for (detail_type, source), (message_ids, payloads) in groups.items()
+        for slack in make_texts(detail_type, source, payloads)
+    ]
+
+
+def put_events(entries: List[Tuple[List[str], Dict[str, Any]]]) -> List[str]:
+    # Returns the message ids of groups with an event that wasn't put,
+    # so only those are retried instead of the whole SQS batch.
+    failed_message_ids: Dict[str, None] = {}
+    for i in range(0, len(entries), PUT_EVENTS_BATCH_SIZE):
+        batch = entries[i:i + PUT_EVENTS_BATCH_SIZE]
+        try:
+            response = events_client.put_events(
+                Entries=[event for _, event in batch]
+            )
+            results = response['Entries']
+        except ClientError as error:
+            print('Failed to put events', error)
+            results = [{'ErrorCode': 'ClientError'}] * len(batch)
+        for (message_ids, _), result in zip(batch, results):
+            if 'ErrorCode' in result:
+                print('Failed to put event', result)
+                failed_message_ids.update(dict.fromkeys(message_ids))
+    return list(failed_message_ids)
+
+
+def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
+    events, unparsed_message_ids = get_events(event['Records'])
+    entries = make_entries(group_events(events))
+    failed_message_ids = unparsed_message_ids + put_events(entries)
+    print(
+        f'Aggregated {len(events)} notifications into {len(entries)}, '
+        f'{len(failed_message_ids)} notifications to retry'
+    )
+    # Failed messages go back to the buffer queue and, after repeated
+    # failures, to the dead-letter queue. Unparsable ones end up there
+    # too, where the alarm surfaces them.
+    return {
+        'batchItemFailures': [
+            {'itemIdentifier': message_id}
+            for message_id in failed_message_ids
+        ]
+    }
@@ -0,0 +1,108 @@
+import json
+
+import os
+
+import time
+
+import urllib.error
+
+import urllib.request
+
+import boto3
+
+from typing import Any
+from typing import Dict
+from typing import List
+
+
+sqs_client = boto3.client('sqs')
+
+ssm_client = boto3.client('ssm')
+
+QUEUE_URL = os.environ['QUEUE_URL']
+
+WEBHOOK_URL_PARAMETER_NAME = os.environ['WEBHOOK_URL_PARAMETER_NAME']
+
+RATE_LIMIT_PER_SECOND = float(
+    os.environ.get('RATE_LIMIT_PER_SECOND', '1')
+)
+
+# Stop receiving with enough time left to finish the current batch.
+MINIMUM_REMAINING_TIME_MILLIS = 30000
+
+
+def get_webhook_url() -> str:
+    webhook_url: str = ssm_client.get_parameter(
+        Name=WEBHOOK_URL_PARAMETER_NAME
+    )['Parameter']['Value']
+    return webhook_url
+
+
+def receive_messages() -> List[Dict[str, Any]]:
+    messages: List[Dict[str, Any]] = sqs_client.receive_message(
+        QueueUrl=QUEUE_URL,
+        MaxNumberOfMessages=10,
+        WaitTimeSeconds=1,
+    ).get('Messages', [])
+    return messages
+
+
+def delete_message(message: Dict[str, Any]) -> None:
+    sqs_client.delete_message(
+        QueueUrl=QUEUE_URL,
+        ReceiptHandle=message['ReceiptHandle'],
+    )
+
+
+def get_slack_payload(message: Dict[str, Any]) -> Dict[str, Any]:
+    # EventBridge puts the original event in the body, so this is the
+    # same $.detail.data.slack the rule posts.
+    payload: Dict[str, Any] = json.loads(message['Body'])['detail']['data']['slack']
+    return payload
+
+
+def post_to_slack(webhook_url: str, payload: Dict[str, Any]) -> int:
+    request = urllib.request.Request(
+        webhook_url,
+        data=json.dumps(payload).encode('utf-8'),
+        headers={
+            'Content-Type': 'application/json',
+        },
+        method='POST',
+    )
+    with urllib.request.urlopen(request, timeout=10) as response:
+        status: int = response.status
+        return status
+
+
+def replay_message(webhook_url: str, message: Dict[str, Any]) -> bool:
+    try:
+        post_to_slack(webhook_url, get_slack_payload(message))
+    except (urllib.error.URLError, KeyError, ValueError) as error:
+        # Left on the queue and retried on a later replay.
+        print('Failed to replay message', message['MessageId'], error)
+        return False
+    delete_message(message)
+    return True
+
+
+def handler(event: Dict[str, Any], context: Any) -> Dict[str, int]:
+    webhook_url = get_webhook_url()
+    replayed = 0
+    failed = 0
+    while context.get_remaining_time_in_millis() > MINIMUM_REMAINING_TIME_MILLIS:
+        messages = receive_messages()
+        if not messages:
+            break
+        for message in messages:
+            if replay_message(webhook_url, message):
+                replayed += 1
+            else:
+                failed += 1
+            # Same pace as the API destination.
+            time.sleep(1 / RATE_LIMIT_PER_SECOND)
+    print(f'Replayed {replayed} messages, {failed} failed')
+    return {
+        'replayed': replayed,
+        'failed': failed,
+    }
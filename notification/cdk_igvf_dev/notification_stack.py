@@ -4,16 +4,31 @@ from constructs import Construct
 
 from aws_cdk.aws_chatbot import SlackChannelConfiguration
 
+from aws_cdk.aws_cloudwatch import Alarm
+from aws_cdk.aws_cloudwatch import ComparisonOperator
+from aws_cdk.aws_cloudwatch import IMetric
+
+from aws_cdk.aws_cloudwatch_actions import SnsAction
+
 from aws_cdk.aws_sns import Topic
 
+from cdk_igvf_dev.constructs.slack import SlackNotificationAggregator
 from cdk_igvf_dev.constructs.slack import SlackWebhook
 
 from typing import Any
+from typing import Optional
+from typing import cast
 
 
 class NotificationStack(cdk.Stack):
 
-    def __init__(self, scope: Construct, construct_id: str, **kwargs: Any) -> None:
+    def __init__(
+            self,
+            scope: Construct,
+            construct_id: str,
+            slack_aggregation_window: Optional[cdk.Duration] = None,
+            **kwargs: Any
+    ) -> None:
         super().__init__(scope, construct_id, **kwargs)
         self.encode_dcc_chatbot: SlackChannelConfiguration = SlackChannelConfiguration(
             self,
@@ -32,4 +47,33 @@ class NotificationStack(cdk.Stack):
         self.encode_dcc_slack_webhook: SlackWebhook = SlackWebhook(
             self,
             'AwsIgvfDevSlackWebhook',
+            aggregated=slack_aggregation_window is not None,
+        )
+        if slack_aggregation_window is not None:
+            # Merges bursts of notifications before they reach the webhook.
+            self.slack_notification_aggregator = SlackNotificationAggregator(
+                self,
+                'SlackNotificationAggregator',
+                dead_letter_queue=self.encode_dcc_slack_webhook.dead_letter_queue,
+                window=slack_aggregation_window,
+            )
+        # Undeliverable Slack notifications show up through chatbot.
+        # The jsii Metric class doesn't satisfy the IMetric protocol for
+        # mypy, though it implements it.
+        dead_letter_queue_metric = cast(
+            IMetric,
+            self.encode_dcc_slack_webhook.dead_letter_queue.metric_approximate_number_of_messages_visible()
+        )
+        dead_letter_queue_alarm = Alarm(
+            self,
+            'SlackWebhookDeadLetterQueueAlarm',
+            metric=dead_letter_queue_metric,
+            threshold=0,
+            comparison_operator=ComparisonOperator.GREATER_THAN_THRESHOLD,
+            evaluation_periods=1,
+        )
+        dead_letter_queue_alarm.add_alarm_action(
+            SnsAction(
+                self.alarm_notification_topic
+            )
         )
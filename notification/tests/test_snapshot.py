@@ -5,13 +5,15 @@ from cdk_igvf_dev.notification_stack import NotificationStack
 
 from aws_cdk.assertions import Template
 
+from typing import Any
+
 ENVIRONMENT = cdk.Environment(
     account='testing',
     region='testing'
 )
 
 
-def test_match_with_snapshot(snapshot):
+def test_match_with_snapshot(snapshot: Any) -> None:
     app = cdk.App()
     stack = NotificationStack(app, 'NotificationStack', env=ENVIRONMENT)
     template = Template.from_stack(stack)
@@ -23,3 +25,22 @@ def test_match_with_snapshot(snapshot):
         ),
         'notification_stack_template.json'
     )
+
+
+def test_slack_aggregation_match_with_snapshot(snapshot: Any) -> None:
+    app = cdk.App()
+    stack = NotificationStack(
+        app,
+        'NotificationStack',
+        slack_aggregation_window=cdk.Duration.minutes(2),
+        env=ENVIRONMENT
+    )
+    template = Template.from_stack(stack)
+    snapshot.assert_match(
+        json.dumps(
+            template.to_json(),
+            indent=4,
+            sort_keys=True
+        ),
+        'notification_stack_template.json'
+    )
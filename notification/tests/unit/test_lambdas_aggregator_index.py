@@ -0,0 +1,209 @@
+import pytest
+
+import json
+
+from pytest_mock import MockerFixture
+
+from typing import Any
+from typing import Dict
+from typing import List
+from typing import Tuple
+
+
+@pytest.fixture
+def index(mocker: MockerFixture) -> Any:
+    import os
+    mocker.patch.dict(
+        os.environ,
+        {
+            'AWS_DEFAULT_REGION': 'us-west-1',
+        }
+    )
+    from cdk_igvf_dev.lambdas.aggregator import index as aggregator_index
+    mocker.patch.object(aggregator_index, 'events_client')
+    aggregator_index.events_client.put_events.side_effect = lambda Entries: {
+        'FailedEntryCount': 0,
+        'Entries': [
+            {'EventId': str(i)}
+            for i, _ in enumerate(Entries)
+        ],
+    }
+    return aggregator_index
+
+
+def make_record(message_id: str, detail_type: str, source: str, slack: Dict[str, Any]) -> Dict[str, Any]:
+    return {
+        'messageId': message_id,
+        'body': json.dumps(
+            {
+                'detail-type': detail_type,
+                'source': source,
+                'detail': {
+                    'metadata': {
+                        'includes_slack_notification': True,
+                    },
+                    'data': {
+                        'slack': slack,
+                    },
+                },
+            }
+        )
+    }
+
+
+def get_sent_details(index: Any) -> List[Tuple[str, Dict[str, Any]]]:
+    return [
+        (entry['DetailType'], json.loads(entry['Detail'])['data']['slack'])
+        for call in index.events_client.put_events.call_args_list
+        for entry in call.kwargs['Entries']
+    ]
+
+
+def test_lambdas_aggregator_index_make_texts(index: Any) -> None:
+    assert index.make_texts('A', 'b', [{'text': 'x'}]) == [{'text': 'x'}]
+    assert index.make_texts(
+        'StackDeleteFailed',
+        'demo.cleaner',
+        [
+            {'text': 'x'},
+            {'text': 'y'},
+            {'text': 'x'},
+            {'blocks': []},
+            {'blocks': []},
+        ]
+    ) == [
+        {
+            'text': '*StackDeleteFailed* from demo.cleaner: 5 notifications\nx (x2)\ny'
+        },
+        {'blocks': []},
+    ]
+
+
+def test_lambdas_aggregator_index_split_lines(index: Any) -> None:
+    assert index.split_lines(['a' * 4, 'b' * 4, 'c' * 4], max_length=10) == [
+        ['aaaa', 'bbbb'],
+        ['cccc'],
+    ]
+    assert index.split_lines([], max_length=10) == []
+
+
+def test_lambdas_aggregator_index_handler(index: Any) -> None:
+    records = [
+        make_record(f'deleted-{i}', 'StackDeleteSucceeded', 'demo.cleaner', {'text': f'deleted {i}'})
+        for i in range(12)
+    ] + [
+        make_record(f'alarm-{i}', 'Alarm', 'igvfd', {'text': 'alarm'})
+        for i in range(5)
+    ]
+    assert index.handler({'Records': records}, {}) == {
+        'batchItemFailures': [],
+    }
+    sent = get_sent_details(index)
+    assert sent[0][0] == 'StackDeleteSucceeded'
+    assert sent[0][1]['text'].splitlines()[0] == '*StackDeleteSucceeded* from demo.cleaner: 12 notifications'
+    assert sent[1] == ('Alarm', {'text': '*Alarm* from igvfd: 5 notifications\nalarm (x5)'})
+    entry = index.events_client.put_events.call_args.kwargs['Entries'][0]
+    assert entry['Source'] == index.AGGREGATED_SOURCE
+    assert json.loads(entry['Detail'])['metadata'] == {
+        'includes_slack_notification': True,
+        'aggregated': True,
+    }
+
+
+def test_lambdas_aggregator_index_handler_puts_events_in_batches(index: Any) -> None:
+    records = [
+        make_record(str(i), f'Type{i}', 'demo.cleaner', {'text': 'x'})
+        for i in range(25)
+    ]
+    index.handler({'Records': records}, {})
+    assert [
+        len(call.kwargs['Entries'])
+        for call in index.events_client.put_events.call_args_list
+    ] == [10, 10, 5]
+
+
+def test_lambdas_aggregator_index_handler_reports_unparsable_records(index: Any) -> None:
+    records = [
+        make_record('good', 'A', 'b', {'text': 'x'}),
+        {
+            'messageId': 'no-data',
+            'body': json.dumps(
+                {
+                    'detail-type': 'A',
+                    'source': 'b',
+                    'detail': {},
+                }
+            ),
+        },
+        {
+            'messageId': 'not-json',
+            'body': 'abc',
+        },
+    ]
+    # The good record is still sent and only the bad ones are retried.
+    assert index.handler({'Records': records}, {}) == {
+        'batchItemFailures': [
+            {'itemIdentifier': 'no-data'},
+            {'itemIdentifier': 'not-json'},
+        ]
+    }
+    assert get_sent_details(index) == [('A', {'text': 'x'})]
+
+
+def test_lambdas_aggregator_index_handler_reports_failed_groups(index: Any) -> None:
+    index.events_client.put_events.side_effect = None
+    index.events_client.put_events.return_value = {
+        'FailedEntryCount': 1,
+        'Entries': [
+            {'EventId': '1'},
+            {'ErrorCode': 'InternalFailure'},
+        ],
+    }
+    records = [
+        make_record('a-1', 'A', 'b', {'text': 'x'}),
+        make_record('c-1', 'C', 'd', {'text': 'y'}),
+        make_record('a-2', 'A', 'b', {'text': 'z'}),
+        make_record('c-2', 'C', 'd', {'text': 'y'}),
+    ]
+    # Only the group whose event wasn't put is retried.
+    assert index.handler({'Records': records}, {}) == {
+        'batchItemFailures': [
+            {'itemIdentifier': 'c-1'},
+            {'itemIdentifier': 'c-2'},
+        ]
+    }
+
+
+def test_lambdas_aggregator_index_handler_reports_batches_that_raise(index: Any) -> None:
+    from botocore.exceptions import ClientError
+    error = ClientError(
+        {'Error': {'Code': 'ThrottlingException', 'Message': 'slow down'}},
+        'PutEvents'
+    )
+    sent: List[Dict[str, Any]] = []
+
+    def put_events(Entries: List[Dict[str, Any]]) -> Dict[str, Any]:
+        if sent:
+            raise error
+        sent.extend(Entries)
+        return {
+            'FailedEntryCount': 0,
+            'Entries': [
+                {'EventId': str(i)}
+                for i, _ in enumerate(Entries)
+            ],
+        }
+
+    index.events_client.put_events.side_effect = put_events
+    records = [
+        make_record(str(i), f'Type{i}', 'demo.cleaner', {'text': 'x'})
+        for i in range(12)
+    ]
+    # The first ten groups were sent and aren't retried.
+    assert index.handler({'Records': records}, {}) == {
+        'batchItemFailures': [
+            {'itemIdentifier': '10'},
+            {'itemIdentifier': '11'},
+        ]
+    }
+    assert len(sent) == 10
@@ -0,0 +1,113 @@
+import pytest
+
+import json
+
+from pytest_mock import MockerFixture
+
+from typing import Any
+from typing import Dict
+
+
+@pytest.fixture
+def index(mocker: MockerFixture) -> Any:
+    import os
+    mocker.patch.dict(
+        os.environ,
+        {
+            'AWS_DEFAULT_REGION': 'us-west-1',
+            'QUEUE_URL': 'abc',
+            'WEBHOOK_URL_PARAMETER_NAME': 'SLACK_WEBHOOK_URL',
+            'RATE_LIMIT_PER_SECOND': '1',
+        }
+    )
+    from cdk_igvf_dev.lambdas.replay import index as replay_index
+    mocker.patch.object(replay_index, 'sqs_client')
+    mocker.patch.object(replay_index, 'ssm_client')
+    replay_index.ssm_client.get_parameter.return_value = {
+        'Parameter': {
+            'Value': 'https://hooks.slack.com/services/xyz',
+        }
+    }
+    mocker.patch('time.sleep')
+    return replay_index
+
+
+def make_message(message_id: str, text: str) -> Dict[str, Any]:
+    return {
+        'MessageId': message_id,
+        'ReceiptHandle': f'handle-{message_id}',
+        'Body': json.dumps(
+            {
+                'detail-type': 'StackDeleteSucceeded',
+                'source': 'demo.cleaner',
+                'detail': {
+                    'metadata': {
+                        'includes_slack_notification': True,
+                    },
+                    'data': {
+                        'slack': {
+                            'text': text,
+                        },
+                    },
+                },
+            }
+        ),
+    }
+
+
+def test_lambdas_replay_index_get_slack_payload(index: Any) -> None:
+    assert index.get_slack_payload(make_message('1', 'hi')) == {'text': 'hi'}
+
+
+def test_lambdas_replay_index_handler(index: Any, mocker: MockerFixture) -> None:
+    import urllib.error
+    from email.message import Message
+    index.sqs_client.receive_message.side_effect = [
+        {
+            'Messages': [
+                make_message('1', 'a'),
+                make_message('2', 'b'),
+                {'MessageId': '3', 'ReceiptHandle': 'handle-3', 'Body': '{}'},
+            ]
+        },
+        {
+            'Messages': [
+                make_message('4', 'c'),
+            ]
+        },
+        {},
+    ]
+    patched_post_to_slack = mocker.patch.object(
+        index,
+        'post_to_slack',
+        side_effect=[
+            200,
+            urllib.error.HTTPError('url', 500, 'error', Message(), None),
+            200,
+        ]
+    )
+    context = mocker.Mock()
+    context.get_remaining_time_in_millis.return_value = 300000
+    assert index.handler({}, context) == {
+        'replayed': 2,
+        'failed': 2,
+    }
+    patched_post_to_slack.assert_any_call(
+        'https://hooks.slack.com/services/xyz',
+        {'text': 'a'}
+    )
+    # Failed and malformed messages stay on the queue.
+    assert [
+        call.kwargs['ReceiptHandle']
+        for call in index.sqs_client.delete_message.call_args_list
+    ] == ['handle-1', 'handle-4']
+
+
+def test_lambdas_replay_index_handler_stops_before_timeout(index: Any, mocker: MockerFixture) -> None:
+    context = mocker.Mock()
+    context.get_remaining_time_in_millis.return_value = 1000
+    assert index.handler({}, context) == {
+        'replayed': 0,
+        'failed': 0,
+    }
+    index.sqs_client.receive_message.assert_not_called()